@@ -3,7 +3,7 @@ from fastapi.responses import RedirectResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from datetime import datetime, timedelta
 from app.models.user import UserCreate
-from app.core.security import verify_password, get_password_hash, create_access_token
+from app.core.security import verify_password, get_password_hash, create_access_token, invalidate_user
 from app.db.mongodb import get_database
 from app.utils.token_utils import verify_invitation_token
 from bson import ObjectId
@@ -409,5 +409,6 @@ async def reset_password(request: ResetPasswordRequest, db=Depends(get_database)
         {"_id": ObjectId(user_id)},
         {"$set": {"hashed_password": hashed_pw}}
     )
+    invalidate_user(user_id)
 
     return {"message": "Password reset successful"}
\ No newline at end of file
@@ -4,9 +4,11 @@ from app.models.company import CompanyCreate, SimpleCompanyOut, CompanyInDB, Upd
 from app.models.user import UserPublic
 from bson import ObjectId
 from app.db.mongodb import get_database
-from app.core.security import get_current_user
+from app.core.security import get_current_user, invalidate_membership, invalidate_user
 from typing import List
 from app.core.security import create_access_token
+from app.services.user_lookup import full_name, lookup_user
+from app.services.ticket_service import invalidate_ticket_prefix
 
 router = APIRouter()
 
@@ -139,6 +141,8 @@ async def update_company(
         update_data["site_url"] = payload.site_url
     if payload.email is not None:
         update_data["email"] = payload.email
+    if payload.ticket_prefix is not None:
+        update_data["ticket_prefix"] = payload.ticket_prefix
 
     if not update_data:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No fields provided for update")
@@ -152,11 +156,15 @@ async def update_company(
     if not updated_company:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Company not found")
 
+    if "ticket_prefix" in update_data:
+        invalidate_ticket_prefix(updated_company["_id"])
+
     return {
         "id": str(updated_company["_id"]),
         "name": updated_company.get("name"),
         "site_url": updated_company.get("site_url"),
-        "email": updated_company.get("email")
+        "email": updated_company.get("email"),
+        "ticket_prefix": updated_company.get("ticket_prefix")
     }
 
 #GET /api/v1/company/{company_id}/members
@@ -169,22 +177,22 @@ async def list_company_members(
     if not ObjectId.is_valid(company_id):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid company ID")
 
-    members_cursor = db["memberships"].find({
-        "company_id": ObjectId(company_id),
-        "status": "active"
-    })
+    # Members joined to their users server-side: one query whatever the team size
+    members_cursor = db["memberships"].aggregate([
+        {"$match": {"company_id": ObjectId(company_id), "status": "active"}},
+        *lookup_user("user_id"),
+    ])
 
     memberships = []
     async for membership in members_cursor:
-        user = await db["users"].find_one({"_id": membership["user_id"]})
-        if user:
-            memberships.append({
-                "id": str(membership["_id"]),
-                "name": f"{user.get('first_name', '')} {user.get('last_name', '')}".strip(),
-                "email": user["email"],
-                "role": membership["role"],
-                "status": "active"
-            })
+        user = membership["user"]
+        memberships.append({
+            "id": str(membership["_id"]),
+            "name": full_name(user),
+            "email": user["email"],
+            "role": membership["role"],
+            "status": "active"
+        })
 
     invitations_cursor = db["invitations"].find({
         "company_id": ObjectId(company_id),
@@ -213,23 +221,21 @@ async def active_members(
     if not ObjectId.is_valid(company_id):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid company ID")
 
-    members_cursor = db["memberships"].find({
-        "company_id": ObjectId(company_id),
-        "role": "agent",
-        "status": "active"
-    })
+    members_cursor = db["memberships"].aggregate([
+        {"$match": {"company_id": ObjectId(company_id), "status": "active", "role": "agent"}},
+        *lookup_user("user_id"),
+    ])
 
     members = []
     async for membership in members_cursor:
-        user = await db["users"].find_one({"_id": membership["user_id"]})
-        if user:
-            members.append({
-                "id": str(user["_id"]),
-                "name": f"{user.get('first_name', '')} {user.get('last_name', '')}".strip(),
-                "email": user["email"],
-                "role": membership["role"],
-                "status": "active"
-            })
+        user = membership["user"]
+        members.append({
+            "id": str(user["_id"]),
+            "name": full_name(user),
+            "email": user["email"],
+            "role": membership["role"],
+            "status": "active"
+        })
    
     if not members:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No active members found for this company")
@@ -257,6 +263,7 @@ async def delete_membership(
             raise HTTPException(status_code=404, detail="Membership not found")
 
         result = await db.memberships.delete_one({"_id": ObjectId(id)})
+        invalidate_membership(membership["user_id"], membership.get("company_id"))
 
         # Remove associated invitations
         company_id = membership.get("company_id")
@@ -272,6 +279,7 @@ async def delete_membership(
         deleted_user_membership = await db.memberships.find_one({"user_id": deleted_user_id})
         if not deleted_user_membership:
             await db.users.delete_one({"_id": deleted_user_id})
+            invalidate_user(deleted_user_id)
 
     elif status == "pending":
         invitation = await db.invitations.find_one({"_id": ObjectId(id)})
@@ -4,32 +4,29 @@ from typing import List, Optional, Dict, Any
 import httpx
 from urllib.parse import urlencode
 from datetime import datetime, timedelta
-from app.core.security import get_current_user
+from app.core.security import get_current_user, get_membership
 from bson import ObjectId
 from motor.motor_asyncio import AsyncIOMotorDatabase
 import os
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from google.cloud import pubsub_v1
-from app.core.config import settings
 import asyncio
 import json
 import base64
 import urllib.parse
 from app.db.mongodb import get_database
-from app.services.gmail_service import get_gmail_service
-from google.oauth2 import service_account
-from email.utils import parsedate_to_datetime
+from app.services.gmail_client import GmailClient
+from app.services.gmail_credentials import gmail_client_for, invalidate_gmail_client
+from app.services.gmail_queue import enqueue, queue_stats
+from app.services.gmail_watch import topic_name, watch_fields
+from app.services.pubsub import ensure_subscription, gmail_notification
+from app.services.user_lookup import lookup_one, lookup_user
 from app.models.gmail import (
     GmailAccountCreate,
     GmailAccountUpdate,
     GmailAccountInDB
 )
 
-from app.models.message import Message, ChatEntry 
+from app.models.message import Message
 from app.utils.logger import logger
-from app.main import sio
-import re
 
 router = APIRouter()
 
@@ -49,7 +46,9 @@ def gmail_account_helper(account: dict) -> dict:
         "token_issued_at": account.get("token_issued_at"),
         "is_primary": account.get("is_primary", False),
         "provider": account.get("provider", "google"),
-        "history_id":  account.get("history_id", ""),
+        "history_id": str(account.get("history_id") or ""),
+        "watch_expiration": account.get("watch_expiration"),
+        "watch_error": account.get("watch_error"),
         "store": account.get("store", "")
     }
 
@@ -81,38 +80,37 @@ async def list_gmail_accounts(
         raise HTTPException(status_code=400, detail="Invalid company ID")
     
     # ✅ check membership
-    membership = await db["memberships"].find_one(
-        {"user_id": current_user["_id"], "company_id": ObjectId(company_id)}
-    )
+    membership = await get_membership(db, current_user["_id"], company_id)
 
     if not membership:
         raise HTTPException(status_code=403, detail="User is not a member of this company")
     
     role = membership.get("role")
 
-    if role == "company_owner":
-        accounts_cursor = db.gmail_accounts.find({"company_id": ObjectId(company_id)})
-    elif role == "store_owner":
-        accounts_cursor = db.gmail_accounts.find({"user_id": current_user["_id"]})
-    else:  # agent and fallback
-        accounts_cursor = db.gmail_accounts.find({"company_id": ObjectId(company_id)})
-    
+    if role == "store_owner":
+        account_filter = {"user_id": current_user["_id"]}
+    else:  # company_owner, agent and fallback
+        account_filter = {"company_id": ObjectId(company_id)}
+
+    # Accounts with their owner and linked store, joined in a single aggregate
+    accounts_cursor = db.gmail_accounts.aggregate([
+        {"$match": account_filter},
+        *lookup_user("user_id", "owner"),
+        *lookup_one("shopify_cred", "store_id", "linked_store", {"shop": 1}, required=False),
+    ])
+
     accounts = []
     async for account in accounts_cursor:
-        owner = await db.users.find_one({"_id": account["user_id"]})
-        if not owner:
-            continue
+        owner = account["owner"]
         account_data = gmail_account_helper(account)
         account_data["owner_email"] = owner.get("email", "unknown")
         account_data["owner_name"] = f"{owner.get('first_name', 'unknown')} {owner.get('last_name', 'unknown')}"
-        if account.get("store_id"):
-            store = await db.shopify_cred.find_one({"_id": account["store_id"]})
-            if store:
-                print(store)
-                account_data["store"] = {
-                    "id": str(store["_id"]),
-                    "shop": store.get("shop", "")
-                }
+        store = account.get("linked_store")
+        if account.get("store_id") and store:
+            account_data["store"] = {
+                "id": str(store["_id"]),
+                "shop": store.get("shop", "")
+            }
         accounts.append(account_data)
 
     # ✅ fetch stores properly
@@ -208,21 +206,13 @@ async def delete_gmail_account(account_id: str, request: Request):
 
     # Step 1: Stop Gmail Watch for this user
     try:
-        creds = Credentials(
-            token=account['access_token'],
-            refresh_token=account.get('refresh_token'),
-            token_uri=account.get('token_uri', 'https://oauth2.googleapis.com/token'),
-            client_id=account['client_id'],
-            client_secret=account['client_secret'],
-            scopes=account.get('scopes', ['https://www.googleapis.com/auth/gmail.modify', 'https://www.googleapis.com/auth/gmail.readonly']),
-        )
-        service = build('gmail', 'v1', credentials=creds)
-        service.users().stop(userId="me").execute()
+        await (await gmail_client_for(db, account)).stop()
     except Exception as e:
         # Don't block delete if Gmail stop fails
         print(f"Failed to stop watch for {account['email']}: {e}")
 
     # Step 2: Delete from DB
+    invalidate_gmail_client(account["_id"])
     result = await db.gmail_accounts.delete_one({"_id": ObjectId(account_id)})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Gmail account not found")
@@ -346,58 +336,21 @@ async def google_oauth_callback(
     if not email:
         raise HTTPException(status_code=400, detail="Failed to retrieve user email")
 
-    # Build credentials
-    creds = Credentials(
-        token=access_token,
-        refresh_token=refresh_token,
-        token_uri="https://oauth2.googleapis.com/token",
-        client_id=GOOGLE_CLIENT_ID,
-        client_secret=GOOGLE_CLIENT_SECRET,
-        scopes=["https://www.googleapis.com/auth/gmail.readonly"]
-    )
-
-    # Call Gmail API in threadpool (avoid blocking)
-    def watch_gmail():
-        gmail = build("gmail", "v1", credentials=creds)
-        watch_request = {
-            "labelIds": ["INBOX"],
-            "topicName": f"projects/{settings.PUBSUB_PROJECT}/topics/{settings.PUBSUB_TOPIC}",
-        }
-        return gmail.users().watch(userId="me", body=watch_request).execute()
-
-    loop = asyncio.get_running_loop()
-    watch_response = await loop.run_in_executor(None, watch_gmail)
+    # Start the Gmail watch with the fresh token
+    watch_response = await GmailClient({
+        "email": email,
+        "access_token": access_token,
+        "refresh_token": refresh_token,
+        "client_id": GOOGLE_CLIENT_ID,
+        "client_secret": GOOGLE_CLIENT_SECRET,
+        "expires_at": expires_at,
+    }).watch(topic_name(), label_ids=["INBOX"])
     print(watch_response)
 
-    history_id = watch_response["historyId"]
-
-    # ✅ Ensure Pub/Sub subscription exists
-    service_account_info = json.loads(settings.SERVICE_ACCOUNT_JSON)
-
-    credentials = service_account.Credentials.from_service_account_info(
-        service_account_info,
-        scopes=["https://www.googleapis.com/auth/pubsub"]
-    )
-
-    def ensure_subscription():
-        subscriber = pubsub_v1.SubscriberClient(credentials=credentials)
-        topic_path = subscriber.topic_path(settings.PUBSUB_PROJECT, settings.PUBSUB_TOPIC)
-        subscription_path = subscriber.subscription_path(settings.PUBSUB_PROJECT, settings.PUBSUB_SUBSCRIPTION)
-
-        try:
-            subscriber.get_subscription(request={"subscription": subscription_path})
-        except Exception:
-            subscriber.create_subscription(
-                request={
-                    "name": subscription_path, 
-                    "topic": topic_path,
-                    "push_config": {
-                        "push_endpoint": f"{settings.BACKEND_URL}/api/v1/gmail/pubsub/push"
-                    }
-                }
-            )
-        return subscription_path
+    history_id = int(watch_response["historyId"])
 
+    # ✅ Ensure Pub/Sub subscription exists (push or pull, per PUBSUB_MODE)
+    loop = asyncio.get_running_loop()
     subscription_path = await loop.run_in_executor(None, ensure_subscription)
 
     # Save/update Gmail account
@@ -419,10 +372,15 @@ async def google_oauth_callback(
         "provider": "google",
         "history_id": history_id,
         "subscription": subscription_path,  # ✅ store subscription
+        **watch_fields(watch_response),  # the scheduler renews it before watch_expiration
     }
 
     if existing:
-        await db.gmail_accounts.update_one({"_id": existing["_id"]}, {"$set": account_data})
+        await db.gmail_accounts.update_one(
+            {"_id": existing["_id"]},
+            {"$set": account_data, "$unset": {"watch_error": "", "watch_failures": "", "watch_retry_at": ""}},
+        )
+        invalidate_gmail_client(existing["_id"])
     else:
         await db.gmail_accounts.insert_one(account_data)
 
@@ -449,202 +407,31 @@ async def pubsub_push(request: Request, db=Depends(get_database)):
         logger.error("Failed to decode Pub/Sub data", exc_info=True)
         return Response(status_code=400)
 
-    email_address = data.get("emailAddress")
-    history_id = data.get("historyId")
-
-    if not email_address or not history_id:
-        logger.warning("Pub/Sub payload missing emailAddress or historyId: %s", data)
+    notification = gmail_notification(data)
+    if notification is None:
         return Response(status_code=200)
+    email_address, history_id = notification
 
     logger.info("📩 Gmail change detected", extra={"email": email_address, "historyId": history_id})
 
-    account = await db["gmail_accounts"].find_one({"email": email_address})
-    if not account:
-        logger.info("No account found for %s", email_address)
-        return Response(status_code=200)
-
-    user_id = account["user_id"]
-    company_id = account["company_id"]
-
+    # Persist and acknowledge; the queue workers do the Gmail/Mongo work
     try:
-        service = get_gmail_service(account)
+        await enqueue(db, email_address, history_id)
     except Exception:
-        logger.error("Failed to initialize Gmail API service for %s", email_address, exc_info=True)
+        # Not persisted: let Pub/Sub redeliver
+        logger.error("Failed to enqueue Gmail notification for %s", email_address, exc_info=True)
         return Response(status_code=500)
 
-    last_history_id = account.get("history_id")
-    if not last_history_id:
-        logger.debug("No stored historyId for %s. Skipping history fetch.", email_address)
-    else:
-        try:
-            results = service.users().history().list(
-                userId="me",
-                startHistoryId=last_history_id
-            ).execute()
+    return Response(status_code=200)
 
-            history = results.get("history", [])
-        except Exception:
-            logger.error("Failed fetching Gmail history for %s", email_address, exc_info=True)
-            return Response(status_code=500)
-
-        for record in history:
-            if "messagesAdded" not in record:
-                continue
-
-            for added in record["messagesAdded"]:
-                gmail_id = added["message"]["id"]
-
-                try:
-                    full_msg = service.users().messages().get(
-                        userId="me",
-                        id=gmail_id,
-                        format="full" 
-                    ).execute()
-                except Exception:
-                    logger.error("Failed fetching Gmail message %s", gmail_id, exc_info=True)
-                    continue
-                
-                labels = full_msg.get("labelIds", [])
-                if "INBOX" not in labels:
-                    continue
-                thread_id = full_msg.get("threadId", gmail_id)
-                payload = full_msg.get("payload", {}) or {}
-                headers = payload.get("headers", [])
-
-                subject = next((h["value"] for h in headers if h["name"] == "Subject"), "")
-                sender = next((h["value"] for h in headers if h["name"] == "From"), "")
-                to = next((h["value"] for h in headers if h["name"] == "To"), "")
-                date = next((h["value"] for h in headers if h["name"] == "Date"), "")
-
-                try:
-                    timestamp = parsedate_to_datetime(date)
-                except Exception:
-                    timestamp = datetime.utcnow()
-
-                # --- Extract bodies ---
-                text_body, html_body = "", ""
-
-                def extract_bodies(payload):
-                    nonlocal text_body, html_body
-                    if "parts" in payload:
-                        for part in payload["parts"]:
-                            mime_type = part.get("mimeType")
-                            data = part["body"].get("data", "")
-                            if data:
-                                decoded = base64.urlsafe_b64decode(data).decode("utf-8", errors="ignore")
-                                if mime_type == "text/plain" and not text_body:
-                                    text_body = decoded
-                                elif mime_type == "text/html" and not html_body:
-                                    html_body = decoded
-                            if "parts" in part:
-                                extract_bodies(part)
-                    else:
-                        data = payload.get("body", {}).get("data", "")
-                        if data:
-                            decoded = base64.urlsafe_b64decode(data).decode("utf-8", errors="ignore")
-                            mime_type = payload.get("mimeType")
-                            if mime_type == "text/plain":
-                                text_body = decoded
-                            elif mime_type == "text/html":
-                                html_body = decoded
-
-                extract_bodies(payload)
-                content = html_body if html_body else text_body
-
-                chat_entry = ChatEntry(
-                    sender=sender,
-                    recipient=to,
-                    content=content,
-                    title=subject,
-                    timestamp=timestamp,
-                    channel="email",
-                    message_type="html",
-                    metadata={
-                        "gmail_id": gmail_id,
-                        "from": sender,
-                        "to": to,
-                        "subject": subject,
-                        "date": date
-                    }
-                )
-
-                existing_thread = await db["messages"].find_one(
-                    {"user_id": ObjectId(user_id), "thread_id": thread_id, "channel": "email"}
-                )
-
-                if existing_thread:
-                    if any(m.get("metadata", {}).get("gmail_id") == gmail_id for m in existing_thread.get("messages", [])):
-                        logger.debug("Duplicate Gmail %s ignored for thread %s", gmail_id, thread_id)
-                        continue
-
-                    participants = existing_thread.get("participants", [])
-                    for p in [sender, to]:
-                        if p not in participants:
-                            participants.append(p)
-
-                    await db["messages"].update_one(
-                        {"_id": existing_thread["_id"]},
-                        {
-                            "$push": {"messages": chat_entry.dict()},
-                            "$set": {
-                                "last_updated": timestamp,
-                                "title": subject,
-                                "participants": participants
-                            }
-                        }
-                    )
-                else:
-
-                    shopify_order_match = re.search(r"#([A-Z]{2}\d+)", subject or content or "")
-                    shopify_order = shopify_order_match.group(1) if shopify_order_match else None
-                    
-                    # Generate new ticket number
-                    today = datetime.utcnow().strftime("%Y-%m-%d")
-                    count_today = await db["messages"].count_documents({
-                        "company_id": ObjectId(company_id),
-                        "started_at": {"$gte": datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)}
-                    })
-                    ticket_number = f"CA-{today}-{count_today + 1:04d}"
-
-                    logger.info(f"Creating new ticket {ticket_number} for order {shopify_order}")
-                    
-                    message_doc = {
-                        "user_id": ObjectId(user_id),
-                        "company_id": ObjectId(company_id),
-                        "thread_id": thread_id,
-                        "participants": list(set([sender, to])),
-                        "channel": "email",
-                        "status": "Open",
-                        "title": subject,
-                        "ticket": ticket_number,
-                        "client": sender,
-                        "agent": to,
-                        "messages": [chat_entry.dict()],
-                        "last_updated": timestamp,
-                        "started_at": timestamp,
-                        "ai_summary": None,
-                        "tags": [],
-                        "resolved_by_ai": False
-                    }
-                    await db["messages"].insert_one(message_doc)
-
-                await sio.emit(
-                    "gmail_update",
-                    {
-                        "user_id": str(user_id),
-                        "company_id": str(company_id),
-                        "email": email_address,
-                        "message": f"New messages pushed for {email_address}"
-                    }
-                )
-                
-    await db["gmail_accounts"].update_one(
-        {"_id": account["_id"]},
-        {"$set": {"history_id": history_id}}
-    )
 
-    logger.info("✅ Processed Gmail Pub/Sub for %s up to historyId=%s", email_address, history_id)
-    return Response(status_code=200)
+#/api/v1/gmail/pubsub/queue
+@router.get("/pubsub/queue")
+async def pubsub_queue_stats(current_user: dict = Depends(get_current_user), db=Depends(get_database)):
+    """Depth and lag of the Gmail notification queue, across all tenants: admins only."""
+    if current_user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return await queue_stats(db)
 
 
 
@@ -2,7 +2,7 @@ from fastapi import APIRouter, Depends, HTTPException, status
 from app.models.membership import UpdateMembershipRequest
 from bson import ObjectId
 from app.db.mongodb import get_database
-from app.core.security import get_current_user
+from app.core.security import get_current_user, invalidate_membership, invalidate_user
 
 router = APIRouter()
 
@@ -35,6 +35,10 @@ async def update_membership(
     if not update_membership:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Membership not found")
 
+    # Role/status changed (e.g. suspended): drop cached principals for this user
+    invalidate_membership(update_membership["user_id"], update_membership.get("company_id"))
+    invalidate_user(update_membership["user_id"])
+
     return {
         "id": str(update_membership["_id"]),
         "role": update_membership.get("role"),
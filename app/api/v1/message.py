@@ -1,10 +1,17 @@
 # app/routes/message.py
 
-from fastapi import APIRouter, HTTPException, Depends, Body, Query
-from app.services.gmail_service import fetch_all_gmail_accounts, get_gmail_service
+from fastapi import APIRouter, HTTPException, Depends, Body, Query, Response
+from fastapi.responses import StreamingResponse
+from gridfs.errors import NoFile
+from urllib.parse import quote
+from app.services.gmail_service import fetch_all_gmail_accounts, gmail_backfill_status
+from app.services.gmail_credentials import gmail_client_for
+from app.services.gmail_hydration import ensure_hydrated
+from app.services.gmail_mime import iter_decoded
 from app.db.mongodb import get_database
+from app.db import files, threads
 from app.models.message import Message, ChatEntry, PyObjectId 
-from typing import List
+from typing import List, Literal, Optional
 import re
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from bson import ObjectId
@@ -17,9 +24,11 @@ from email.mime.text import MIMEText
 from datetime import datetime, timezone
 from email.utils import parseaddr
 from pymongo import DESCENDING
-from app.core.security import get_current_user
-
-from math import ceil
+from app.core.security import get_current_user, get_membership
+from app.utils.pagination import approximate_count, keyset_filter, keyset_sort, next_cursor
+from app.services.user_lookup import fetch_users, to_object_id, user_summary
+from app.services.search_service import build_text_query, build_token_query
+from app.services.order_service import find_company_order, normalize_email
 
 router = APIRouter()
 
@@ -29,9 +38,22 @@ async def fetch_all(body: dict, db=Depends(get_database), current_user: dict = D
     if not ObjectId.is_valid(company_id):
         raise HTTPException(status_code=400, detail="Invalid company ID")
     
-    result = await fetch_all_gmail_accounts(db, user_id=str(current_user["_id"]), company_id= company_id)
+    days = body.get("days")
+    if days is not None and (not isinstance(days, int) or days < 1):
+        raise HTTPException(status_code=400, detail="days must be a positive integer")
+
+    # Queues a resumable backfill per account; progress at GET /fetch-all
+    kwargs = {"days": days} if days else {}
+    result = await fetch_all_gmail_accounts(db, user_id=str(current_user["_id"]), company_id= company_id, **kwargs)
     return {"result": result}
 
+@router.get("/fetch-all")
+async def fetch_all_status(company_id: str, db=Depends(get_database), current_user: dict = Depends(get_current_user)):
+    if not ObjectId.is_valid(company_id):
+        raise HTTPException(status_code=400, detail="Invalid company ID")
+
+    return {"result": await gmail_backfill_status(db, user_id=str(current_user["_id"]), company_id=company_id)}
+
 def extract_name(email_str: str) -> str:
     match = re.match(r"^(.*?)\s*<", email_str)
     return match.group(1).strip() if match else email_str
@@ -75,9 +97,18 @@ def doc_to_message_detail(doc: dict) -> Message:
 
 @router.get("/", response_model=List[dict])
 async def get_messages(db=Depends(get_database), current_user: dict = Depends(get_current_user)):
-    cursor = db["messages"].find({"user_id": current_user["_id"]}).sort("last_updated", DESCENDING)
+    docs = await (
+        db["messages"]
+        .find({"user_id": current_user["_id"]}, threads.LIST_PROJECTION)
+        .sort("last_updated", DESCENDING)
+        .to_list(length=None)
+    )
+
+    # Assigned members for the whole list in one query
+    members = await fetch_users(db, (doc.get("assigned_member_id") for doc in docs))
+
     messages = []
-    async for doc in cursor:
+    for doc in docs:
         doc["_id"] = str(doc["_id"]) 
         doc["user_id"] = str(doc["user_id"])
         doc["company_id"] = str(doc["company_id"])
@@ -86,34 +117,21 @@ async def get_messages(db=Depends(get_database), current_user: dict = Depends(ge
         doc["client"] = cleaned_client
 
         # Assigned member
-        member = None
-        assigned_member_id = doc.get("assigned_member_id")
-        if assigned_member_id:
-            try:
-                member_obj = await db["users"].find_one({"_id": assigned_member_id if isinstance(assigned_member_id, ObjectId) else ObjectId(assigned_member_id)})
-                if member_obj:
-                    member_obj["_id"] = str(member_obj["_id"])
-                    # Include only desired member fields
-                    member = {
-                        "id": member_obj["_id"],
-                        "name": f"{member_obj.get('first_name', '')} {member_obj.get('last_name', '')}".strip(),
-                        "email": member_obj.get("email", "")
-                    }
-            except Exception:
-                member = None
-        doc["assigned_to"] = member
+        doc["assigned_to"] = user_summary(members.get(to_object_id(doc.get("assigned_member_id"))))
         if "assigned_member_id" in doc and doc["assigned_member_id"]:
             doc.pop("assigned_member_id", None)
-        doc.pop("messages", None)
         messages.append(doc)
     return messages
 
 @router.get("/company_messages", response_model=dict)
 async def get_company_messages(
     company_id: str = Query(..., description="ID of the company"),
-    search: str = Query("", description="Search by message title or client name/email"),
+    search: str = Query("", description="Search by message title, client name/email or body"),
+    sort: Literal["recent", "relevance"] = Query("recent", description="Order search results by recency or relevance"),
     page: int = Query(1, ge=1, description="Page number"),
     size: int = Query(10, ge=1, le=100, description="Page size"),
+    cursor: Optional[str] = Query(None, description="Opaque cursor from a previous page's next_cursor; overrides page"),
+    include_count: Optional[bool] = Query(None, description="Return totals (default: on for page mode, off for cursor mode)"),
     db: AsyncIOMotorDatabase = Depends(get_database),
     current_user: dict = Depends(get_current_user)
 ):
@@ -121,9 +139,7 @@ async def get_company_messages(
         raise HTTPException(status_code=400, detail="Invalid company ID")
 
     # ✅ Verify membership
-    membership = await db["memberships"].find_one(
-        {"user_id": current_user["_id"], "company_id": ObjectId(company_id)}
-    )
+    membership = await get_membership(db, current_user["_id"], company_id)
     if not membership:
         raise HTTPException(status_code=403, detail="User is not a member of this company")
 
@@ -138,31 +154,49 @@ async def get_company_messages(
     elif role not in ["company_owner", "store_owner", "agent"]:
         query["user_id"] = current_user["_id"]
 
-    # ✅ Apply search filter (case-insensitive)
-    if search.strip():
-        search_regex = {"$regex": search.strip(), "$options": "i"}
-        query["$or"] = [
-            {"title": search_regex},
-            {"client": search_regex},
-        ]
-
-    # Count total documents for pagination
-    total_count = await db["messages"].count_documents(query)
-    totalPages = ceil(total_count / size)
-
-    # ✅ Pagination
-    skip = (page - 1) * size
+    # ✅ Apply search filter (index-backed, see app.services.search_service)
+    projection = threads.LIST_PROJECTION
+    sort_spec = keyset_sort("last_updated")
+    ranked = bool(search.strip()) and sort == "relevance"
+    if ranked:
+        if cursor:
+            raise HTTPException(status_code=400, detail="Cursor pagination is not available for relevance-sorted search")
+        text_filter, score_projection, sort_spec = build_text_query(search)
+        query.update(text_filter)
+        projection = {**projection, **score_projection}
+    elif search.strip():
+        token_query = build_token_query(search)
+        if token_query:
+            query = {"$and": [query, token_query]}
+
+    # Totals are optional and capped (see app.utils.pagination.COUNT_LIMIT)
+    if include_count is None:
+        include_count = cursor is None
+    totals = await approximate_count(db["messages"], query, size) if include_count else None
+
+    # ✅ Pagination: keyset on (last_updated, _id) when a cursor is given, skip otherwise
+    find_query = query
+    skip = 0
+    if cursor:
+        find_query = {"$and": [query, keyset_filter("last_updated", cursor)]}
+    else:
+        skip = (page - 1) * size
 
-    cursor = (
+    docs = await (
         db["messages"]
-        .find(query)
-        .sort("last_updated", DESCENDING)
+        .find(find_query, projection)
+        .sort(sort_spec)
         .skip(skip)
         .limit(size)
+        .to_list(length=size)
     )
+    next_page_cursor = None if ranked else next_cursor(docs, size, "last_updated")
+
+    # ✅ Assigned members for the whole page in one query
+    members = await fetch_users(db, (doc.get("assigned_member_id") for doc in docs))
 
     messages = []
-    async for doc in cursor:
+    for doc in docs:
         doc["_id"] = str(doc["_id"])
         doc["user_id"] = str(doc["user_id"])
         doc["company_id"] = str(doc["company_id"])
@@ -172,43 +206,33 @@ async def get_company_messages(
         doc["client"] = extract_name(raw_client)
 
         # ✅ Get assigned member details
-        assigned_member_id = doc.get("assigned_member_id")
-        member = None
-        if assigned_member_id:
-            try:
-                member_obj = await db["users"].find_one(
-                    {"_id": assigned_member_id if isinstance(assigned_member_id, ObjectId) else ObjectId(assigned_member_id)}
-                )
-                if member_obj:
-                    member = {
-                        "id": str(member_obj["_id"]),
-                        "name": f"{member_obj.get('first_name', '')} {member_obj.get('last_name', '')}".strip(),
-                        "email": member_obj.get("email", "")
-                    }
-            except Exception:
-                member = None
-        doc["assigned_to"] = member
+        doc["assigned_to"] = user_summary(members.get(to_object_id(doc.get("assigned_member_id"))))
 
-        # ✅ Cleanup unused fields
+        # ✅ Cleanup unused fields (entry bodies and comments are projected out)
         doc.pop("assigned_member_id", None)
-        doc.pop("messages", None)
-        doc.pop("comments", None)
 
         messages.append(doc)
 
-    return {
+    response = {
         "messages": messages,
-        "totalPages": totalPages
+        "next_cursor": next_page_cursor,
     }
+    if totals:
+        response["totalPages"] = totals["totalPages"]
+        response["total"] = totals["total"]
+        response["total_is_approximate"] = totals["approximate"]
+    return response
 
 @router.get("/{id}", response_model=dict)
 async def get_message(id: str, db: AsyncIOMotorDatabase = Depends(get_database)):
     if not ObjectId.is_valid(id):
         raise HTTPException(status_code=400, detail="Invalid message ID")
 
-    doc = await db["messages"].find_one({"_id": ObjectId(id)})
+    doc = await threads.load_thread(db, {"_id": ObjectId(id)})
     if not doc:
         raise HTTPException(status_code=404, detail="Message not found")
+    # Email bodies not yet fetched by the background hydration
+    await ensure_hydrated(db, doc)
 
     # Convert ObjectIds → strings
     doc["_id"] = str(doc["_id"])
@@ -217,14 +241,87 @@ async def get_message(id: str, db: AsyncIOMotorDatabase = Depends(get_database))
     if "assigned_member_id" in doc and doc["assigned_member_id"]:
         doc["assigned_member_id"] = str(doc["assigned_member_id"])
 
-    # Properly await comment serialization
-    comments = []
-    for c in doc.get("comments", []):
-        comments.append(await serialize_comment(c, db))
-    doc["comments"] = comments
+    # Resolve all comment authors at once
+    comments = doc.get("comments", [])
+    authors = await fetch_users(db, (c.get("user_id") for c in comments))
+    doc["comments"] = [await serialize_comment(c, db, authors) for c in comments]
 
     return doc
 
+async def _email_entry(db, id: str, gmail_id: str, current_user: dict) -> tuple:
+    """(thread, entry) for a Gmail message of a thread the user's company owns."""
+    if not ObjectId.is_valid(id):
+        raise HTTPException(status_code=400, detail="Invalid message ID")
+    doc = await threads.load_thread(db, {"_id": ObjectId(id)})
+    if not doc:
+        raise HTTPException(status_code=404, detail="Message not found")
+    if not await get_membership(db, current_user["_id"], doc["company_id"]):
+        raise HTTPException(status_code=403, detail="User is not a member of this company")
+    entry = next((e for e in doc["messages"] if (e.get("metadata") or {}).get("gmail_id") == gmail_id), None)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Email not found in this thread")
+    return doc, entry
+
+
+@router.get("/{id}/emails/{gmail_id}/body")
+async def download_email_body(
+    id: str,
+    gmail_id: str,
+    db: AsyncIOMotorDatabase = Depends(get_database),
+    current_user: dict = Depends(get_current_user),
+):
+    """Full body of an email whose stored content was capped (metadata.body_file_id)."""
+    _, entry = await _email_entry(db, id, gmail_id, current_user)
+    file_id = entry["metadata"].get("body_file_id")
+    if not file_id:
+        raise HTTPException(status_code=404, detail="Email body is stored inline")
+    try:
+        grid_out = await files.open_download(db, ObjectId(file_id))
+    except NoFile:
+        raise HTTPException(status_code=404, detail="Email body file not found")
+    return StreamingResponse(
+        files.iter_chunks(grid_out),
+        media_type=(grid_out.metadata or {}).get("content_type", "text/html"),
+        headers={"Content-Length": str(grid_out.length)},
+    )
+
+
+@router.get("/{id}/emails/{gmail_id}/attachments/{attachment_id}")
+async def download_email_attachment(
+    id: str,
+    gmail_id: str,
+    attachment_id: str,
+    db: AsyncIOMotorDatabase = Depends(get_database),
+    current_user: dict = Depends(get_current_user),
+):
+    """
+    Fetch an attachment from Gmail on demand; attachment data is never stored.
+    The Gmail response is spooled (see GmailClient.call_spooled) and the
+    download decoded chunk by chunk as it is streamed out.
+    """
+    doc, entry = await _email_entry(db, id, gmail_id, current_user)
+    attachment = next(
+        (a for a in entry["metadata"].get("attachments", []) if a.get("attachment_id") == attachment_id), None
+    )
+    if attachment is None:
+        raise HTTPException(status_code=404, detail="Attachment not found")
+
+    account_id = entry["metadata"].get("gmail_account_id")
+    account = await db["gmail_accounts"].find_one(
+        {"_id": ObjectId(account_id)} if account_id else {"user_id": doc["user_id"]}
+    )
+    if not account:
+        raise HTTPException(status_code=404, detail="Gmail account not connected")
+    gmail = await gmail_client_for(db, account)
+    data = await gmail.attachments_get(gmail_id, attachment_id)
+
+    filename = attachment.get("filename") or "attachment"
+    return StreamingResponse(
+        iter_decoded(data.get("data", "")),
+        media_type=attachment.get("mime_type", "application/octet-stream"),
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}"},
+    )
+
 @router.put("/{id}", response_model=dict)
 async def update_message(id: str, payload: dict = Body(...), db: AsyncIOMotorDatabase = Depends(get_database)):
     db["messages"].find_one_and_update(
@@ -233,8 +330,11 @@ async def update_message(id: str, payload: dict = Body(...), db: AsyncIOMotorDat
     )
     return {"message": "Message updated"}
 
-async def serialize_comment(comment: dict, db) -> dict:
-    user = await db["users"].find_one({"_id": comment["user_id"]})
+async def serialize_comment(comment: dict, db, users: Optional[dict] = None) -> dict:
+    """`users` is a prefetched {ObjectId: user} map; the author is looked up when omitted."""
+    if users is None:
+        users = await fetch_users(db, [comment["user_id"]])
+    user = users.get(comment["user_id"])
     return {
         "id": str(comment["_id"]),
         "user_id": str(comment["user_id"]),  # raw user reference
@@ -431,9 +531,10 @@ async def analyze_email_message_as_list(
     if not message_id or not ObjectId.is_valid(message_id):
         raise HTTPException(status_code=400, detail="Invalid message ID")
 
-    doc = await db["messages"].find_one({"_id": ObjectId(message_id)})
+    doc = await threads.load_thread(db, {"_id": ObjectId(message_id)})
     if not doc:
         raise HTTPException(status_code=404, detail="Message not found")
+    await ensure_hydrated(db, doc)
 
     result = await analyze_emails_with_ai(doc)
     order_list = []
@@ -467,6 +568,8 @@ async def analyze_email_message(
         raise HTTPException(status_code=404, detail="Message not found")
 
     if not (order_info := message_doc.get('order_info')):
+        message_doc["messages"] = await threads.load_entries(db, message_doc)
+        await ensure_hydrated(db, message_doc)
         result = await analyze_emails_with_ai(message_doc)
         # result is now a single dict, not a list
         
@@ -484,16 +587,12 @@ async def analyze_email_message(
                 }
             )
     
-    order_id = str(order_info.get("order_id", ""))
-    order_name = order_id if order_id.startswith("#") else "#" + order_id
+    db_order = await find_company_order(db, message_doc.get("company_id"), order_info.get("order_id"))
 
-    db_order = await db["orders"].find_one({"name": order_name})
-    
     if db_order:
-        match = re.findall(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\b', message_doc.get('client'))
-        email = match[0]
+        _, email = parseaddr(message_doc.get('client') or "")
 
-        if (db_order.get("customer", {}).get("email", "") == email):
+        if db_order.get("customer_email") and db_order["customer_email"] == normalize_email(email):
             db_order["_id"] = str(db_order["_id"])
             db_order["user_id"] = str(db_order.get("user_id", ""))
             db_order["company_id"] = str(db_order.get("company_id", ""))
@@ -522,7 +621,7 @@ async def reply_to_message(
     if not ObjectId.is_valid(id):
         raise HTTPException(status_code=400, detail="Invalid message ID")
     
-    message = await db["messages"].find_one({"_id": ObjectId(id)})
+    message = await threads.load_thread(db, {"_id": ObjectId(id)})
     if not message:
         raise HTTPException(status_code=404, detail="Message not found")
     
@@ -567,14 +666,8 @@ async def reply_to_message(
     raw_message = base64.urlsafe_b64encode(mime_msg.as_bytes()).decode()
     
     # Send via Gmail API
-    service = get_gmail_service(user_creds)
-    sent = service.users().messages().send(
-        userId="me",
-        body={
-            'raw': raw_message,
-            'threadId': thread_id
-        }
-    ).execute()
+    gmail = await gmail_client_for(db, user_creds)
+    sent = await gmail.messages_send(raw_message, thread_id=thread_id)
 
     # Construct ChatEntry and save to DB
     now = datetime.now(timezone.utc).astimezone()
@@ -594,15 +687,11 @@ async def reply_to_message(
         }
     }
 
-    await db["messages"].update_one(
-        {"_id": ObjectId(id)},
-        {
-            "$push": {"messages": reply_entry},
-            "$set": {"last_updated": reply_entry["timestamp"]}
-        }
+    await threads.append_entry(
+        db, ObjectId(id), reply_entry, set_fields={"last_updated": reply_entry["timestamp"]}
     )
 
-    updated_message = await db["messages"].find_one({"_id": ObjectId(id)})
+    updated_message = await threads.load_thread(db, {"_id": ObjectId(id)})
 
     if '_id' in updated_message:
         updated_message['_id'] = str(updated_message['_id'])
@@ -3,19 +3,22 @@ from fastapi.responses import RedirectResponse, JSONResponse
 from urllib.parse import urlencode
 import hmac, hashlib, requests, base64
 import os
-from typing import List, Dict
+from typing import List, Dict, Optional
 from datetime import datetime
 import json
+import re
 from bson import ObjectId
 from app.services.shopify_service import (
     get_all_shopify_creds,
     fetch_orders_from_shop,
     upsert_orders,
+    backfill_shop_orders,
 )
+from app.services.order_service import normalize_email, write_orders
 
-from math import ceil
 from app.db.mongodb import get_database
-from app.core.security import get_current_user
+from app.utils.pagination import approximate_count, keyset_filter, keyset_sort, next_cursor
+from app.core.security import get_current_user, get_membership
 import httpx
 
 router = APIRouter()
@@ -347,67 +350,8 @@ async def shopify_orders_create_webhook(
         print(f"[✓] x_shopify_shop_domain: {x_shopify_shop_domain}")
 
         db = await get_database()
-        user_id, company_id = None, None
-
-        cred = await db.shopify_cred.find_one({"shop": x_shopify_shop_domain})
-        if not cred:
-            print(f"[!] Shopify credentials not found for shop: {x_shopify_shop_domain}")
-            user_id = None
-            company_id = None
-        else:
-            user_id = cred.get("user_id")
-            company_id = cred.get("company_id")
-
-        order_document = {
-            "shop": x_shopify_shop_domain,
-            "order_id": data["id"],
-            "user_id": ObjectId(user_id),
-            "company_id": ObjectId(company_id),
-            "order_number": data.get("order_number"),
-            "name": data.get("name"),
-            "created_at": data.get("created_at"),
-            "customer": {
-                "id": data.get("customer", {}).get("id"),
-                "email": data.get("customer", {}).get("email"),
-                "name": f"{data.get('customer', {}).get('first_name', '')} {data.get('customer', {}).get('last_name', '')}".strip(),
-                "phone": data.get("customer", {}).get("phone"),
-                "default_address": {
-                    "address1": data.get("customer", {}).get("default_address", {}).get("address1"),
-                    "address2": data.get("customer", {}).get("default_address", {}).get("address2"),
-                    "city": data.get("customer", {}).get("default_address", {}).get("city"),
-                    "province": data.get("customer", {}).get("default_address", {}).get("province"),
-                    "country": data.get("customer", {}).get("default_address", {}).get("country"),
-                    "zip": data.get("customer", {}).get("default_address", {}).get("zip"),
-                }
-            },
-            "shipping_address": data.get("shipping_address", {}),
-            "billing_address": data.get("billing_address", {}),
-            "line_items": [
-                {   
-                    "id": item.get("id"),
-                    "product_id": item.get("product_id"),
-                    "name": item.get("name"),
-                    "quantity": item.get("quantity"),
-                    "price": item.get("price")
-                } for item in data.get("line_items", [])
-            ],
-            "total_price": data.get("total_price"),
-            "total_shipping_price": (
-                    data.get("total_shipping_price_set", {})
-                        .get("shop_money", {})
-                        .get("amount", 0)
-                    ),
-            "payment_status": data.get("financial_status"),
-            "fulfillment_status": data.get("fulfillment_status"),
-            "updated_at": data.get("updated_at")
-        }
-
-        
-        # async Motor: must await db operations
-        print(f"[✓] Inserting/updating order: {order_document['order_id']} in shop: {order_document['shop']}")
-        if not await db.orders.find_one({"order_id": order_document["order_id"]}):
-            print(f"[✓] Order {order_document['order_id']} not found, inserting new document.")
-            await db.orders.insert_one(order_document)
+        print(f"[✓] Inserting/updating order: {data.get('id')} in shop: {x_shopify_shop_domain}")
+        await write_orders(db, x_shopify_shop_domain, [data])
 
         return {"success": True}
     except Exception as e:
@@ -423,41 +367,61 @@ async def get_orders(
     page: int = Query(1, ge=1, description="Page number"),
     size: int = Query(10, ge=1, le=100, description="Page size"),
     company_id: str = Query("", description="Company ID"),
-    email: str = Query("", description="Email")
+    email: str = Query("", description="Email"),
+    cursor: Optional[str] = Query(None, description="Opaque cursor from a previous page's next_cursor; overrides page"),
+    include_count: Optional[bool] = Query(None, description="Return totals (default: on for page mode, off for cursor mode)")
 ):
     db = request.app.state.db
 
     # Build filter query
     filter_query = {}
-    if search:
+    if search.strip():
+        # Anchored, escaped prefixes so both branches are index range scans
+        term = search.strip()
+        name_prefix = term.upper() if term.startswith("#") else "#" + term.upper()
         filter_query["$or"] = [
-            {"name": {"$regex": search, "$options": "i"}},
-            {"customer.email": {"$regex": search, "$options": "i"}}
+            {"name": {"$regex": f"^{re.escape(name_prefix)}"}},
+            {"customer_email": {"$regex": f"^{re.escape(term.lower())}"}}
         ]
     if shop:
         filter_query["shop"] = shop
     if company_id:
         filter_query["company_id"] = ObjectId(company_id)
     if email:
-        filter_query["customer.email"] = email
+        filter_query["customer_email"] = normalize_email(email)
+
+    # Totals are optional and capped (see app.utils.pagination.COUNT_LIMIT)
+    if include_count is None:
+        include_count = cursor is None
+    totals = await approximate_count(db.orders, filter_query, size) if include_count else None
+
+    # Fetch orders sorted by (created_at, _id) descending; keyset when a cursor is given
+    find_query = filter_query
+    skip = 0
+    if cursor:
+        find_query = {"$and": [filter_query, keyset_filter("created_at", cursor)]}
+    else:
+        skip = (page - 1) * size
 
-    # Count total documents for pagination
-    total_count = await db.orders.count_documents(filter_query)
-    totalPages = ceil(total_count / size)
+    docs = await db.orders.find(find_query).sort(keyset_sort("created_at")).skip(skip).limit(size).to_list(length=size)
+    next_page_cursor = next_cursor(docs, size, "created_at")
 
-    # Fetch paginated orders sorted by created_at descending
-    cursor = db.orders.find(filter_query).sort("created_at", -1).skip((page - 1) * size).limit(size)
     orders = []
-    async for doc in cursor:
+    for doc in docs:
         doc['_id'] = str(doc['_id'])
         doc['user_id'] = str(doc['user_id'])
         doc['company_id'] = str(doc['company_id'])
         orders.append(doc)
 
-    return {
+    response = {
         "orders": orders,
-        "totalPages": totalPages
+        "next_cursor": next_page_cursor,
     }
+    if totals:
+        response["totalPages"] = totals["totalPages"]
+        response["total"] = totals["total"]
+        response["total_is_approximate"] = totals["approximate"]
+    return response
 
 # Endpoint: Sync orders from all stores
 @router.post("/orders/sync")
@@ -465,6 +429,39 @@ def sync_orders(background_tasks: BackgroundTasks):
     background_tasks.add_task(sync_all_stores_orders)
     return {"msg": "Sync started."}
 
+# Endpoint: Backfill the full order history of one store
+@router.post("/orders/backfill")
+async def backfill_orders(
+    background_tasks: BackgroundTasks,
+    payload: dict = Body(...),
+    current_user: dict = Depends(get_current_user),
+):
+    db = await get_database()
+    company_id = payload.get("company_id", "")
+    shop = payload.get("shop", "")
+    if not ObjectId.is_valid(company_id) or not shop:
+        raise HTTPException(status_code=400, detail="company_id and shop are required")
+
+    membership = await get_membership(db, current_user["_id"], company_id)
+    if not membership:
+        raise HTTPException(status_code=403, detail="User is not a member of this company")
+    cred = await db.shopify_cred.find_one({"shop": shop, "company_id": ObjectId(company_id)})
+    if not cred or not cred.get("access_token"):
+        raise HTTPException(status_code=404, detail="Store not found for this company")
+    # Company owners may backfill any of the company's stores, others only their own
+    if membership.get("role") != "company_owner" and cred.get("user_id") != current_user["_id"]:
+        raise HTTPException(status_code=403, detail="Not allowed to backfill this store")
+
+    background_tasks.add_task(backfill_store_orders, shop, cred["access_token"])
+    return {"msg": "Backfill started."}
+
+async def backfill_store_orders(shop: str, access_token: str):
+    db = await get_database()
+    try:
+        await backfill_shop_orders(db, shop, access_token)
+    except Exception as e:
+        print(f"Error backfilling {shop}: {e}")
+
 # Background job: fetch and upsert all orders for all stores
 async def sync_all_stores_orders():
     db = await get_database()
@@ -5,6 +5,8 @@ from twilio.rest import Client
 from datetime import datetime
 from bson import ObjectId
 from app.models.message import Message, ChatEntry  # assuming these are in models.py
+from app.db import threads
+from app.services.ticket_service import next_ticket_number
 import os
 
 router = APIRouter()
@@ -45,24 +47,23 @@ async def send_sms(data: SMSRequest, request: Request):
         
         db = request.app.state.db
         # Upsert Message document (either new or existing thread)
+        existing = None
         if data.thread_id:
-            result = await db.messages.update_one(
-                {"thread_id": data.thread_id},
-                {
-                    "$push": {"messages": chat_entry.dict()},
-                    "$set": {"last_updated": datetime.utcnow()}
-                },
-                upsert=True
+            existing = await db.messages.find_one({"thread_id": data.thread_id}, {"_id": 1})
+
+        if existing:
+            await threads.append_entry(
+                db, existing["_id"], chat_entry.dict(), set_fields={"last_updated": datetime.utcnow()}
             )
         else:
             new_message = Message(
-                thread_id=str(ObjectId()),  # or generate based on business logic
+                thread_id=data.thread_id or str(ObjectId()),  # or generate based on business logic
                 participants=[TWILIO_PHONE, data.to],
                 client_id=data.to,
                 channel="sms",
-                messages=[chat_entry]
+                ticket=await next_ticket_number(db, None),
             )
-            result = await db.messages.insert_one(new_message.dict(by_alias=True))
+            await threads.create_thread(db, new_message.dict(by_alias=True), chat_entry.dict())
 
         return {
             "sid": message.sid,
@@ -7,6 +7,7 @@ from datetime import datetime
 from bson import ObjectId
 from app.utils.bson import PyObjectId  # helper to handle ObjectId correctly
 from passlib.context import CryptContext
+from app.core.security import invalidate_membership, invalidate_user
 
 router = APIRouter()
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -77,6 +78,7 @@ async def update_user(user_id: str, user: UserCreate, db: Collection = Depends(g
         update_data["hashed_password"] = pwd_context.hash(user.password)
 
     await db["users"].update_one({"_id": oid}, {"$set": update_data})
+    invalidate_user(oid)
     updated_user = await db["users"].find_one({"_id": oid})
     updated_user["_id"] = str(updated_user["_id"])
     return updated_user
@@ -97,4 +99,6 @@ async def delete_user(user_id: str, db: Collection = Depends(get_database)):
         raise HTTPException(status_code=404, detail="User not found")
 
     await db["users"].delete_one({"_id": oid})
+    invalidate_user(oid)
+    invalidate_membership(oid)
     return {"message": "User deleted"}
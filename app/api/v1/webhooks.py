@@ -7,9 +7,10 @@ from bson import ObjectId
 
 router = APIRouter()
 
-from motor.motor_asyncio import AsyncIOMotorClient
 import os
 from app.models.message import Message, ChatEntry
+from app.db import threads
+from app.services.ticket_service import next_ticket_number
 
 
 @router.post("/twilio/sms")
@@ -26,7 +27,7 @@ async def twilio_sms_webhook(
 
     # Try to find the existing thread
     db = request.app.state.db
-    doc = await db.messages.find_one({"thread_id": thread_id, "channel": "sms"})
+    doc = await db.messages.find_one({"thread_id": thread_id, "channel": "sms"}, {"_id": 1})
     now = datetime.utcnow()
 
     chat_entry = ChatEntry(
@@ -48,13 +49,7 @@ async def twilio_sms_webhook(
 
     if doc:
         # Update thread: add new entry, update last_updated
-        await db.messages.update_one(
-            {"_id": doc["_id"]},
-            {
-                "$push": {"messages": chat_entry.dict()},
-                "$set": {"last_updated": now}
-            }
-        )
+        await threads.append_entry(db, doc["_id"], chat_entry.dict(), set_fields={"last_updated": now})
     else:
         # New thread
         msg_obj = Message(
@@ -62,12 +57,12 @@ async def twilio_sms_webhook(
             participants=[From, To],
             client_id=From,
             channel="sms",
+            ticket=await next_ticket_number(db, None),
             status="open",
             started_at=now,
             last_updated=now,
-            messages=[chat_entry],
         )
-        await db.messages.insert_one(msg_obj.dict(by_alias=True))
+        await threads.create_thread(db, msg_obj.dict(by_alias=True), chat_entry.dict())
 
     resp = MessagingResponse()
     resp.message("We've got your message!, we'll get back to you soon.")
@@ -1,7 +1,9 @@
 from passlib.context import CryptContext
 from datetime import datetime, timedelta
+from typing import Any, Optional
 from jose import JWTError, jwt
 import os
+from cachetools import TTLCache
 from fastapi import Depends, HTTPException, Request, status
 from bson import ObjectId
 from fastapi.security import OAuth2PasswordBearer
@@ -11,6 +13,14 @@ SECRET_KEY = os.getenv("SECRET_KEY", "supersecret")
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 30))
 
+# Authenticated principals and their company memberships, per process. Writes
+# that change them call the invalidate_* hooks below; the TTL bounds how long
+# another worker process can serve a stale entry.
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", 10000))
+PRINCIPAL_CACHE_TTL = int(os.getenv("PRINCIPAL_CACHE_TTL", 60))
+_user_cache: TTLCache = TTLCache(maxsize=PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_CACHE_TTL)
+_membership_cache: TTLCache = TTLCache(maxsize=PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_CACHE_TTL)
+
 # OAuth2 token scheme
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/v1/auth/login")
 
@@ -45,8 +55,44 @@ async def get_current_user(request: Request, token: str = Depends(oauth2_scheme)
     except JWTError:
         raise credentials_exception
 
-    user = await db.users.find_one({"_id": ObjectId(user_id)})
-    if user is None:
+    if not ObjectId.is_valid(str(user_id)):
         raise credentials_exception
+    oid = ObjectId(str(user_id))
+
+    user = _user_cache.get(oid)
+    if user is None:
+        user = await db.users.find_one({"_id": oid})
+        if user is None:
+            raise credentials_exception
+        _user_cache[oid] = user
+
+    # Routes may add keys to current_user; never let that leak into the cache.
+    return dict(user)
+
+
+async def get_membership(db, user_id: Any, company_id: Any) -> Optional[dict]:
+    """The user's membership in a company (cached), or None if not a member."""
+    key = (ObjectId(str(user_id)), ObjectId(str(company_id)))
+    membership = _membership_cache.get(key)
+    if membership is None:
+        membership = await db["memberships"].find_one({"user_id": key[0], "company_id": key[1]})
+        if membership is None:
+            # Not cached: a membership created right after must be seen at once.
+            return None
+        _membership_cache[key] = membership
+    return dict(membership)
+
+
+def invalidate_user(user_id: Any):
+    """Call after updating, suspending or deleting a user."""
+    _user_cache.pop(ObjectId(str(user_id)), None)
+
 
-    return user
+def invalidate_membership(user_id: Any, company_id: Any = None):
+    """Call after changing or deleting a membership; without company_id, all of the user's."""
+    uid = ObjectId(str(user_id))
+    if company_id is not None:
+        _membership_cache.pop((uid, ObjectId(str(company_id))), None)
+        return
+    for key in [k for k in list(_membership_cache.keys()) if k[0] == uid]:
+        _membership_cache.pop(key, None)
@@ -0,0 +1,48 @@
+# app/db/files.py
+"""
+GridFS storage for blobs too large to embed in a document (e.g. oversized
+email bodies). Files are written and read in GridFS chunks, so neither side
+holds a whole file in memory.
+"""
+from typing import Any, AsyncIterator, Dict, Iterable, Optional
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+
+MAIL_BODIES_BUCKET = "mail_bodies"
+
+
+def get_bucket(db, bucket_name: str = MAIL_BODIES_BUCKET) -> AsyncIOMotorGridFSBucket:
+    return AsyncIOMotorGridFSBucket(db, bucket_name=bucket_name)
+
+
+async def upload_chunks(
+    db,
+    filename: str,
+    chunks: Iterable[bytes],
+    metadata: Optional[Dict[str, Any]] = None,
+    bucket_name: str = MAIL_BODIES_BUCKET,
+) -> ObjectId:
+    """Stream `chunks` into a new GridFS file and return its id."""
+    grid_in = get_bucket(db, bucket_name).open_upload_stream(filename, metadata=metadata or {})
+    try:
+        for chunk in chunks:
+            await grid_in.write(chunk)
+    except BaseException:
+        await grid_in.abort()
+        raise
+    await grid_in.close()
+    return grid_in._id
+
+
+async def open_download(db, file_id: ObjectId, bucket_name: str = MAIL_BODIES_BUCKET):
+    """GridOut for `file_id`; raises gridfs.errors.NoFile if it does not exist."""
+    return await get_bucket(db, bucket_name).open_download_stream(file_id)
+
+
+async def iter_chunks(grid_out) -> AsyncIterator[bytes]:
+    while True:
+        chunk = await grid_out.readchunk()
+        if not chunk:
+            break
+        yield chunk
@@ -0,0 +1,338 @@
+# app/db/indexes.py
+"""
+Declarative index registry.
+
+Every index the query paths rely on is declared here, per collection. Bump
+INDEX_VERSION whenever the registry changes so that the next startup (or
+`python -m app.db.migrations indexes`) re-applies it. create_indexes is idempotent,
+so re-applying an unchanged spec is a no-op on the server.
+"""
+from datetime import datetime
+from typing import Dict, List, Set, Tuple
+
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+from pymongo.errors import OperationFailure
+
+from app.utils.logger import logger
+
+INDEX_VERSION = 11
+
+META_COLLECTION = "schema_meta"
+META_ID = "indexes"
+# Applied data migrations, see app.db.migrations
+MIGRATIONS_COLLECTION = "schema_migrations"
+
+INDEXES: Dict[str, List[IndexModel]] = {
+    "messages": [
+        # get_company_messages: company inbox, keyset-paginated on (last_updated, _id)
+        IndexModel(
+            [("company_id", ASCENDING), ("last_updated", DESCENDING), ("_id", DESCENDING)],
+            name="company_last_updated_id",
+        ),
+        # store_owner view of the company inbox
+        IndexModel(
+            [("company_id", ASCENDING), ("user_id", ASCENDING), ("last_updated", DESCENDING), ("_id", DESCENDING)],
+            name="company_user_last_updated_id",
+        ),
+        # agent view: only threads that are assigned to someone
+        IndexModel(
+            [
+                ("company_id", ASCENDING),
+                ("assigned_member_id", ASCENDING),
+                ("last_updated", DESCENDING),
+                ("_id", DESCENDING),
+            ],
+            name="company_assignee_last_updated_id",
+            partialFilterExpression={"assigned_member_id": {"$exists": True}},
+        ),
+        # get_messages
+        IndexModel([("user_id", ASCENDING), ("last_updated", DESCENDING)], name="user_last_updated"),
+        # Gmail ingestion: one thread per (mailbox user, Gmail thread). Unique so
+        # concurrent upserts for the same new thread cannot create two headers.
+        IndexModel(
+            [("user_id", ASCENDING), ("thread_id", ASCENDING), ("channel", ASCENDING)],
+            name="user_thread_email",
+            unique=True,
+            partialFilterExpression={"channel": "email"},
+        ),
+        # Twilio SMS thread lookup
+        IndexModel([("thread_id", ASCENDING), ("channel", ASCENDING)], name="thread_channel"),
+        # Inbox search: token/prefix lookups inside one tenant
+        IndexModel([("company_id", ASCENDING), ("search_tokens", ASCENDING)], name="company_search_tokens"),
+        # Inbox search: relevance-ranked, tenant-prefixed text index
+        IndexModel(
+            [("company_id", ASCENDING), ("title", TEXT), ("client", TEXT), ("search_text", TEXT)],
+            name="thread_text",
+            weights={"title": 10, "client": 5, "search_text": 1},
+            default_language="none",
+        ),
+    ],
+    "message_entries": [
+        # open bucket lookup on append
+        IndexModel([("thread_id", ASCENDING), ("count", ASCENDING)], name="thread_count"),
+        # ordered read of a thread's buckets
+        IndexModel(
+            [("thread_id", ASCENDING), ("first_ts", ASCENDING), ("seq", ASCENDING)],
+            name="thread_first_ts",
+        ),
+        # provider message ids (e.g. gmail_id) stored once per thread
+        IndexModel(
+            [("thread_id", ASCENDING), ("keys", ASCENDING)],
+            name="thread_keys",
+            unique=True,
+            partialFilterExpression={"keys": {"$exists": True}},
+        ),
+    ],
+    "counters": [
+        # per-day ticket counters expire once the day is over
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "orders": [
+        IndexModel([("name", ASCENDING)], name="name"),
+        IndexModel([("order_id", ASCENDING), ("shop", ASCENDING)], name="order_shop", unique=True),
+        # /shopify/orders, keyset-paginated on (created_at, _id)
+        IndexModel(
+            [("company_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)],
+            name="company_created_at_id",
+        ),
+        IndexModel(
+            [("shop", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)],
+            name="shop_created_at_id",
+        ),
+        IndexModel([("created_at", DESCENDING), ("_id", DESCENDING)], name="created_at_id"),
+        # /message/analyze order matching, always inside one tenant
+        IndexModel([("company_id", ASCENDING), ("name_key", ASCENDING)], name="company_name_key"),
+        # orders by customer (analyze, /shopify/orders?email=, search prefix)
+        IndexModel([("company_id", ASCENDING), ("customer_email", ASCENDING)], name="company_customer_email"),
+        IndexModel([("customer_email", ASCENDING)], name="customer_email_normalized"),
+    ],
+    "gmail_accounts": [
+        IndexModel([("email", ASCENDING)], name="email"),
+        IndexModel([("user_id", ASCENDING)], name="user_id"),
+        IndexModel([("company_id", ASCENDING)], name="company_id"),
+        # watch scheduler: accounts whose watch lapses soon
+        IndexModel([("watch_expiration", ASCENDING)], name="watch_expiration"),
+    ],
+    "gmail_notifications": [
+        # queue claim: due pending items, oldest first
+        IndexModel([("status", ASCENDING), ("available_at", ASCENDING)], name="status_available_at"),
+        # reclaim of items whose worker lease expired
+        IndexModel(
+            [("status", ASCENDING), ("lease_until", ASCENDING)],
+            name="status_lease_until",
+            partialFilterExpression={"status": "processing"},
+        ),
+        # queue lag: oldest waiting item
+        IndexModel([("status", ASCENDING), ("created_at", ASCENDING)], name="status_created_at"),
+        # at most one pending item per account: notifications coalesce into it
+        IndexModel(
+            [("email", ASCENDING)],
+            name="email_pending",
+            unique=True,
+            partialFilterExpression={"status": "pending"},
+        ),
+        # processed notifications are kept for a day
+        IndexModel([("done_at", ASCENDING)], name="done_at_ttl", expireAfterSeconds=86400),
+    ],
+    "gmail_backfills": [
+        # backfill scheduler: queued jobs, oldest first
+        IndexModel([("status", ASCENDING), ("available_at", ASCENDING)], name="status_available_at"),
+        # resume of jobs whose process died
+        IndexModel(
+            [("status", ASCENDING), ("lease_until", ASCENDING)],
+            name="status_lease_until",
+            partialFilterExpression={"status": "running"},
+        ),
+    ],
+    "memberships": [
+        IndexModel([("user_id", ASCENDING), ("company_id", ASCENDING)], name="user_company"),
+        IndexModel(
+            [("user_id", ASCENDING), ("status", ASCENDING), ("last_used_at", DESCENDING)],
+            name="user_status_last_used",
+        ),
+        IndexModel(
+            [("company_id", ASCENDING), ("status", ASCENDING), ("role", ASCENDING)],
+            name="company_status_role",
+        ),
+    ],
+    "invitations": [
+        IndexModel([("email", ASCENDING), ("company_id", ASCENDING)], name="email_company"),
+        IndexModel([("token", ASCENDING)], name="token"),
+        IndexModel([("company_id", ASCENDING), ("status", ASCENDING)], name="company_status"),
+    ],
+    "users": [
+        IndexModel([("email", ASCENDING)], name="email", unique=True),
+    ],
+    "shopify_cred": [
+        IndexModel([("shop", ASCENDING)], name="shop"),
+        IndexModel([("user_id", ASCENDING)], name="user_id"),
+        IndexModel([("company_id", ASCENDING)], name="company_id"),
+    ],
+}
+
+
+# Indexes from earlier registry versions, dropped when the registry is applied.
+OBSOLETE_INDEXES: Dict[str, List[str]] = {
+    "messages": [
+        "company_last_updated",
+        "company_user_last_updated",
+        "company_assignee_last_updated",
+        "company_started_at",
+        "user_thread_channel",
+    ],
+    "orders": ["company_created_at", "shop_created_at", "customer_email"],
+    "gmail_notifications": ["message_id"],
+}
+
+# Obsolete indexes that stay until the index replacing them has been built.
+REPLACED_BY: Dict[str, Dict[str, str]] = {
+    "messages": {"user_thread_channel": "user_thread_email"},
+}
+
+
+# Migrations an index depends on, run by `python -m app.db.migrations indexes`
+# while the index is missing. App startup never runs them: it skips the index
+# until the migration has been recorded.
+PREREQUISITES: Dict[str, Dict[str, str]] = {
+    "messages": {"user_thread_email": "0004_merge_duplicate_email_threads"},
+    # /shopify/orders and /message/analyze only match on the derived keys
+    "orders": {
+        "company_name_key": "0005_backfill_order_keys",
+        "company_customer_email": "0005_backfill_order_keys",
+    },
+}
+
+
+async def _index_names(db, collection: str) -> Set[str]:
+    return {index["name"] async for index in db[collection].list_indexes()}
+
+
+async def _create_indexes(db, collection: str, models: List[IndexModel]) -> Tuple[List[str], List[str]]:
+    """
+    Create a collection's indexes; returns (created, failed) names. A batch that
+    fails is retried index by index so one bad index does not hold back the rest.
+    """
+    try:
+        return await db[collection].create_indexes(models), []
+    except OperationFailure as e:
+        logger.error("Failed creating indexes on %s: %s", collection, e)
+
+    created, failed = [], []
+    for model in models:
+        name = model.document["name"]
+        try:
+            created += await db[collection].create_indexes([model])
+        except OperationFailure as e:
+            # Usually a unique index over existing duplicates
+            failed.append(name)
+            logger.error("Failed creating index %s.%s: %s", collection, name, e)
+    return created, failed
+
+
+async def _pending_prerequisites(db, collection: str) -> Dict[str, str]:
+    """Missing indexes of a collection whose migration has not been applied."""
+    needs = PREREQUISITES.get(collection, {})
+    if not needs:
+        return {}
+    present = await _index_names(db, collection)
+    applied = {
+        doc["_id"]
+        async for doc in db[MIGRATIONS_COLLECTION].find({"_id": {"$in": list(needs.values())}}, {"_id": 1})
+    }
+    return {
+        name: migration
+        for name, migration in needs.items()
+        if name not in present and migration not in applied
+    }
+
+
+async def apply_indexes(db, force: bool = False, run_prerequisites: bool = False) -> Dict[str, List[str]]:
+    """
+    Create every registered index. Skipped when the stored registry version is
+    already current, unless `force` is set. Returns the created index names
+    per collection; failures are logged and left for `index_report` to show.
+
+    An index whose prerequisite migration has not been applied is skipped (and
+    the version left unrecorded) unless `run_prerequisites` is set, which only
+    the migrations CLI does. Obsolete indexes are only dropped from collections
+    whose indexes were all built, and never before the index that replaces
+    them exists.
+    """
+    meta = await db[META_COLLECTION].find_one({"_id": META_ID})
+    if not force and meta and meta.get("version", 0) >= INDEX_VERSION:
+        logger.info("Indexes up to date (version %s)", INDEX_VERSION)
+        return {}
+
+    created: Dict[str, List[str]] = {}
+    failed: Dict[str, List[str]] = {}
+    for collection, models in INDEXES.items():
+        pending = await _pending_prerequisites(db, collection)
+        if pending and run_prerequisites:
+            # Imported here: the migrations module imports this one
+            from app.db.migrations import run_migrations
+            await run_migrations(db, sorted(set(pending.values())))
+        elif pending:
+            for name, migration in pending.items():
+                logger.warning(
+                    "Skipping index %s.%s until migration %s is applied "
+                    "(python -m app.db.migrations indexes)", collection, name, migration,
+                )
+            models = [m for m in models if m.document["name"] not in pending]
+            failed[collection] = list(pending)
+        created[collection], errors = await _create_indexes(db, collection, models)
+        if errors:
+            failed.setdefault(collection, []).extend(errors)
+
+    for collection, names in OBSOLETE_INDEXES.items():
+        if collection in failed:
+            logger.warning("Keeping obsolete indexes on %s until its indexes build", collection)
+            continue
+        present = await _index_names(db, collection)
+        for name in names:
+            replacement = REPLACED_BY.get(collection, {}).get(name)
+            if name in present and (replacement is None or replacement in present):
+                await db[collection].drop_index(name)
+                logger.info("Dropped obsolete index %s.%s", collection, name)
+
+    if not failed:
+        await db[META_COLLECTION].update_one(
+            {"_id": META_ID},
+            {"$set": {"version": INDEX_VERSION, "applied_at": datetime.utcnow()}},
+            upsert=True,
+        )
+    logger.info("Applied index registry version %s", INDEX_VERSION)
+    return created
+
+
+async def index_report(db) -> Dict[str, Dict[str, List[str]]]:
+    """
+    Compare the registry with the server, per collection:
+      missing: registered but not present
+      extra:   present but not registered (excluding _id_)
+      unused:  present with zero recorded accesses since the last server restart
+    """
+    report: Dict[str, Dict[str, List[str]]] = {}
+    existing_collections = set(await db.list_collection_names())
+
+    for collection, models in INDEXES.items():
+        expected = {m.document["name"] for m in models}
+        if collection not in existing_collections:
+            report[collection] = {"missing": sorted(expected), "extra": [], "unused": []}
+            continue
+
+        present = set()
+        async for index in db[collection].list_indexes():
+            present.add(index["name"])
+        present.discard("_id_")
+
+        unused = []
+        async for stat in db[collection].aggregate([{"$indexStats": {}}]):
+            if stat["name"] != "_id_" and stat.get("accesses", {}).get("ops", 0) == 0:
+                unused.append(stat["name"])
+
+        report[collection] = {
+            "missing": sorted(expected - present),
+            "extra": sorted(present - expected),
+            "unused": sorted(unused),
+        }
+    return report
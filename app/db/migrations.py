@@ -0,0 +1,109 @@
+# app/db/migrations.py
+"""
+Schema/data migration manager.
+
+Usage:
+    python -m app.db.migrations indexes [--force]   # apply the index registry
+    python -m app.db.migrations report              # missing / extra / unused indexes
+    python -m app.db.migrations status              # applied and pending migrations
+    python -m app.db.migrations migrate [name ...]  # run pending (or named) migrations
+
+Data migrations are never run from the app lifespan; only the index registry
+is. An index that depends on a migration (see indexes.PREREQUISITES) is skipped
+at startup until that migration is recorded: the `indexes` command runs it
+first, e.g. merge_duplicate_email_threads before the unique `user_thread_email`
+and backfill_order_keys before the order key indexes. Run it once per deploy
+that adds such an index.
+Each migration is an async callable taking the database and returning a
+JSON-serialisable summary. Applied migrations are recorded in `schema_migrations`.
+"""
+import argparse
+import asyncio
+import json
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from app.db.indexes import MIGRATIONS_COLLECTION, apply_indexes, index_report
+from app.db.threads import (
+    backfill_search_fields,
+    backfill_thread_previews,
+    bucket_thread_entries,
+    cap_search_tokens,
+    merge_duplicate_email_threads,
+)
+from app.services.order_service import backfill_order_keys
+from app.utils.logger import logger
+
+# Ordered (name, migration) pairs. Append only; never rename an applied entry.
+MIGRATIONS: List[Tuple[str, Callable[..., Awaitable[dict]]]] = [
+    ("0001_bucket_thread_entries", bucket_thread_entries),
+    ("0002_backfill_thread_previews", backfill_thread_previews),
+    ("0003_backfill_search_fields", backfill_search_fields),
+    ("0004_merge_duplicate_email_threads", merge_duplicate_email_threads),
+    ("0005_backfill_order_keys", backfill_order_keys),
+    ("0006_cap_search_tokens", cap_search_tokens),
+]
+
+
+async def migration_status(db) -> Dict[str, Optional[datetime]]:
+    applied = {
+        doc["_id"]: doc.get("applied_at")
+        async for doc in db[MIGRATIONS_COLLECTION].find({})
+    }
+    return {name: applied.get(name) for name, _ in MIGRATIONS}
+
+
+async def run_migrations(db, names: Optional[List[str]] = None) -> Dict[str, dict]:
+    """Run the named migrations, or every pending one in registry order."""
+    registry = dict(MIGRATIONS)
+    if names:
+        unknown = [n for n in names if n not in registry]
+        if unknown:
+            raise ValueError(f"Unknown migrations: {', '.join(unknown)}")
+        todo = names
+    else:
+        status = await migration_status(db)
+        todo = [name for name, applied_at in status.items() if applied_at is None]
+
+    results = {}
+    for name in todo:
+        logger.info("Running migration %s", name)
+        summary = await registry[name](db)
+        await db[MIGRATIONS_COLLECTION].update_one(
+            {"_id": name},
+            {"$set": {"applied_at": datetime.utcnow(), "summary": summary}},
+            upsert=True,
+        )
+        results[name] = summary
+    return results
+
+
+async def _main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog="python -m app.db.migrations")
+    sub = parser.add_subparsers(dest="command", required=True)
+    indexes_cmd = sub.add_parser("indexes", help="apply the index registry")
+    indexes_cmd.add_argument("--force", action="store_true", help="re-apply even if the version is current")
+    sub.add_parser("report", help="report missing, extra and unused indexes")
+    sub.add_parser("status", help="list applied and pending migrations")
+    migrate_cmd = sub.add_parser("migrate", help="run pending or named migrations")
+    migrate_cmd.add_argument("names", nargs="*")
+    args = parser.parse_args(argv)
+
+    from app.db.mongodb import close_database, get_database
+    db = await get_database()
+
+    if args.command == "indexes":
+        result = await apply_indexes(db, force=args.force, run_prerequisites=True)
+    elif args.command == "report":
+        result = await index_report(db)
+    elif args.command == "status":
+        result = await migration_status(db)
+    else:
+        result = await run_migrations(db, args.names or None)
+
+    print(json.dumps(result, indent=2, default=str))
+    close_database()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
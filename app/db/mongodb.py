@@ -1,11 +1,154 @@
-from motor.motor_asyncio import AsyncIOMotorClient
+# app/db/mongodb.py
+"""
+The process-wide MongoDB client.
+
+Every route, service, background task and CLI shares the one client created
+here (FastAPI routes may also reach it as `request.app.state.db`, which the
+lifespan points at the same database). Pool sizing and wire compression come
+from the environment; `pool_metrics` records how long requests wait to check
+out a connection, which is the signal that the pool is too small.
+"""
 import os
+import threading
+from collections import deque
+from typing import Any, Dict, Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from pymongo import monitoring
 
 MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017")
 DB_NAME = os.getenv("DB_NAME", "attentify")
 
-client = AsyncIOMotorClient(MONGO_URL)
-db = client[DB_NAME]
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "5"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "300000"))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "10000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+# Negotiated with the server in order; zlib ships with Python, zstd needs `zstandard`.
+MONGO_COMPRESSORS = os.getenv("MONGO_COMPRESSORS", "zstd,zlib")
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Connection checkout wait times and pool gauges, shared by all pools of the client."""
+
+    def __init__(self, samples: int = 1000):
+        self._lock = threading.Lock()
+        self._waits = deque(maxlen=samples)
+        self.checkouts = 0
+        self.checkout_failures: Dict[str, int] = {}
+        self.checked_out = 0
+        self.open_connections = 0
+        self.pool_clears = 0
+        self.max_wait_ms = 0.0
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_checked_out(self, event):
+        wait_ms = event.duration * 1000
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self._waits.append(wait_ms)
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures[event.reason] = self.checkout_failures.get(event.reason, 0) + 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self.open_connections += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open_connections -= 1
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.pool_clears += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            waits = sorted(self._waits)
+            checkouts, failures = self.checkouts, dict(self.checkout_failures)
+            checked_out, open_connections = self.checked_out, self.open_connections
+            pool_clears, max_wait = self.pool_clears, self.max_wait_ms
+
+        def pct(p: float) -> Optional[float]:
+            if not waits:
+                return None
+            return round(waits[min(len(waits) - 1, int(len(waits) * p))], 3)
+
+        return {
+            "max_pool_size": MONGO_MAX_POOL_SIZE,
+            "min_pool_size": MONGO_MIN_POOL_SIZE,
+            "open_connections": open_connections,
+            "checked_out": checked_out,
+            "checkouts": checkouts,
+            "checkout_failures": failures,
+            "pool_clears": pool_clears,
+            "checkout_wait_ms": {
+                "p50": pct(0.50),
+                "p95": pct(0.95),
+                "p99": pct(0.99),
+                "max": round(max_wait, 3),
+                "samples": len(waits),
+            },
+        }
+
+
+pool_metrics = PoolMetrics()
+
+_client: Optional[AsyncIOMotorClient] = None
+
+
+def get_client() -> AsyncIOMotorClient:
+    """The shared client, created on first use."""
+    global _client
+    if _client is None:
+        _client = AsyncIOMotorClient(
+            MONGO_URL,
+            maxPoolSize=MONGO_MAX_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL_SIZE,
+            maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+            waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+            serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+            compressors=MONGO_COMPRESSORS,
+            event_listeners=[pool_metrics],
+        )
+    return _client
+
+
+async def connect_database() -> AsyncIOMotorDatabase:
+    """Create the client if needed and check the server is reachable."""
+    client = get_client()
+    await client.admin.command("ping")
+    return client[DB_NAME]
+
+
+def close_database():
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
+
 
-async def get_database():
-    return db
\ No newline at end of file
+async def get_database() -> AsyncIOMotorDatabase:
+    return get_client()[DB_NAME]
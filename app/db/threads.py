@@ -0,0 +1,482 @@
+# app/db/threads.py
+"""
+Thread storage for the `messages` collection.
+
+A thread is a header document in `messages` (participants, status, counters and
+a preview of the last entry). Its ChatEntry list is stored either:
+
+  embedded  - in the header's `messages` array (the original layout), or
+  bucketed  - in `message_entries`, BUCKET_SIZE entries per bucket document,
+              so the header stays small no matter how long the thread gets.
+
+MESSAGE_STORAGE_MODE selects where new entries go. Reads merge both layouts, so
+threads can be converted with the `bucket_thread_entries` migration while the
+app is running in bucketed mode.
+"""
+import os
+import re
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from app.services.search_service import SEARCH_TEXT_LIMIT, entry_search_tokens, entry_text, thread_search_fields
+
+STORAGE_MODE = os.getenv("MESSAGE_STORAGE_MODE", "embedded")
+BUCKET_SIZE = int(os.getenv("MESSAGE_BUCKET_SIZE", "50"))
+
+THREADS_COLLECTION = "messages"
+ENTRIES_COLLECTION = "message_entries"
+BUCKETED = "bucketed"
+
+# Header-only view for inbox lists: entry bodies and comments never leave the server.
+LIST_PROJECTION = {"messages": 0, "comments": 0, "search_text": 0, "search_tokens": 0}
+
+SNIPPET_LENGTH = 200
+_SPACE_RE = re.compile(r"\s+")
+
+
+def is_bucketed() -> bool:
+    return STORAGE_MODE == BUCKETED
+
+
+def entry_preview(entry: Dict[str, Any]) -> Dict[str, Any]:
+    """Small summary of an entry, stored on the header as `last_entry`."""
+    content = entry_text(entry)
+    return {
+        "sender": entry.get("sender"),
+        "title": entry.get("title"),
+        "channel": entry.get("channel"),
+        "timestamp": entry.get("timestamp"),
+        "snippet": _SPACE_RE.sub(" ", content).strip()[:SNIPPET_LENGTH],
+    }
+
+
+def dedupe_key(entry: Dict[str, Any]) -> Optional[str]:
+    """Provider id that makes an entry unique (currently the Gmail message id)."""
+    return (entry.get("metadata") or {}).get("gmail_id")
+
+
+async def _push_to_bucket(db, thread_id: ObjectId, entry: Dict[str, Any]):
+    """
+    Append to the thread's open bucket. Entries with a dedupe key also record it
+    in `keys`; (thread_id, keys) is uniquely indexed, so pushing a key that any
+    bucket of the thread already holds raises DuplicateKeyError.
+    """
+    timestamp = entry.get("timestamp")
+    key = dedupe_key(entry)
+    query: Dict[str, Any] = {"thread_id": thread_id, "count": {"$lt": BUCKET_SIZE}}
+    update: Dict[str, Any] = {
+        "$push": {"entries": entry},
+        "$inc": {"count": 1},
+        "$min": {"first_ts": timestamp},
+        "$max": {"last_ts": timestamp},
+    }
+    if key:
+        query["keys"] = {"$ne": key}
+        update["$push"]["keys"] = key
+    await db[ENTRIES_COLLECTION].update_one(query, update, upsert=True)
+
+
+def _append_update(
+    entry: Dict[str, Any],
+    set_fields: Optional[Dict[str, Any]] = None,
+    add_participants: Optional[List[str]] = None,
+) -> Dict[str, Any]:
+    """
+    Header update for one appended entry: preview, counter, participants.
+    Search tokens are not touched; they are fixed when the thread is created.
+    """
+    update: Dict[str, Any] = {
+        "$set": {"last_entry": entry_preview(entry), **(set_fields or {})},
+        "$inc": {"entry_count": 1},
+    }
+    if add_participants:
+        update["$addToSet"] = {"participants": {"$each": [p for p in add_participants if p]}}
+    return update
+
+
+async def create_thread(db, header: Dict[str, Any], first_entry: Dict[str, Any]) -> ObjectId:
+    """Insert a new thread header with its first entry and return its _id."""
+    doc = {k: v for k, v in header.items() if k != "messages"}
+    doc["entry_count"] = 1
+    doc["last_entry"] = entry_preview(first_entry)
+    doc.update(thread_search_fields(doc, first_entry))
+    doc["search_source"] = dedupe_key(first_entry)
+    if is_bucketed():
+        doc["entry_storage"] = BUCKETED
+    else:
+        doc["messages"] = [first_entry]
+
+    result = await db[THREADS_COLLECTION].insert_one(doc)
+    if is_bucketed():
+        await _push_to_bucket(db, result.inserted_id, first_entry)
+    return result.inserted_id
+
+
+async def append_entry(
+    db,
+    thread_id: ObjectId,
+    entry: Dict[str, Any],
+    set_fields: Optional[Dict[str, Any]] = None,
+    add_participants: Optional[List[str]] = None,
+) -> bool:
+    """
+    Append an entry to an existing thread and refresh the header counters.
+    Returns False if the thread does not exist.
+    """
+    update = _append_update(entry, set_fields, add_participants)
+    if is_bucketed():
+        update["$set"]["entry_storage"] = BUCKETED
+    else:
+        update["$push"] = {"messages": entry}
+
+    result = await db[THREADS_COLLECTION].update_one({"_id": thread_id}, update)
+    if result.matched_count == 0:
+        return False
+    if is_bucketed():
+        await _push_to_bucket(db, thread_id, entry)
+    return True
+
+
+async def upsert_entry(
+    db,
+    key: Dict[str, Any],
+    entry: Dict[str, Any],
+    on_insert: Dict[str, Any],
+    set_fields: Optional[Dict[str, Any]] = None,
+    add_participants: Optional[List[str]] = None,
+    older: bool = False,
+) -> Optional[Tuple[ObjectId, bool]]:
+    """
+    Idempotently add `entry` to the thread identified by `key`, creating the
+    thread (with `on_insert` header fields) if needed.
+
+    Duplicates are rejected by the database: in embedded mode by an `$ne` guard
+    on the entry's dedupe key plus the unique thread-key index, in bucketed mode
+    by the unique bucket `keys` index. Returns (thread _id, created), or None if
+    the entry was already stored.
+
+    `older` is for backfilled entries that may predate the thread's existing
+    ones: `set_fields` and the preview only apply to a new thread, and the
+    entry is placed in timestamp order rather than appended.
+    """
+    key_value = dedupe_key(entry)
+    # Fields maintained by the append update itself must not also be in $setOnInsert.
+    managed = {*key, *(set_fields or {}), "messages", "participants", "entry_count", "last_entry"}
+    insert_fields = {k: v for k, v in on_insert.items() if k not in managed}
+    insert_fields.update(thread_search_fields(on_insert, entry))
+    insert_fields["search_source"] = key_value
+
+    # A DuplicateKeyError on the first attempt may just be a concurrent insert of
+    # the same new thread; the retry then matches the existing header.
+    for attempt in range(2):
+        new_id = ObjectId()
+        try:
+            if not is_bucketed():
+                update = _append_update(entry, set_fields, add_participants)
+                update["$push"] = {"messages": entry}
+                update["$setOnInsert"] = {"_id": new_id, **insert_fields}
+                if older:
+                    for field in ("last_entry", *(set_fields or {})):
+                        update["$setOnInsert"][field] = update["$set"].pop(field)
+                    if not update["$set"]:
+                        del update["$set"]
+                    update["$push"] = {"messages": {"$each": [entry], "$sort": {"timestamp": 1}}}
+                query = dict(key)
+                if key_value:
+                    query["messages.metadata.gmail_id"] = {"$ne": key_value}
+                before = await db[THREADS_COLLECTION].find_one_and_update(
+                    query, update, projection={"_id": 1}, upsert=True
+                )
+                return (before["_id"], False) if before else (new_id, True)
+
+            header_update: Dict[str, Any] = {
+                "$setOnInsert": {"_id": new_id, **insert_fields},
+                "$set": {"entry_storage": BUCKETED},
+            }
+            before = await db[THREADS_COLLECTION].find_one_and_update(
+                key, header_update, projection={"_id": 1}, upsert=True
+            )
+            break
+        except DuplicateKeyError:
+            if attempt:
+                return None
+
+    thread_id = before["_id"] if before else new_id
+    try:
+        await _push_to_bucket(db, thread_id, entry)
+    except DuplicateKeyError:
+        return None
+    update = _append_update(entry, set_fields, add_participants)
+    if older and before is not None:
+        for field in ("last_entry", *(set_fields or {})):
+            update["$set"].pop(field)
+        # Buckets are filled in arrival order; load_entries re-sorts these threads
+        update["$set"]["entries_unordered"] = True
+    await db[THREADS_COLLECTION].update_one({"_id": thread_id}, update)
+    return thread_id, before is None
+
+
+async def update_entry(
+    db,
+    thread_id: ObjectId,
+    key: str,
+    fields: Dict[str, Any],
+    unset: Tuple[str, ...] = (),
+) -> bool:
+    """
+    Set `fields` (paths relative to the entry, e.g. "content") on the entry with
+    dedupe key `key`, in whichever layout holds it. New content of the entry the
+    thread's search fields were built from (its `search_source`) is added to
+    them; other entries do not grow the header. Returns False if no entry has
+    that key.
+    """
+    def matched(prefix: str) -> Dict[str, Any]:
+        # arrayFilters instead of the positional `$`: the target is named by its
+        # own key, not by whichever array condition the filter matched first
+        update: Dict[str, Any] = {}
+        if fields:
+            update["$set"] = {f"{prefix}.$[e].{k}": v for k, v in fields.items()}
+        if unset:
+            update["$unset"] = {f"{prefix}.$[e].{k}": "" for k in unset}
+        return update
+
+    array_filters = [{"e.metadata.gmail_id": key}]
+    result = await db[THREADS_COLLECTION].update_one(
+        {"_id": thread_id, "messages.metadata.gmail_id": key},
+        matched("messages"),
+        array_filters=array_filters,
+    )
+    if result.matched_count == 0:
+        # `keys` names the one bucket holding the entry (thread_keys is unique)
+        result = await db[ENTRIES_COLLECTION].update_one(
+            {"thread_id": thread_id, "keys": key},
+            matched("entries"),
+            array_filters=array_filters,
+        )
+        if result.matched_count == 0:
+            return False
+    if "content" in fields:
+        entry = {"content": fields["content"], "message_type": fields.get("message_type")}
+        await db[THREADS_COLLECTION].update_one(
+            {"_id": thread_id, "search_source": key},
+            {
+                "$set": {"search_text": entry_text(entry)[:SEARCH_TEXT_LIMIT]},
+                "$addToSet": {"search_tokens": {"$each": entry_search_tokens(entry)}},
+            },
+        )
+    return True
+
+
+async def load_entries(db, thread: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """All entries of a thread header, oldest first."""
+    entries = list(thread.get("messages") or [])
+    if thread.get("entry_storage") == BUCKETED:
+        cursor = db[ENTRIES_COLLECTION].find(
+            {"thread_id": thread["_id"]}, {"entries": 1}
+        ).sort([("first_ts", 1), ("seq", 1), ("_id", 1)])
+        async for bucket in cursor:
+            entries.extend(bucket.get("entries", []))
+    if thread.get("entries_unordered"):
+        entries.sort(key=lambda e: e.get("timestamp") or datetime.min)
+    return entries
+
+
+async def load_thread(db, query: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """find_one on the headers with `messages` populated from either layout."""
+    thread = await db[THREADS_COLLECTION].find_one(query)
+    if thread:
+        thread["messages"] = await load_entries(db, thread)
+    return thread
+
+
+async def bucket_thread_entries(db) -> dict:
+    """
+    Migration: move embedded `messages` arrays into `message_entries` buckets.
+    Safe to re-run; migrated buckets are keyed by (thread_id, seq).
+    """
+    converted, skipped = 0, 0
+    cursor = db[THREADS_COLLECTION].find({"messages.0": {"$exists": True}})
+    async for thread in cursor:
+        entries = thread["messages"]
+        ops = []
+        seen_keys = set()
+        for seq, start in enumerate(range(0, len(entries), BUCKET_SIZE)):
+            chunk = entries[start:start + BUCKET_SIZE]
+            timestamps = [e.get("timestamp") for e in chunk if e.get("timestamp")]
+            # Dedupe keys are unique per thread; legacy duplicates keep only their first key.
+            keys = [k for k in map(dedupe_key, chunk) if k and k not in seen_keys]
+            seen_keys.update(keys)
+            ops.append(ReplaceOne(
+                {"thread_id": thread["_id"], "seq": seq},
+                {
+                    "thread_id": thread["_id"],
+                    "seq": seq,
+                    "entries": chunk,
+                    # Keep migrated buckets full so appends open a new bucket after them.
+                    "count": BUCKET_SIZE,
+                    "first_ts": min(timestamps) if timestamps else None,
+                    "last_ts": max(timestamps) if timestamps else None,
+                    **({"keys": keys} if keys else {}),
+                },
+                upsert=True,
+            ))
+        await db[ENTRIES_COLLECTION].bulk_write(ops, ordered=False)
+
+        # Entries appended to buckets after the mode switch, if any.
+        appended = 0
+        async for row in db[ENTRIES_COLLECTION].aggregate([
+            {"$match": {"thread_id": thread["_id"], "seq": {"$exists": False}}},
+            {"$group": {"_id": None, "n": {"$sum": {"$size": "$entries"}}}},
+        ]):
+            appended = row["n"]
+
+        update = {
+            "$unset": {"messages": ""},
+            "$set": {"entry_storage": BUCKETED, "entry_count": len(entries) + appended},
+        }
+        if not appended:
+            update["$set"]["last_entry"] = entry_preview(entries[-1])
+
+        # Only drop the array if nobody appended to it in the meantime.
+        result = await db[THREADS_COLLECTION].update_one(
+            {"_id": thread["_id"], "messages": {"$size": len(entries)}},
+            update,
+        )
+        if result.modified_count:
+            converted += 1
+        else:
+            skipped += 1
+    return {"converted": converted, "skipped": skipped}
+
+
+async def backfill_thread_previews(db, batch_size: int = 500) -> dict:
+    """
+    Migration: set `entry_count` and `last_entry` on headers written before
+    they were maintained, reading only the last embedded entry of each thread.
+    """
+    updated = 0
+    ops = []
+    cursor = db[THREADS_COLLECTION].find(
+        {"last_entry": {"$exists": False}, "messages.0": {"$exists": True}},
+        {"last": {"$slice": ["$messages", -1]}, "n": {"$size": "$messages"}},
+    )
+    async for thread in cursor:
+        ops.append(UpdateOne(
+            {"_id": thread["_id"]},
+            {"$set": {"entry_count": thread["n"], "last_entry": entry_preview(thread["last"][0])}},
+        ))
+        if len(ops) >= batch_size:
+            updated += (await db[THREADS_COLLECTION].bulk_write(ops, ordered=False)).modified_count
+            ops = []
+    if ops:
+        updated += (await db[THREADS_COLLECTION].bulk_write(ops, ordered=False)).modified_count
+    return {"updated": updated}
+
+
+async def backfill_search_fields(db) -> dict:
+    """Migration: compute search_text / search_tokens for threads that lack them."""
+    updated = 0
+    cursor = db[THREADS_COLLECTION].find({"search_tokens": {"$exists": False}}, {"comments": 0})
+    async for thread in cursor:
+        entries = await load_entries(db, thread)
+        if not entries:
+            continue
+        fields = thread_search_fields(thread, entries[0])
+        fields["search_source"] = dedupe_key(entries[0])
+        await db[THREADS_COLLECTION].update_one({"_id": thread["_id"]}, {"$set": fields})
+        updated += 1
+    return {"updated": updated}
+
+
+async def merge_duplicate_email_threads(db) -> dict:
+    """
+    Migration: fold duplicate email headers for one (user_id, thread_id) into the
+    oldest one so the unique `user_thread_email` index can be built. Entries the
+    survivor does not already hold (by dedupe key) are appended, comments are
+    carried over, and the duplicates and their buckets are deleted.
+    """
+    merged, removed = 0, 0
+    groups = db[THREADS_COLLECTION].aggregate([
+        {"$match": {"channel": "email"}},
+        {"$group": {"_id": {"user_id": "$user_id", "thread_id": "$thread_id"}, "ids": {"$push": "$_id"}, "n": {"$sum": 1}}},
+        {"$match": {"n": {"$gt": 1}}},
+    ], allowDiskUse=True)
+    async for group in groups:
+        headers = await db[THREADS_COLLECTION].find({"_id": {"$in": group["ids"]}}).sort("_id", 1).to_list(None)
+        keeper, duplicates = headers[0], headers[1:]
+        kept = await load_entries(db, keeper)
+        seen = {dedupe_key(e) for e in kept if dedupe_key(e)}
+
+        extra: List[Dict[str, Any]] = []
+        comments: List[Dict[str, Any]] = []
+        participants: List[str] = []
+        for dup in duplicates:
+            for entry in await load_entries(db, dup):
+                key = dedupe_key(entry)
+                if key and key in seen:
+                    continue
+                seen.add(key)
+                extra.append(entry)
+            comments.extend(dup.get("comments") or [])
+            participants.extend(dup.get("participants") or [])
+        extra.sort(key=lambda e: e.get("timestamp") or datetime.min)
+
+        update: Dict[str, Any] = {"$addToSet": {"participants": {"$each": participants}}}
+        if extra:
+            update["$inc"] = {"entry_count": len(extra)}
+            last = max(kept + extra, key=lambda e: e.get("timestamp") or datetime.min)
+            update["$set"] = {"last_entry": entry_preview(last)}
+            if keeper.get("entry_storage") == BUCKETED:
+                for entry in extra:
+                    try:
+                        await _push_to_bucket(db, keeper["_id"], entry)
+                    except DuplicateKeyError:
+                        update["$inc"]["entry_count"] -= 1
+            else:
+                update["$push"] = {"messages": {"$each": extra}}
+        if comments:
+            update.setdefault("$push", {})["comments"] = {"$each": comments}
+        await db[THREADS_COLLECTION].update_one({"_id": keeper["_id"]}, update)
+
+        duplicate_ids = [d["_id"] for d in duplicates]
+        await db[ENTRIES_COLLECTION].delete_many({"thread_id": {"$in": duplicate_ids}})
+        removed += (await db[THREADS_COLLECTION].delete_many({"_id": {"$in": duplicate_ids}})).deleted_count
+        merged += 1
+    return {"merged": merged, "removed": removed}
+
+
+async def cap_search_tokens(db, batch_size: int = 500) -> dict:
+    """
+    Migration: rebuild search_text / search_tokens of threads indexed before
+    they were capped, from the title, client and opening entry only.
+    """
+    updated = 0
+    ops = []
+    cursor = db[THREADS_COLLECTION].find(
+        {"search_tokens": {"$exists": True}, "search_source": {"$exists": False}},
+        {"title": 1, "client": 1, "messages": {"$slice": 1}},
+    )
+    async for thread in cursor:
+        first = (thread.get("messages") or [None])[0]
+        if first is None:
+            bucket = await db[ENTRIES_COLLECTION].find_one(
+                {"thread_id": thread["_id"]},
+                {"entries": {"$slice": 1}},
+                sort=[("first_ts", 1), ("seq", 1), ("_id", 1)],
+            )
+            first = ((bucket or {}).get("entries") or [None])[0]
+        if first is None:
+            continue
+        fields = thread_search_fields(thread, first)
+        fields["search_source"] = dedupe_key(first)
+        ops.append(UpdateOne({"_id": thread["_id"]}, {"$set": fields}))
+        if len(ops) >= batch_size:
+            updated += (await db[THREADS_COLLECTION].bulk_write(ops, ordered=False)).modified_count
+            ops = []
+    if ops:
+        updated += (await db[THREADS_COLLECTION].bulk_write(ops, ordered=False)).modified_count
+    return {"updated": updated}
@@ -1,86 +1,66 @@
 #app/main.py
 from fastapi import FastAPI, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
 from contextlib import asynccontextmanager
 import os
 from dotenv import load_dotenv
 load_dotenv()  # Load from .env at startup
-from app.db.mongodb import get_database
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from app.core.config import settings
+from app.db.mongodb import close_database, connect_database, get_client, get_database, pool_metrics
+from app.db.indexes import apply_indexes
+from app.services.gmail_client import close_http_client
+from app.services.gmail_backfill import backfill_scheduler
+from app.services.gmail_queue import start_workers, stop_workers
+from app.services.gmail_watch import watch_scheduler
 import asyncio
 
 import socketio
+from app.socket import emitter
 
 origins = os.getenv("ORIGINS", "http://localhost:5173").split(",")
 
 # Create Socket.IO server
 sio = socketio.AsyncServer(
     async_mode="asgi",
-    cors_allowed_origins=[origin.strip() for origin in origins]
+    cors_allowed_origins=[origin.strip() for origin in origins],
+    client_manager=emitter.client_manager(),
 )
+emitter.attach(sio)
 
 # CORS origins
-MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017")
-DB_NAME = os.getenv("DB_NAME", "attentify")
+AUTO_APPLY_INDEXES = os.getenv("AUTO_APPLY_INDEXES", "true").lower() == "true"
 from starlette.middleware.sessions import SessionMiddleware
 
-GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
-GOOGLE_CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET")
-
-def set_gmail_watch(cred):
-    access_token = cred["access_token"]
-    refresh_token = cred["refresh_token"]
-            
-    creds = Credentials(
-        token=access_token,
-        refresh_token=refresh_token,
-        token_uri="https://oauth2.googleapis.com/token",
-        client_id=GOOGLE_CLIENT_ID,
-        client_secret=GOOGLE_CLIENT_SECRET,
-        scopes=["https://www.googleapis.com/auth/gmail.readonly"]
-    )
-
-    gmail = build("gmail", "v1", credentials=creds)
-    watch_request = {
-        "labelIds": ["INBOX"],
-        "topicName": f"projects/{settings.PUBSUB_PROJECT}/topics/{settings.PUBSUB_TOPIC}",
-    }
-    return gmail.users().watch(userId="me", body=watch_request).execute()
-
-async def set_gmail_watches_periodically():
-    while True:
-        print("Setting up Gmail Watches...")
-        db = app.state.db
-        cursor = db["gmail_accounts"].find()
-        async for cred in cursor:
-            loop = asyncio.get_running_loop()
-            response = await loop.run_in_executor(None, set_gmail_watch, cred)
-            print(response)
-            
-        await asyncio.sleep(24 * 3600)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     try:
-        mongo_client = AsyncIOMotorClient(MONGO_URL, serverSelectionTimeoutMS=5000)
-        # Try to ping the server to check connection
-        await mongo_client.admin.command("ping")
+        # One shared, pooled client (app.db.mongodb); ping to check the connection
+        app.state.db = await connect_database()
+        app.state.mongo_client = get_client()
         print("✅ Connected to MongoDB")
-        app.state.mongo_client = mongo_client
-        app.state.db = mongo_client[DB_NAME]
     except Exception as e:
         print("❌ Failed to connect to MongoDB:", e)
         raise e  # Optional: prevent app from starting if DB fails
 
-    asyncio.create_task(set_gmail_watches_periodically())
+    if AUTO_APPLY_INDEXES:
+        await apply_indexes(app.state.db)
+
+    # Renews Gmail watches before they lapse; one process in the cluster at a time
+    watch_task = asyncio.create_task(watch_scheduler(app.state.db))
+    # Drain queued Gmail Pub/Sub notifications (app.services.gmail_queue)
+    start_workers(app.state.db)
+    # Run new and interrupted /message/fetch-all backfills
+    backfill_task = asyncio.create_task(backfill_scheduler(app.state.db))
 
     yield  # App runs
 
+    watch_task.cancel()
+    backfill_task.cancel()
+    await asyncio.gather(watch_task, backfill_task, return_exceptions=True)
+    await stop_workers()
+    await close_http_client()
     print("🔌 Closing MongoDB connection")
-    mongo_client.close()
+    close_database()
 
 app = FastAPI(title="Attentify APP", lifespan=lifespan)
 
@@ -148,6 +128,11 @@ def read_root():
 def health_check():
     return {"status": "ok"}
 
+@app.get("/health/db")
+def db_pool_health():
+    # Rising checkout waits at a steady load mean MONGO_MAX_POOL_SIZE is too small
+    return {"status": "ok", "pool": pool_metrics.snapshot()}
+
 @app.get("/test-db")
 async def test(db=Depends(get_database)):
     collections = await db.list_collection_names()
@@ -16,6 +16,7 @@ class CompanyInDB(CompanyBase):
     id: PyObjectId = Field(default_factory=PyObjectId, alias="_id")
     created_by: PyObjectId
     created_at: datetime
+    ticket_prefix: Optional[str] = None
 
     class Config:
         json_encoders = {ObjectId: str}
@@ -35,4 +36,5 @@ class UpdateCompanyRequest(BaseModel):
     company_id: str = Field(..., description="MongoDB ObjectId of the company")
     name: Optional[str] = None
     site_url: Optional[str] = None
-    email: Optional[EmailStr] = None
\ No newline at end of file
+    email: Optional[EmailStr] = None
+    ticket_prefix: Optional[str] = Field(None, pattern=r"^[A-Z0-9]{1,10}$", description="Prefix for new ticket numbers, e.g. CA")
\ No newline at end of file
@@ -41,3 +41,5 @@ class GmailAccountUpdate(BaseModel):
 class GmailAccountInDB(GmailAccountBase):
     id: str
     user_id: str
+    watch_expiration: Optional[datetime] = None
+    watch_error: Optional[dict] = None
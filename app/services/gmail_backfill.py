@@ -0,0 +1,360 @@
+# app/services/gmail_backfill.py
+"""
+Resumable Gmail backfill: imports an account's INBOX back to a date horizon.
+
+One job per account lives in `gmail_backfills` (keyed by the account _id).
+A run pages through messages.list (`after:<horizon>`, newest first), storing
+the page token and counters after every page, so a crashed or restarted
+process resumes from the last finished page; re-ingesting part of a page is
+harmless because entries are deduplicated by Gmail id. Each page is fetched in
+GMAIL_BATCH_SIZE chunks, GMAIL_BACKFILL_CONCURRENCY of them at a time per
+account and paced to GMAIL_BACKFILL_QUOTA_UNITS per second, metadata only:
+bodies are hydrated when a thread is opened. A page with messages that could
+not be fetched fails as a whole, without advancing the page token, and is
+retried with backoff.
+
+Before the first page the job records the mailbox's current historyId and
+hands it to an account that has none, so live sync (app.services.gmail_ingest)
+covers everything from there on while the backfill works backwards; the job is
+caught up once its last page is stored. Threads the backfill creates from mail
+older than the start of live sync (`live_since`: that handoff, or when the
+account was connected) are stored Closed and get no ticket, so onboarding a
+mailbox does not flood the inbox with long-finished conversations.
+Extending the horizon of a finished job only lists the gap (`before:<old horizon>`).
+
+Jobs are claimed with a lease, like the notification queue, and a heartbeat
+extends it while the job runs; the scheduler loop in each process picks up
+new jobs and those whose lease expired.
+"""
+import asyncio
+import calendar
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+
+from app.services.gmail_client import GMAIL_BATCH_SIZE
+from app.services.gmail_credentials import gmail_client_for
+from app.services.gmail_ingest import as_history_id, emit_gmail_update, ingest_messages
+from app.utils.logger import logger
+
+BACKFILL_COLLECTION = "gmail_backfills"
+
+GMAIL_BACKFILL_DAYS = int(os.getenv("GMAIL_BACKFILL_DAYS", "365"))
+GMAIL_BACKFILL_PAGE_SIZE = min(int(os.getenv("GMAIL_BACKFILL_PAGE_SIZE", "500")), 500)
+GMAIL_BACKFILL_CONCURRENCY = int(os.getenv("GMAIL_BACKFILL_CONCURRENCY", "4"))
+# Jobs run at the same time in one process
+GMAIL_BACKFILL_JOBS = int(os.getenv("GMAIL_BACKFILL_JOBS", "2"))
+GMAIL_BACKFILL_LEASE = timedelta(seconds=int(os.getenv("GMAIL_BACKFILL_LEASE_SECONDS", "300")))
+GMAIL_BACKFILL_POLL_SECONDS = float(os.getenv("GMAIL_BACKFILL_POLL_SECONDS", "10"))
+GMAIL_BACKFILL_MAX_ATTEMPTS = int(os.getenv("GMAIL_BACKFILL_MAX_ATTEMPTS", "5"))
+# Gmail allows 250 quota units per second per user; keep some for live sync
+GMAIL_BACKFILL_QUOTA_UNITS = int(os.getenv("GMAIL_BACKFILL_QUOTA_UNITS", "200"))
+# Quota cost of messages.list and of each messages.get (also inside a batch)
+LIST_UNITS = 5
+GET_UNITS = 5
+RETRY_BASE_SECONDS = 30
+RETRY_MAX_SECONDS = 1800
+
+PENDING, RUNNING, DONE, FAILED = "pending", "running", "done", "failed"
+
+PROGRESS_FIELDS = (
+    "email", "status", "horizon", "pages", "listed", "stored", "estimate",
+    "error", "attempts", "created_at", "started_at", "finished_at",
+)
+
+_wakeup: Optional[asyncio.Event] = None
+_owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+class _Quota:
+    """Spaces out Gmail calls so they stay under a units-per-second budget."""
+
+    def __init__(self, units_per_second: int = GMAIL_BACKFILL_QUOTA_UNITS):
+        self.units_per_second = units_per_second
+        self.next_at = 0.0
+
+    async def spend(self, units: int):
+        now = asyncio.get_running_loop().time()
+        start = max(now, self.next_at)
+        self.next_at = start + units / self.units_per_second
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+def _event() -> asyncio.Event:
+    global _wakeup
+    if _wakeup is None:
+        _wakeup = asyncio.Event()
+    return _wakeup
+
+
+def _epoch(value: datetime) -> int:
+    return calendar.timegm(value.utctimetuple())
+
+
+def backfill_query(job: dict) -> str:
+    q = f"after:{_epoch(job['horizon'])}"
+    if job.get("until"):
+        q += f" before:{_epoch(job['until'])}"
+    return q
+
+
+def progress(job: dict) -> Dict[str, Any]:
+    return {field: job.get(field) for field in PROGRESS_FIELDS}
+
+
+async def start_backfill(db, account: dict, days: int = GMAIL_BACKFILL_DAYS) -> dict:
+    """
+    Create or extend the account's backfill job and return it. A job that is
+    already queued or running is left alone, a failed one is resumed, and a
+    finished one is only restarted to reach further back than it did.
+    """
+    horizon = (datetime.utcnow() - timedelta(days=days)).replace(hour=0, minute=0, second=0, microsecond=0)
+    now = datetime.utcnow()
+    job = await db[BACKFILL_COLLECTION].find_one({"_id": account["_id"]})
+
+    if job is not None and job["status"] in (PENDING, RUNNING):
+        return job
+    if job is not None and job["status"] == FAILED:
+        # Resume from its page token; the query must not change under it
+        update: Dict[str, Any] = {"$set": {"status": PENDING, "attempts": 0, "available_at": now, "error": None}}
+    else:
+        if job is not None and horizon >= job["horizon"]:
+            return job
+        update = {
+            "$set": {
+                "email": account["email"],
+                "user_id": account["user_id"],
+                "company_id": account["company_id"],
+                "status": PENDING,
+                "horizon": horizon,
+                # Everything after a finished job's horizon is already stored
+                "until": job["horizon"] if job is not None else None,
+                "page_token": None,
+                "pages": 0,
+                "listed": 0,
+                "stored": 0,
+                "estimate": None,
+                "start_history_id": None,
+                "attempts": 0,
+                "available_at": now,
+                "created_at": now,
+                "error": None,
+                "finished_at": None,
+            },
+            "$unset": {"started_at": ""},
+        }
+    job = await db[BACKFILL_COLLECTION].find_one_and_update(
+        {"_id": account["_id"]}, update, upsert=True, return_document=ReturnDocument.AFTER
+    )
+    logger.info("Queued Gmail backfill for %s back to %s", account["email"], job["horizon"].date())
+    _event().set()
+    return job
+
+
+async def _claim(db) -> Optional[dict]:
+    now = datetime.utcnow()
+    return await db[BACKFILL_COLLECTION].find_one_and_update(
+        {"$or": [
+            {"status": PENDING, "available_at": {"$lte": now}},
+            # Lease expired: the process running it died mid-job
+            {"status": RUNNING, "lease_until": {"$lt": now}},
+        ]},
+        {
+            "$set": {"status": RUNNING, "owner": _owner, "lease_until": now + GMAIL_BACKFILL_LEASE},
+            "$min": {"started_at": now},
+        },
+        sort=[("available_at", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+async def _save(db, job: dict, update: Dict[str, Any]) -> bool:
+    """Write to a job this process still owns; False if the lease was lost."""
+    result = await db[BACKFILL_COLLECTION].update_one({"_id": job["_id"], "owner": _owner}, update)
+    return result.matched_count == 1
+
+
+async def _ingest_page(
+    db, account: dict, gmail, message_ids: List[str], closed_before: datetime, quota: _Quota
+) -> int:
+    """
+    Ingest one listed page in parallel chunks; returns how many entries were
+    new. Raises if any chunk does (e.g. GmailBatchIncomplete), so the caller
+    keeps the page token and the page is retried.
+    """
+    slots = asyncio.Semaphore(GMAIL_BACKFILL_CONCURRENCY)
+
+    async def ingest(chunk: List[str]) -> int:
+        async with slots:
+            await quota.spend(GET_UNITS * len(chunk))
+            return len(await ingest_messages(
+                db, account, gmail, chunk, older=True, hydrate=False, closed_before=closed_before
+            ))
+
+    counts = await asyncio.gather(*(
+        ingest(message_ids[start:start + GMAIL_BATCH_SIZE])
+        for start in range(0, len(message_ids), GMAIL_BATCH_SIZE)
+    ))
+    return sum(counts)
+
+
+async def run_backfill(db, job: dict):
+    account = await db["gmail_accounts"].find_one({"_id": job["_id"]})
+    if account is None:
+        await _save(db, job, {"$set": {"status": FAILED, "error": "account removed"}, "$unset": {"lease_until": ""}})
+        return
+    gmail = await gmail_client_for(db, account)
+
+    if job.get("start_history_id") is None:
+        profile = await gmail.get_profile()
+        start_history_id = as_history_id(profile.get("historyId"))
+        # Live sync takes over from here; the backfill covers what came before
+        handed_over = await db["gmail_accounts"].update_one(
+            {"_id": account["_id"], "history_id": {"$in": [None, "", 0]}},
+            {"$set": {"history_id": start_history_id}},
+        )
+        if handed_over.modified_count or not isinstance(account["_id"], ObjectId):
+            job["live_since"] = datetime.utcnow()
+        else:
+            # Already live-synced since the account was connected
+            job["live_since"] = account["_id"].generation_time.replace(tzinfo=None)
+        if not await _save(db, job, {"$set": {"start_history_id": start_history_id, "live_since": job["live_since"]}}):
+            return
+    # Threads whose newest mail predates live sync are history: Closed, no ticket
+    closed_before = job.get("live_since") or job["created_at"]
+
+    q = backfill_query(job)
+    page_token = job.get("page_token")
+    quota = _Quota()
+    while True:
+        await quota.spend(LIST_UNITS)
+        page = await gmail.messages_list(
+            max_results=GMAIL_BACKFILL_PAGE_SIZE, page_token=page_token, q=q, label_ids=["INBOX"]
+        )
+        message_ids = [m["id"] for m in page.get("messages", [])]
+        stored = await _ingest_page(db, account, gmail, message_ids, closed_before, quota) if message_ids else 0
+        page_token = page.get("nextPageToken")
+
+        update: Dict[str, Any] = {
+            "$set": {
+                "page_token": page_token,
+                "lease_until": datetime.utcnow() + GMAIL_BACKFILL_LEASE,
+                "updated_at": datetime.utcnow(),
+            },
+            "$inc": {"pages": 1, "listed": len(message_ids), "stored": stored},
+        }
+        if job.get("estimate") is None and page.get("resultSizeEstimate") is not None:
+            # Only the first page's estimate covers the whole query
+            update["$set"]["estimate"] = page["resultSizeEstimate"]
+            job["estimate"] = page["resultSizeEstimate"]
+        if not page_token:
+            update["$set"].update(status=DONE, finished_at=datetime.utcnow(), error=None)
+            update["$unset"] = {"lease_until": "", "owner": ""}
+            del update["$set"]["lease_until"]
+        if not await _save(db, job, update):
+            logger.warning("Lost the Gmail backfill lease for %s; stopping", job["email"])
+            return
+
+        if stored:
+            await emit_gmail_update({
+                "user_id": str(account["user_id"]),
+                "company_id": str(account["company_id"]),
+                "email": account["email"],
+                "message": f"Imported {stored} older messages for {account['email']}",
+            })
+        if not page_token:
+            logger.info("✅ Gmail backfill for %s caught up", job["email"])
+            return
+
+
+async def _heartbeat(db, job: dict):
+    """Extend the job's lease while it runs, so a slow page does not let it be reclaimed."""
+    while True:
+        await asyncio.sleep(GMAIL_BACKFILL_LEASE.total_seconds() / 3)
+        try:
+            await db[BACKFILL_COLLECTION].update_one(
+                {"_id": job["_id"], "owner": _owner, "status": RUNNING},
+                {"$set": {"lease_until": datetime.utcnow() + GMAIL_BACKFILL_LEASE}},
+            )
+        except Exception:
+            # Try again next beat; the lease still has two beats left
+            logger.warning("Gmail backfill heartbeat failed for %s", job["email"], exc_info=True)
+
+
+async def _backfill(db, job: dict):
+    heartbeat = asyncio.create_task(_heartbeat(db, job))
+    try:
+        await run_backfill(db, job)
+    finally:
+        heartbeat.cancel()
+
+
+async def _run(db, job: dict, slots: asyncio.Semaphore):
+    try:
+        await _backfill(db, job)
+    except asyncio.CancelledError:
+        # Shutting down: let another process resume from the stored page token
+        await _save(db, job, {"$set": {"status": PENDING, "available_at": datetime.utcnow()}})
+        raise
+    except Exception as e:
+        attempts = job.get("attempts", 0) + 1
+        retry_in = min(RETRY_BASE_SECONDS * 2 ** (attempts - 1), RETRY_MAX_SECONDS)
+        if attempts >= GMAIL_BACKFILL_MAX_ATTEMPTS:
+            logger.error("Gmail backfill for %s failed %d times; giving up", job["email"], attempts, exc_info=True)
+            status = FAILED
+        else:
+            logger.warning("Gmail backfill for %s failed (attempt %d): %s", job["email"], attempts, e)
+            status = PENDING
+        await _save(db, job, {
+            "$set": {
+                "status": status,
+                "attempts": attempts,
+                "error": str(e),
+                "available_at": datetime.utcnow() + timedelta(seconds=retry_in),
+            },
+            "$unset": {"lease_until": ""},
+        })
+    finally:
+        slots.release()
+
+
+async def backfill_scheduler(db):
+    """Run claimable backfill jobs, GMAIL_BACKFILL_JOBS at a time in this process."""
+    slots = asyncio.Semaphore(GMAIL_BACKFILL_JOBS)
+    wakeup = _event()
+    running = set()
+    try:
+        while True:
+            await slots.acquire()
+            try:
+                job = await _claim(db)
+            except Exception:
+                logger.error("Gmail backfill claim failed", exc_info=True)
+                job = None
+            if job is None:
+                slots.release()
+                wakeup.clear()
+                try:
+                    await asyncio.wait_for(wakeup.wait(), timeout=GMAIL_BACKFILL_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            logger.info("Running Gmail backfill for %s (page %d)", job["email"], job.get("pages", 0) + 1)
+            task = asyncio.create_task(_run(db, job, slots))
+            running.add(task)
+            task.add_done_callback(running.discard)
+    finally:
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+
+
+async def backfill_progress(db, account_ids: List[Any]) -> List[Dict[str, Any]]:
+    jobs = db[BACKFILL_COLLECTION].find({"_id": {"$in": account_ids}})
+    return [progress(job) async for job in jobs]
@@ -0,0 +1,472 @@
+# app/services/gmail_client.py
+"""
+Async Gmail API client.
+
+All Gmail calls go through one process-wide `httpx.AsyncClient` (keep-alive,
+HTTP/2 when `h2` is installed), so a slow Google response only suspends the
+awaiting request instead of blocking the event loop the way the synchronous
+googleapiclient/httplib2 calls did. Access tokens are refreshed with an async
+POST to the OAuth token endpoint when they are about to expire, or once after
+a 401. Endpoints come from a vendored Gmail discovery document
+(gmail_discovery.json) parsed once per process.
+
+    client = GmailClient(account)
+    history = await client.history_list(start_history_id=account["history_id"])
+"""
+import asyncio
+import importlib.util
+import json
+import os
+import tempfile
+import uuid
+from functools import lru_cache
+from datetime import datetime, timedelta, timezone
+from email.parser import BytesParser
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import quote, urlencode
+
+import httpx
+
+from app.utils.logger import logger
+
+# Pinned, vendored discovery document: endpoints are resolved from it once per
+# process and never fetched from Google at runtime.
+DISCOVERY_PATH = os.path.join(os.path.dirname(__file__), "gmail_discovery.json")
+TOKEN_URL = "https://oauth2.googleapis.com/token"
+TOKENINFO_URL = "https://www.googleapis.com/oauth2/v1/tokeninfo"
+
+GMAIL_HTTP_TIMEOUT = float(os.getenv("GMAIL_HTTP_TIMEOUT", "30"))
+GMAIL_HTTP_MAX_CONNECTIONS = int(os.getenv("GMAIL_HTTP_MAX_CONNECTIONS", "100"))
+# Gmail accepts up to 100 calls per batch but advises staying around 50 to
+# avoid per-user rate limiting; GMAIL_BATCH_SIZE is capped at 100.
+GMAIL_BATCH_SIZE = min(int(os.getenv("GMAIL_BATCH_SIZE", "50")), 100)
+GMAIL_BATCH_RETRIES = int(os.getenv("GMAIL_BATCH_RETRIES", "3"))
+# Per-item statuses worth retrying; anything else (e.g. 404 for a message
+# deleted since the notification) is final.
+RETRYABLE_STATUSES = {401, 429, 500, 502, 503, 504}
+# Large responses are streamed into a temporary file that spills to disk past this size
+GMAIL_SPOOL_BYTES = int(os.getenv("GMAIL_SPOOL_BYTES", str(1024 * 1024)))
+# history.list page size (Gmail's maximum is 500)
+HISTORY_PAGE_SIZE = 500
+# Refresh this long before the recorded expiry so in-flight calls don't race it.
+TOKEN_EXPIRY_SKEW = timedelta(seconds=60)
+
+_http: Optional[httpx.AsyncClient] = None
+
+
+class GmailAPIError(Exception):
+    def __init__(self, status_code: int, message: str, payload: Optional[dict] = None):
+        super().__init__(f"Gmail API error {status_code}: {message}")
+        self.status_code = status_code
+        self.payload = payload or {}
+
+
+class GmailAuthError(GmailAPIError):
+    """The account's refresh token was rejected; the user has to reconnect."""
+
+
+class GmailBatchIncomplete(GmailAPIError):
+    """Batch items still failing with a retryable status after the retries."""
+
+    def __init__(self, missing: List[str], fetched: Dict[str, dict]):
+        super().__init__(503, f"{len(missing)} messages not fetched")
+        self.missing = missing
+        self.fetched = fetched
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """The shared HTTP client for Google APIs, created on first use."""
+    global _http
+    if _http is None:
+        _http = httpx.AsyncClient(
+            http2=importlib.util.find_spec("h2") is not None,
+            timeout=httpx.Timeout(GMAIL_HTTP_TIMEOUT, connect=10.0),
+            limits=httpx.Limits(
+                max_connections=GMAIL_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=GMAIL_HTTP_MAX_CONNECTIONS // 4 or 1,
+                keepalive_expiry=60.0,
+            ),
+        )
+    return _http
+
+
+async def close_http_client():
+    global _http
+    if _http is not None:
+        await _http.aclose()
+        _http = None
+
+
+def parse_expires_at(value: Any) -> Optional[datetime]:
+    """Stored `expires_at` (datetime or ISO string) as naive UTC, or None."""
+    if not value:
+        return None
+    try:
+        expires_at = datetime.fromisoformat(value) if isinstance(value, str) else value
+    except ValueError:
+        logger.warning("Could not parse expires_at: %s", value)
+        return None
+    if expires_at.tzinfo:
+        expires_at = expires_at.astimezone(timezone.utc).replace(tzinfo=None)
+    return expires_at
+
+
+def _error_message(response: httpx.Response) -> tuple:
+    try:
+        payload = response.json()
+    except ValueError:
+        return response.text[:200], {}
+    error = payload.get("error")
+    if isinstance(error, dict):
+        return error.get("message", ""), payload
+    return payload.get("error_description") or str(error or ""), payload
+
+
+async def refresh_access_token(account: dict) -> Dict[str, Any]:
+    """Exchange the account's refresh token; returns {"access_token", "expires_at"}."""
+    response = await get_http_client().post(TOKEN_URL, data={
+        "grant_type": "refresh_token",
+        "refresh_token": account["refresh_token"],
+        "client_id": account["client_id"],
+        "client_secret": account["client_secret"],
+    })
+    if response.status_code != 200:
+        message, payload = _error_message(response)
+        error_cls = GmailAuthError if response.status_code in (400, 401) else GmailAPIError
+        raise error_cls(response.status_code, message, payload)
+    data = response.json()
+    return {
+        "access_token": data["access_token"],
+        "expires_at": datetime.utcnow() + timedelta(seconds=data.get("expires_in", 3600)),
+    }
+
+
+async def token_scopes(access_token: str) -> str:
+    """Space separated scopes granted to an access token."""
+    response = await get_http_client().get(TOKENINFO_URL, params={"access_token": access_token})
+    return response.json().get("scope", "")
+
+
+@lru_cache(maxsize=1)
+def discovery() -> Dict[str, Any]:
+    with open(DISCOVERY_PATH, encoding="utf-8") as f:
+        return json.load(f)
+
+
+@lru_cache(maxsize=None)
+def method_spec(method_id: str) -> Tuple[str, str]:
+    """("GET", "gmail/v1/users/{userId}/messages/{id}") for "users.messages.get"."""
+    *resources, method = method_id.split(".")
+    node = discovery()
+    for name in resources:
+        node = node["resources"][name]
+    spec = node["methods"][method]
+    return spec["httpMethod"], spec["path"]
+
+
+def method_path(method_id: str, **path_params: str) -> Tuple[str, str]:
+    """HTTP method and root-relative path with the path parameters filled in."""
+    http_method, template = method_spec(method_id)
+    path_params.setdefault("userId", "me")
+    return http_method, template.format(**{k: quote(str(v), safe="") for k, v in path_params.items()})
+
+
+def batch_url() -> str:
+    return discovery()["rootUrl"] + discovery()["batchPath"]
+
+
+def _batch_body(requests: List[Tuple[str, str]], boundary: str) -> bytes:
+    """multipart/mixed body of (content_id, "GET /path?query") sub-requests."""
+    parts = []
+    for content_id, request_line in requests:
+        parts.append(
+            f"--{boundary}\r\n"
+            "Content-Type: application/http\r\n"
+            f"Content-ID: <{content_id}>\r\n\r\n"
+            f"{request_line} HTTP/1.1\r\n\r\n"
+        )
+    parts.append(f"--{boundary}--\r\n")
+    return "".join(parts).encode()
+
+
+def parse_batch_response(content_type: str, body: bytes) -> Dict[str, Tuple[int, dict]]:
+    """{content_id: (status, json body)} from a multipart/mixed batch response."""
+    message = BytesParser().parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+    results: Dict[str, Tuple[int, dict]] = {}
+    for part in message.get_payload() or []:
+        # Responses echo the request id as "<response-{id}>"
+        content_id = (part.get("Content-ID") or "").strip("<>")
+        if content_id.startswith("response-"):
+            content_id = content_id[len("response-"):]
+        raw = part.get_payload(decode=True) or b""
+        head, _, payload = raw.partition(b"\r\n\r\n")
+        if not _:
+            head, _, payload = raw.partition(b"\n\n")
+        status_line = head.split(b"\n", 1)[0].decode(errors="ignore").split()
+        status = int(status_line[1]) if len(status_line) > 1 and status_line[1].isdigit() else 500
+        try:
+            data = json.loads(payload) if payload.strip() else {}
+        except ValueError:
+            data = {}
+        results[content_id] = (status, data)
+    return results
+
+
+class GmailClient:
+    """Gmail API calls for one connected account (`gmail_accounts` document)."""
+
+    def __init__(self, account: dict, on_refresh: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None):
+        self.account = account
+        self.email = account.get("email")
+        self.access_token = account.get("access_token")
+        self.expires_at = parse_expires_at(account.get("expires_at"))
+        self._on_refresh = on_refresh
+        self._refresh_lock = asyncio.Lock()
+
+    def _expired(self) -> bool:
+        if not self.access_token:
+            return True
+        return self.expires_at is not None and datetime.utcnow() >= self.expires_at - TOKEN_EXPIRY_SKEW
+
+    async def refresh(self, stale_token: Optional[str] = None):
+        """
+        Refresh the access token. Concurrent callers are serialised, and a
+        caller whose `stale_token` was already replaced by another coroutine's
+        refresh reuses that token instead of refreshing again (single-flight).
+        """
+        async with self._refresh_lock:
+            if stale_token is not None and self.access_token != stale_token and not self._expired():
+                return
+            token = await refresh_access_token(self.account)
+            self.access_token = token["access_token"]
+            self.expires_at = token["expires_at"]
+            if self._on_refresh:
+                await self._on_refresh(token)
+
+    async def token(self) -> str:
+        if self._expired() and self.account.get("refresh_token"):
+            await self.refresh(stale_token=self.access_token)
+        return self.access_token
+
+    async def call(self, method_id: str, params: Optional[dict] = None, json: Optional[dict] = None, **path_params) -> dict:
+        """Invoke a discovery method, e.g. call("users.messages.get", id=message_id)."""
+        http_method, path = method_path(method_id, **path_params)
+        return await self.request(http_method, discovery()["rootUrl"] + path, params=params, json=json)
+
+    async def request(self, method: str, url: str, params: Optional[dict] = None, json: Optional[dict] = None) -> dict:
+        http = get_http_client()
+        for attempt in range(2):
+            access_token = await self.token()
+            headers = {"Authorization": f"Bearer {access_token}"}
+            response = await http.request(method, url, params=params, json=json, headers=headers)
+            if response.status_code == 401 and attempt == 0 and self.account.get("refresh_token"):
+                # Revoked or clock-skewed token: refresh once and retry
+                await self.refresh(stale_token=access_token)
+                continue
+            if response.status_code >= 400:
+                message, payload = _error_message(response)
+                raise GmailAPIError(response.status_code, message, payload)
+            return response.json() if response.content else {}
+        raise GmailAPIError(401, "Unauthorized after token refresh")
+
+    async def call_spooled(self, method_id: str, params: Optional[dict] = None, **path_params) -> dict:
+        """
+        `call` for responses that may be large (a full message, an attachment):
+        the body is streamed into a temporary file, spilled to disk past
+        GMAIL_SPOOL_BYTES, and parsed from there instead of being buffered.
+        """
+        http_method, path = method_path(method_id, **path_params)
+        url = discovery()["rootUrl"] + path
+        http = get_http_client()
+        for attempt in range(2):
+            access_token = await self.token()
+            headers = {"Authorization": f"Bearer {access_token}"}
+            async with http.stream(http_method, url, params=params, headers=headers) as response:
+                if response.status_code == 401 and attempt == 0 and self.account.get("refresh_token"):
+                    await self.refresh(stale_token=access_token)
+                    continue
+                if response.status_code >= 400:
+                    await response.aread()
+                    message, payload = _error_message(response)
+                    raise GmailAPIError(response.status_code, message, payload)
+                with tempfile.SpooledTemporaryFile(max_size=GMAIL_SPOOL_BYTES) as spool:
+                    async for chunk in response.aiter_bytes():
+                        spool.write(chunk)
+                    if not spool.tell():
+                        return {}
+                    spool.seek(0)
+                    return json.load(spool)
+        raise GmailAPIError(401, "Unauthorized after token refresh")
+
+    async def history_list(
+        self,
+        start_history_id: str,
+        page_token: Optional[str] = None,
+        history_types: Optional[List[str]] = None,
+        label_id: Optional[str] = None,
+        max_results: Optional[int] = None,
+    ) -> dict:
+        params: Dict[str, Any] = {"startHistoryId": start_history_id}
+        if page_token:
+            params["pageToken"] = page_token
+        if history_types:
+            params["historyTypes"] = history_types
+        if label_id:
+            params["labelId"] = label_id
+        if max_results:
+            params["maxResults"] = max_results
+        return await self.call("users.history.list", params=params)
+
+    async def history_list_all(
+        self,
+        start_history_id: str,
+        history_types: Optional[List[str]] = None,
+        label_id: Optional[str] = None,
+    ) -> dict:
+        """
+        Every history page since `start_history_id`, merged. The returned
+        `historyId` is the mailbox's current one, from the last page.
+        """
+        records: List[dict] = []
+        page_token = None
+        while True:
+            page = await self.history_list(
+                start_history_id,
+                page_token=page_token,
+                history_types=history_types,
+                label_id=label_id,
+                max_results=HISTORY_PAGE_SIZE,
+            )
+            records.extend(page.get("history", []))
+            page_token = page.get("nextPageToken")
+            if not page_token:
+                return {"history": records, "historyId": page.get("historyId")}
+
+    async def messages_list(
+        self,
+        max_results: Optional[int] = None,
+        page_token: Optional[str] = None,
+        q: Optional[str] = None,
+        label_ids: Optional[List[str]] = None,
+    ) -> dict:
+        params: Dict[str, Any] = {}
+        if max_results:
+            params["maxResults"] = max_results
+        if page_token:
+            params["pageToken"] = page_token
+        if q:
+            params["q"] = q
+        if label_ids:
+            params["labelIds"] = label_ids
+        return await self.call("users.messages.list", params=params)
+
+    async def message_ids(self, q: Optional[str] = None, label_ids: Optional[List[str]] = None, limit: int = 500) -> List[str]:
+        """Ids of up to `limit` matching messages, newest first, across pages."""
+        ids: List[str] = []
+        page_token = None
+        while len(ids) < limit:
+            page = await self.messages_list(
+                max_results=min(limit - len(ids), 500), page_token=page_token, q=q, label_ids=label_ids
+            )
+            ids.extend(m["id"] for m in page.get("messages", []))
+            page_token = page.get("nextPageToken")
+            if not page_token:
+                break
+        return ids[:limit]
+
+    async def messages_get(
+        self,
+        message_id: str,
+        format: str = "full",
+        metadata_headers: Optional[List[str]] = None,
+        spool: bool = False,
+    ) -> dict:
+        """One message; `spool` streams the response (see call_spooled) for large mail."""
+        params: Dict[str, Any] = {"format": format}
+        if metadata_headers:
+            params["metadataHeaders"] = metadata_headers
+        if spool:
+            return await self.call_spooled("users.messages.get", params=params, id=message_id)
+        return await self.call("users.messages.get", params=params, id=message_id)
+
+    async def attachments_get(self, message_id: str, attachment_id: str) -> dict:
+        """{"size": int, "data": base64url} for one attachment."""
+        return await self.call_spooled("users.messages.attachments.get", messageId=message_id, id=attachment_id)
+
+    async def messages_send(self, raw: str, thread_id: Optional[str] = None) -> dict:
+        body = {"raw": raw}
+        if thread_id:
+            body["threadId"] = thread_id
+        return await self.call("users.messages.send", json=body)
+
+    async def watch(self, topic_name: str, label_ids: Optional[List[str]] = None) -> dict:
+        return await self.call("users.watch", json={"topicName": topic_name, "labelIds": label_ids or ["INBOX"]})
+
+    async def stop(self) -> dict:
+        return await self.call("users.stop")
+
+    async def get_profile(self) -> dict:
+        return await self.call("users.getProfile")
+
+    async def _batch(self, requests: List[Tuple[str, str]]) -> Tuple[str, Dict[str, Tuple[int, dict]]]:
+        boundary = f"batch_{uuid.uuid4().hex}"
+        access_token = await self.token()
+        response = await get_http_client().post(
+            batch_url(),
+            content=_batch_body(requests, boundary),
+            headers={
+                "Authorization": f"Bearer {access_token}",
+                "Content-Type": f"multipart/mixed; boundary={boundary}",
+            },
+        )
+        if response.status_code >= 400:
+            message, payload = _error_message(response)
+            raise GmailAPIError(response.status_code, message, payload)
+        return access_token, parse_batch_response(response.headers.get("content-type", ""), response.content)
+
+    async def messages_get_many(
+        self,
+        message_ids: Iterable[str],
+        format: str = "full",
+        metadata_headers: Optional[List[str]] = None,
+    ) -> Dict[str, dict]:
+        """
+        Fetch many messages with multipart batch requests of GMAIL_BATCH_SIZE
+        ids. Items that fail with a retryable status are retried on their own
+        (with backoff); other failures (e.g. 404) are logged and left out of
+        the result. Raises GmailBatchIncomplete, carrying what was fetched,
+        when retryable items remain after GMAIL_BATCH_RETRIES.
+        """
+        params: List[Tuple[str, str]] = [("format", format)]
+        params += [("metadataHeaders", h) for h in metadata_headers or []]
+        query = urlencode(params)
+
+        pending = list(dict.fromkeys(message_ids))
+        fetched: Dict[str, dict] = {}
+        for attempt in range(GMAIL_BATCH_RETRIES + 1):
+            if not pending:
+                break
+            if attempt:
+                await asyncio.sleep(min(0.5 * 2 ** attempt, 8))
+            retry: List[str] = []
+            for start in range(0, len(pending), GMAIL_BATCH_SIZE):
+                chunk = pending[start:start + GMAIL_BATCH_SIZE]
+                access_token, results = await self._batch([
+                    (message_id, "{} /{}?{}".format(*method_path("users.messages.get", id=message_id), query))
+                    for message_id in chunk
+                ])
+                for message_id in chunk:
+                    status, data = results.get(message_id, (500, {}))
+                    if status == 200:
+                        fetched[message_id] = data
+                    elif status in RETRYABLE_STATUSES:
+                        retry.append(message_id)
+                    else:
+                        logger.warning("Gmail batch get %s for %s failed: %s", message_id, self.email, status)
+                if any(results.get(m, (0,))[0] == 401 for m in chunk) and self.account.get("refresh_token"):
+                    await self.refresh(stale_token=access_token)
+            pending = retry
+        if pending:
+            logger.error("Gmail batch get gave up on %d messages for %s", len(pending), self.email)
+            raise GmailBatchIncomplete(pending, fetched)
+        return fetched
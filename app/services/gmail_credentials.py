@@ -0,0 +1,70 @@
+# app/services/gmail_credentials.py
+"""
+Per-account Gmail clients with live, persisted credentials.
+
+`gmail_client_for(db, account)` hands out one cached `GmailClient` per
+connected account. The client keeps its access token until shortly before
+expiry, refreshes it single-flight (concurrent requests for the same account
+share one refresh) and writes the new token and `expires_at` back to
+`gmail_accounts`, so the next process start, or another worker, picks it up
+instead of refreshing again.
+"""
+import os
+from typing import Any, Dict
+
+from bson import ObjectId
+from cachetools import LRUCache
+
+from app.services.gmail_client import GmailClient, parse_expires_at
+from app.utils.logger import logger
+
+GMAIL_CLIENT_CACHE_SIZE = int(os.getenv("GMAIL_CLIENT_CACHE_SIZE", "2048"))
+
+_clients: LRUCache = LRUCache(maxsize=GMAIL_CLIENT_CACHE_SIZE)
+
+
+def _persist_refresh(db, account_id: ObjectId):
+    async def persist(token: Dict[str, Any]):
+        await db["gmail_accounts"].update_one(
+            {"_id": account_id},
+            {"$set": {
+                "access_token": token["access_token"],
+                "expires_at": token["expires_at"],
+                "status": "connected",
+            }},
+        )
+        logger.info("Refreshed Gmail token for account %s", account_id)
+    return persist
+
+
+async def gmail_client_for(db, account: dict) -> GmailClient:
+    """The shared client for a `gmail_accounts` document."""
+    account_id = account.get("_id")
+    if account_id is None:
+        # Not stored yet (e.g. during the OAuth callback): nothing to cache or persist
+        return GmailClient(account)
+
+    client = _clients.get(account_id)
+    if client is not None and client.account.get("refresh_token") != account.get("refresh_token"):
+        # Reconnected with a new grant
+        client = None
+    if client is None:
+        client = GmailClient(account, on_refresh=_persist_refresh(db, account_id))
+        _clients[account_id] = client
+        return client
+
+    # Another worker may have refreshed and persisted a newer token
+    stored_expiry = parse_expires_at(account.get("expires_at"))
+    if (
+        account.get("access_token") != client.access_token
+        and stored_expiry
+        and (client.expires_at is None or stored_expiry > client.expires_at)
+    ):
+        client.access_token = account["access_token"]
+        client.expires_at = stored_expiry
+    return client
+
+
+def invalidate_gmail_client(account_id: Any):
+    """Call when an account is deleted or reconnected."""
+    _clients.pop(ObjectId(str(account_id)), None)
@@ -0,0 +1,222 @@
+# app/services/gmail_hydration.py
+"""
+Two-phase Gmail ingestion.
+
+Phase one fetches messages with `format=metadata` (labels, thread id, the four
+headers we use and Gmail's snippet), which is enough to filter, thread and
+ticket a message. The entry is stored with the snippet as its content,
+`metadata.body_pending` and Gmail's `sizeEstimate` (`metadata.size_estimate`).
+
+Phase two fetches `format=full` and replaces the snippet with the decoded,
+size-capped body (app.services.gmail_mime): in the background right after
+ingestion, or at the latest when the thread is opened or analysed
+(`ensure_hydrated`). Small messages are fetched in batches; messages estimated
+over GMAIL_HYDRATE_LARGE_BYTES are fetched one at a time with a streamed
+response, so only one of them is held in memory at once.
+"""
+import asyncio
+import os
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+
+from app.db import files, threads
+from app.models.message import ChatEntry
+from app.services.gmail_client import GmailAPIError, GmailBatchIncomplete
+from app.services.gmail_credentials import gmail_client_for
+from app.services.gmail_mime import extract_body, iter_body
+from app.utils.logger import logger
+
+METADATA_HEADERS = ["Subject", "From", "To", "Date"]
+BODY_PENDING = "body_pending"
+
+GMAIL_HYDRATE_IN_BACKGROUND = os.getenv("GMAIL_HYDRATE_IN_BACKGROUND", "true").lower() == "true"
+GMAIL_HYDRATE_CONCURRENCY = int(os.getenv("GMAIL_HYDRATE_CONCURRENCY", "4"))
+GMAIL_HYDRATE_BATCH_SIZE = int(os.getenv("GMAIL_HYDRATE_BATCH_SIZE", "10"))
+# Messages whose sizeEstimate exceeds this are fetched on their own, streamed
+GMAIL_HYDRATE_LARGE_BYTES = int(os.getenv("GMAIL_HYDRATE_LARGE_BYTES", str(1024 * 1024)))
+
+_hydrate_slots: Optional[asyncio.Semaphore] = None
+_background: set = set()
+
+
+def message_headers(msg: dict) -> Dict[str, str]:
+    """First value of each METADATA_HEADERS header."""
+    headers: Dict[str, str] = {}
+    for h in (msg.get("payload") or {}).get("headers", []):
+        if h.get("name") in METADATA_HEADERS:
+            headers.setdefault(h["name"], h.get("value", ""))
+    return headers
+
+
+def metadata_entry(msg: dict, account: dict, timestamp: datetime) -> ChatEntry:
+    """Entry for a `format=metadata` message: the snippet stands in for the body."""
+    headers = message_headers(msg)
+    return ChatEntry(
+        sender=headers.get("From", ""),
+        recipient=headers.get("To", ""),
+        content=msg.get("snippet", ""),
+        title=headers.get("Subject", ""),
+        timestamp=timestamp,
+        channel="email",
+        message_type="html",
+        metadata={
+            "gmail_id": msg["id"],
+            "from": headers.get("From", ""),
+            "to": headers.get("To", ""),
+            "subject": headers.get("Subject", ""),
+            "date": headers.get("Date", ""),
+            "gmail_account_id": str(account["_id"]),
+            "size_estimate": msg.get("sizeEstimate"),
+            BODY_PENDING: True,
+        },
+    )
+
+
+async def store_large_body(db, gmail_id: str, body: Dict[str, Any]) -> ObjectId:
+    """Stream the full (over-cap) body into GridFS."""
+    html = body["message_type"] == "html"
+    return await files.upload_chunks(
+        db,
+        f"{gmail_id}.{'html' if html else 'txt'}",
+        iter_body(body["parts"], b"" if html else b"\n"),
+        metadata={
+            "gmail_id": gmail_id,
+            "content_type": f"text/{'html' if html else 'plain'}; charset={body['charset']}",
+        },
+    )
+
+
+def apply_fields(entry: dict, fields: Dict[str, Any]):
+    """Mirror an update_entry `fields` dict onto an in-memory entry."""
+    for path, value in fields.items():
+        if path.startswith("metadata."):
+            entry.setdefault("metadata", {})[path[len("metadata."):]] = value
+        else:
+            entry[path] = value
+
+
+async def _store_body(db, thread_id: ObjectId, gmail_id: str, msg: dict) -> Dict[str, Any]:
+    body = extract_body(msg.get("payload") or {})
+    fields: Dict[str, Any] = {}
+    if body["content"]:
+        # No body part at all (e.g. attachment-only mail): keep the snippet
+        fields = {"content": body["content"], "message_type": body["message_type"]}
+    if body["attachments"]:
+        fields["metadata.attachments"] = body["attachments"]
+    if body["truncated"]:
+        file_id = await store_large_body(db, gmail_id, body)
+        fields["metadata.body_file_id"] = str(file_id)
+        fields["metadata.body_size"] = body["size"]
+    await threads.update_entry(db, thread_id, gmail_id, fields, unset=(f"metadata.{BODY_PENDING}",))
+    return fields
+
+
+async def hydrate_bodies(
+    db,
+    account: dict,
+    items: List[Tuple[ObjectId, str]],
+    sizes: Optional[Dict[str, int]] = None,
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Fetch full bodies for (thread _id, gmail id) pairs and store them on the
+    entries: the capped body, attachment metadata and, for bodies over the
+    cap, a GridFS file holding the whole body. Returns the stored entry fields
+    per gmail id; messages Gmail did not return stay pending.
+
+    `sizes` holds the metadata-phase sizeEstimate per gmail id; messages over
+    GMAIL_HYDRATE_LARGE_BYTES are fetched one by one instead of in a batch.
+    """
+    gmail = await gmail_client_for(db, account)
+    sizes = sizes or {}
+    large = [(t, g) for t, g in items if (sizes.get(g) or 0) > GMAIL_HYDRATE_LARGE_BYTES]
+    small = [(t, g) for t, g in items if (sizes.get(g) or 0) <= GMAIL_HYDRATE_LARGE_BYTES]
+    hydrated: Dict[str, Dict[str, Any]] = {}
+    # Small slices: only a few full messages are held in memory at a time
+    for start in range(0, len(small), GMAIL_HYDRATE_BATCH_SIZE):
+        chunk = small[start:start + GMAIL_HYDRATE_BATCH_SIZE]
+        try:
+            fetched = await gmail.messages_get_many([gmail_id for _, gmail_id in chunk], format="full")
+        except GmailBatchIncomplete as e:
+            # The rest stay pending and are fetched when the thread is opened
+            fetched = e.fetched
+        for thread_id, gmail_id in chunk:
+            msg = fetched.pop(gmail_id, None)
+            if msg is not None:
+                hydrated[gmail_id] = await _store_body(db, thread_id, gmail_id, msg)
+
+    for thread_id, gmail_id in large:
+        try:
+            msg = await gmail.messages_get(gmail_id, format="full", spool=True)
+        except GmailAPIError as e:
+            logger.warning("Gmail get %s for %s failed: %s", gmail_id, account.get("email"), e)
+            continue
+        hydrated[gmail_id] = await _store_body(db, thread_id, gmail_id, msg)
+    return hydrated
+
+
+async def _hydrate_later(db, account: dict, items: List[Tuple[ObjectId, str]], sizes: Dict[str, int]):
+    global _hydrate_slots
+    if _hydrate_slots is None:
+        _hydrate_slots = asyncio.Semaphore(GMAIL_HYDRATE_CONCURRENCY)
+    async with _hydrate_slots:
+        try:
+            await hydrate_bodies(db, account, items, sizes)
+        except Exception:
+            # Left pending; ensure_hydrated retries when the thread is opened
+            logger.warning("Background hydration failed for %s", account.get("email"), exc_info=True)
+
+
+def schedule_hydration(
+    db,
+    account: dict,
+    items: List[Tuple[ObjectId, str]],
+    sizes: Optional[Dict[str, int]] = None,
+):
+    """Hydrate in the background, off the ingestion path (GMAIL_HYDRATE_IN_BACKGROUND)."""
+    if not items or not GMAIL_HYDRATE_IN_BACKGROUND:
+        return
+    task = asyncio.create_task(_hydrate_later(db, account, items, sizes or {}))
+    # Keep a reference until done so the task is not garbage-collected mid-flight
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+
+async def ensure_hydrated(db, thread: dict) -> dict:
+    """
+    Hydrate any still-pending email entries of a loaded thread (see
+    threads.load_thread) and patch them in place. Failures leave the snippet.
+    """
+    pending = [
+        e for e in thread.get("messages") or []
+        if (e.get("metadata") or {}).get(BODY_PENDING) and e["metadata"].get("gmail_id")
+    ]
+    if not pending:
+        return thread
+
+    by_account: Dict[Any, List[dict]] = {}
+    for entry in pending:
+        by_account.setdefault(entry["metadata"].get("gmail_account_id"), []).append(entry)
+
+    for account_id, entries in by_account.items():
+        query = {"_id": ObjectId(account_id)} if account_id else {"user_id": thread.get("user_id")}
+        account = await db["gmail_accounts"].find_one(query)
+        if not account:
+            continue
+        try:
+            hydrated = await hydrate_bodies(
+                db,
+                account,
+                [(thread["_id"], e["metadata"]["gmail_id"]) for e in entries],
+                {e["metadata"]["gmail_id"]: e["metadata"].get("size_estimate") for e in entries},
+            )
+        except Exception:
+            logger.warning("Hydration on open failed for thread %s", thread["_id"], exc_info=True)
+            continue
+        for entry in entries:
+            fields = hydrated.get(entry["metadata"]["gmail_id"])
+            if fields is not None:
+                apply_fields(entry, fields)
+                entry["metadata"].pop(BODY_PENDING, None)
+    return thread
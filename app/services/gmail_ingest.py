@@ -0,0 +1,248 @@
+# app/services/gmail_ingest.py
+"""
+Gmail mailbox ingestion: turn the history since an account's stored
+`history_id` into thread entries. Runs from the notification queue workers
+(app.services.gmail_queue), never inside the Pub/Sub push request.
+"""
+import calendar
+import os
+import re
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from typing import List, Optional, Tuple
+
+from bson import ObjectId
+
+from app.db import threads
+from app.services.gmail_client import GmailAPIError
+from app.services.gmail_credentials import gmail_client_for
+from app.services.gmail_hydration import METADATA_HEADERS, message_headers, metadata_entry, schedule_hydration
+from app.services.ticket_service import next_ticket_number
+from app.socket import emitter
+from app.utils.logger import logger
+
+# Bounded resync when the stored historyId is older than Gmail's history window
+GMAIL_RESYNC_DAYS = int(os.getenv("GMAIL_RESYNC_DAYS", "7"))
+GMAIL_RESYNC_MAX_MESSAGES = int(os.getenv("GMAIL_RESYNC_MAX_MESSAGES", "500"))
+
+
+async def emit_gmail_update(payload: dict):
+    # Through app.socket.emitter: this also runs in the standalone pull worker
+    await emitter.emit("gmail_update", payload)
+
+
+def as_history_id(value) -> int:
+    """Stored history ids are ints, or strings from older watch responses."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+async def advance_history_id(db, account_id, history_id: int) -> bool:
+    """
+    Monotonic compare-and-set of the account's history_id: only moves forward,
+    so a slow, older pass can never rewind it. Returns whether it moved.
+    """
+    result = await db["gmail_accounts"].update_one(
+        {
+            "_id": account_id,
+            "$expr": {"$lt": [
+                {"$convert": {"input": "$history_id", "to": "long", "onError": 0, "onNull": 0}},
+                history_id,
+            ]},
+        },
+        {"$set": {"history_id": history_id}},
+    )
+    return result.modified_count == 1
+
+
+async def added_inbox_message_ids(gmail, account: dict, start_history_id: int) -> Tuple[List[str], int]:
+    """
+    Ids of messages added to INBOX since `start_history_id`, oldest first, and
+    the mailbox's current historyId. Follows every history page, asking Gmail
+    for messageAdded records on INBOX only.
+
+    Gmail keeps roughly a week of history; when the start id has expired (404)
+    this falls back to a bounded resync of recent INBOX mail. Already stored
+    messages are skipped by upsert_entry's dedupe keys, so the overlap is safe.
+    """
+    try:
+        results = await gmail.history_list_all(start_history_id, history_types=["messageAdded"], label_id="INBOX")
+    except GmailAPIError as e:
+        if e.status_code != 404:
+            raise
+        logger.warning(
+            "historyId %s expired for %s; resyncing the last %d days of INBOX",
+            start_history_id, account["email"], GMAIL_RESYNC_DAYS,
+        )
+        # Profile first: anything arriving during the resync is picked up by the next pass
+        current_history_id = as_history_id((await gmail.get_profile()).get("historyId"))
+        since = datetime.utcnow() - timedelta(days=GMAIL_RESYNC_DAYS)
+        ids = await gmail.message_ids(
+            q=f"after:{calendar.timegm(since.timetuple())}", label_ids=["INBOX"], limit=GMAIL_RESYNC_MAX_MESSAGES
+        )
+        return list(reversed(ids)), current_history_id
+
+    added_ids = list(dict.fromkeys(
+        added["message"]["id"]
+        for record in results["history"]
+        for added in record.get("messagesAdded", [])
+    ))
+    return added_ids, as_history_id(results.get("historyId"))
+
+
+async def ingest_messages(
+    db,
+    account: dict,
+    gmail,
+    message_ids: List[str],
+    older: bool = False,
+    hydrate: bool = True,
+    closed_before: Optional[datetime] = None,
+) -> List[Tuple[ObjectId, str]]:
+    """
+    Store INBOX messages as thread entries, creating threads (and tickets) as
+    needed; ids already stored are skipped. Returns (thread _id, gmail id) of
+    the new entries.
+
+    Phase one fetches metadata only (labels, thread, headers, snippet), with
+    multipart batch requests instead of one serial GET per message. Phase two,
+    the full bodies, is scheduled in the background when `hydrate`, and
+    otherwise happens when a thread is opened. `older` marks backfilled mail
+    that predates what the threads already hold (see threads.upsert_entry).
+
+    A thread created from mail older than `closed_before` (naive UTC) is
+    history, not a new conversation: it is stored as Closed and gets no ticket.
+    Live mail appended to such a thread reopens it and gives it a ticket.
+    """
+    user_id = account["user_id"]
+    company_id = account["company_id"]
+    fetched = await gmail.messages_get_many(message_ids, format="metadata", metadata_headers=METADATA_HEADERS)
+
+    ingested: List[Tuple[ObjectId, str]] = []
+    for gmail_id in message_ids:
+        msg = fetched.get(gmail_id)
+        if msg is None:
+            continue
+
+        labels = msg.get("labelIds", [])
+        if "INBOX" not in labels:
+            continue
+        thread_id = msg.get("threadId", gmail_id)
+        headers = message_headers(msg)
+        subject = headers.get("Subject", "")
+        sender = headers.get("From", "")
+        to = headers.get("To", "")
+
+        try:
+            timestamp = parsedate_to_datetime(headers.get("Date", ""))
+        except Exception:
+            timestamp = datetime.utcnow()
+
+        chat_entry = metadata_entry(msg, account, timestamp)
+        utc_timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None) if timestamp.tzinfo else timestamp
+        historical = closed_before is not None and utc_timestamp < closed_before
+
+        shopify_order_match = re.search(r"#([A-Z]{2}\d+)", subject or chat_entry.content or "")
+        shopify_order = shopify_order_match.group(1) if shopify_order_match else None
+
+        # One atomic upsert: creates the thread or appends to it, and
+        # rejects a Gmail message id that is already stored.
+        result = await threads.upsert_entry(
+            db,
+            {"user_id": ObjectId(user_id), "thread_id": thread_id, "channel": "email"},
+            chat_entry.dict(),
+            on_insert={
+                "company_id": ObjectId(company_id),
+                "status": "Closed" if historical else "Open",
+                "client": sender,
+                "agent": to,
+                "started_at": timestamp,
+                "ai_summary": None,
+                "tags": [],
+                "resolved_by_ai": False
+            },
+            set_fields={"last_updated": timestamp, "title": subject},
+            add_participants=[sender, to],
+            older=older,
+        )
+        if result is None:
+            logger.debug("Duplicate Gmail %s ignored for thread %s", gmail_id, thread_id)
+            continue
+
+        thread_oid, created = result
+        if created and not historical:
+            # Generate new ticket number
+            ticket_number = await next_ticket_number(db, ObjectId(company_id))
+            logger.info(f"Creating new ticket {ticket_number} for order {shopify_order}")
+            await db["messages"].update_one({"_id": thread_oid}, {"$set": {"ticket": ticket_number}})
+        elif not created and not older and not historical:
+            # New mail on a thread the backfill stored as history: it is live again
+            if await db["messages"].find_one({"_id": thread_oid, "ticket": {"$exists": False}}, {"_id": 1}):
+                ticket_number = await next_ticket_number(db, ObjectId(company_id))
+                reopened = await db["messages"].update_one(
+                    {"_id": thread_oid, "ticket": {"$exists": False}},
+                    {"$set": {"ticket": ticket_number, "status": "Open"}},
+                )
+                if reopened.modified_count:
+                    logger.info(f"Reopened thread {thread_oid} as ticket {ticket_number}")
+        ingested.append((thread_oid, gmail_id))
+
+    if hydrate:
+        sizes = {gmail_id: fetched[gmail_id].get("sizeEstimate") for _, gmail_id in ingested}
+        schedule_hydration(db, account, ingested, sizes)
+    return ingested
+
+
+async def sync_mailbox(db, account: dict, history_id):
+    """
+    Ingest INBOX messages added since the account's stored history_id, then
+    advance it to the mailbox's current historyId (at least `history_id`).
+    Gmail errors propagate so the caller can retry.
+
+    `history_id` is the highest id seen in the notifications coalesced into
+    this pass; if the stored one has already reached it there is nothing to do.
+    """
+    email_address = account["email"]
+    user_id = account["user_id"]
+    company_id = account["company_id"]
+    history_id = as_history_id(history_id)
+
+    last_history_id = as_history_id(account.get("history_id"))
+    if last_history_id and last_history_id >= history_id:
+        logger.debug("%s already synced to historyId=%s (target %s)", email_address, last_history_id, history_id)
+        return
+
+    gmail = await gmail_client_for(db, account)
+
+    if not last_history_id:
+        logger.debug("No stored historyId for %s. Skipping history fetch.", email_address)
+    else:
+        try:
+            added_ids, current_history_id = await added_inbox_message_ids(gmail, account, last_history_id)
+        except Exception:
+            logger.error("Failed fetching Gmail history for %s", email_address, exc_info=True)
+            raise
+        history_id = max(history_id, current_history_id)
+
+        try:
+            ingested = await ingest_messages(db, account, gmail, added_ids)
+        except Exception:
+            logger.error("Failed fetching Gmail messages for %s", email_address, exc_info=True)
+            raise
+
+        # One UI refresh per pass, however many notifications it covers
+        if ingested:
+            await emit_gmail_update(
+                {
+                    "user_id": str(user_id),
+                    "company_id": str(company_id),
+                    "email": email_address,
+                    "message": f"New messages pushed for {email_address}"
+                }
+            )
+
+    await advance_history_id(db, account["_id"], history_id)
+
+    logger.info("✅ Processed Gmail Pub/Sub for %s up to historyId=%s", email_address, history_id)
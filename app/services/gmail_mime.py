@@ -0,0 +1,157 @@
+# app/services/gmail_mime.py
+"""
+Body extraction for Gmail `format=full` payloads.
+
+The part tree is walked iteratively (no recursion limit on deeply nested
+mail). Attachments are recorded from their headers only; Gmail leaves their
+data behind an attachmentId and it is never fetched here. Text bodies are
+decoded only up to GMAIL_BODY_PART_MAX_BYTES per part and
+GMAIL_BODY_MAX_BYTES per message; when a body is larger the entry keeps that
+prefix and `iter_body` streams the whole body (in fixed-size chunks) into
+GridFS (app.db.files) for download.
+"""
+import base64
+import codecs
+import os
+from typing import Any, Dict, Iterator, List
+
+GMAIL_BODY_PART_MAX_BYTES = int(os.getenv("GMAIL_BODY_PART_MAX_BYTES", str(256 * 1024)))
+GMAIL_BODY_MAX_BYTES = int(os.getenv("GMAIL_BODY_MAX_BYTES", str(512 * 1024)))
+# base64 characters decoded per step when streaming a body (multiple of 4)
+DECODE_CHUNK_CHARS = 256 * 1024
+
+
+def walk_parts(payload: dict) -> Iterator[dict]:
+    """Leaf parts of a payload, depth-first in document order."""
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        children = part.get("parts")
+        if children:
+            stack.extend(reversed(children))
+        else:
+            yield part
+
+
+def part_header(part: dict, name: str) -> str:
+    name = name.lower()
+    return next((h.get("value", "") for h in part.get("headers", []) if h.get("name", "").lower() == name), "")
+
+
+def part_charset(part: dict) -> str:
+    for param in part_header(part, "Content-Type").split(";")[1:]:
+        key, _, value = param.strip().partition("=")
+        if key.lower() == "charset" and value:
+            charset = value.strip().strip('"')
+            try:
+                return codecs.lookup(charset).name
+            except LookupError:
+                break
+    return "utf-8"
+
+
+def part_size(part: dict) -> int:
+    """Decoded size, from Gmail's `body.size` without decoding."""
+    body = part.get("body") or {}
+    return int(body.get("size") or len(body.get("data", "")) * 3 // 4)
+
+
+def is_attachment(part: dict) -> bool:
+    body = part.get("body") or {}
+    return bool(part.get("filename") or body.get("attachmentId"))
+
+
+def attachment_info(part: dict) -> Dict[str, Any]:
+    body = part.get("body") or {}
+    info = {
+        "filename": part.get("filename") or "",
+        "mime_type": part.get("mimeType") or "application/octet-stream",
+        "size": int(body.get("size") or 0),
+        "attachment_id": body.get("attachmentId"),
+        "part_id": part.get("partId"),
+    }
+    content_id = part_header(part, "Content-ID").strip("<>")
+    if content_id:
+        info["content_id"] = content_id
+    return info
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def decode_prefix(data: str, limit: int) -> bytes:
+    """The first `limit` decoded bytes, decoding only the base64 needed for them."""
+    chars = -(-limit // 3) * 4
+    return _b64decode(data[:chars])[:limit]
+
+
+def iter_decoded(data: str) -> Iterator[bytes]:
+    for start in range(0, len(data), DECODE_CHUNK_CHARS):
+        yield _b64decode(data[start:start + DECODE_CHUNK_CHARS])
+
+
+def extract_body(
+    payload: dict,
+    part_limit: int = GMAIL_BODY_PART_MAX_BYTES,
+    total_limit: int = GMAIL_BODY_MAX_BYTES,
+) -> Dict[str, Any]:
+    """
+    Capped body of a message. HTML parts are preferred over plain text (the
+    usual multipart/alternative pair); several parts of the chosen kind are
+    concatenated in order.
+
+    Returns content, message_type ("html" or "text"), size (full decoded size
+    of the chosen parts), truncated, charset, parts (to stream with
+    `iter_body`) and attachments.
+    """
+    html_parts: List[dict] = []
+    text_parts: List[dict] = []
+    attachments: List[Dict[str, Any]] = []
+    for part in walk_parts(payload):
+        if is_attachment(part):
+            attachments.append(attachment_info(part))
+            continue
+        if not (part.get("body") or {}).get("data"):
+            continue
+        mime_type = part.get("mimeType")
+        if mime_type == "text/html":
+            html_parts.append(part)
+        elif mime_type == "text/plain":
+            text_parts.append(part)
+
+    parts = html_parts or text_parts
+    separator = "" if html_parts else "\n"
+    pieces: List[str] = []
+    budget = total_limit
+    size = 0
+    truncated = False
+    for part in parts:
+        full = part_size(part)
+        size += full
+        take = min(full, part_limit, budget)
+        if take < full:
+            truncated = True
+        if take <= 0:
+            continue
+        pieces.append(decode_prefix(part["body"]["data"], take).decode(part_charset(part), errors="ignore"))
+        budget -= take
+
+    return {
+        "content": separator.join(pieces),
+        "message_type": "html" if html_parts else "text",
+        "size": size,
+        "truncated": truncated,
+        "charset": part_charset(parts[0]) if parts else "utf-8",
+        "parts": parts,
+        "attachments": attachments,
+    }
+
+
+def iter_body(parts: List[dict], separator: bytes = b"") -> Iterator[bytes]:
+    """Every chosen part fully decoded, chunk by chunk."""
+    for i, part in enumerate(parts):
+        if i and separator:
+            yield separator
+        yield from iter_decoded(part["body"]["data"])
+
@@ -0,0 +1,256 @@
+# app/services/gmail_queue.py
+"""
+Durable queue between the Gmail Pub/Sub push endpoint and mailbox ingestion.
+
+The push handler only validates the notification and `enqueue`s it, so Pub/Sub
+gets its 2xx immediately. A pool of async workers (started from the app
+lifespan) drains `gmail_notifications`:
+
+  - notifications are coalesced: an account has at most one pending item, and
+    each further notification only raises its target `history_id`. While a
+    pass for the account runs, new notifications collect in that one pending
+    item, which becomes the single follow-up pass;
+  - claiming is an atomic find_one_and_update that takes a time-limited lease,
+    so a crashed worker's items become claimable again;
+  - each account is processed by one worker at a time, across processes, via a
+    lease on its `gmail_accounts` document; a heartbeat extends both leases
+    while the pass runs, however long it takes;
+  - failures are retried with exponential backoff up to GMAIL_QUEUE_MAX_ATTEMPTS,
+    then parked as "failed";
+  - finished items expire through a TTL index on `done_at`.
+"""
+import asyncio
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from app.services.gmail_ingest import sync_mailbox
+from app.utils.logger import logger
+
+QUEUE_COLLECTION = "gmail_notifications"
+
+GMAIL_QUEUE_WORKERS = int(os.getenv("GMAIL_QUEUE_WORKERS", "4"))
+GMAIL_QUEUE_MAX_ATTEMPTS = int(os.getenv("GMAIL_QUEUE_MAX_ATTEMPTS", "8"))
+GMAIL_QUEUE_LEASE = timedelta(seconds=int(os.getenv("GMAIL_QUEUE_LEASE_SECONDS", "300")))
+GMAIL_QUEUE_POLL_SECONDS = float(os.getenv("GMAIL_QUEUE_POLL_SECONDS", "2"))
+BACKOFF_BASE_SECONDS = 5
+BACKOFF_MAX_SECONDS = 600
+# Retry delay when the account is busy in another worker
+ACCOUNT_BUSY_DELAY = timedelta(seconds=2)
+
+PENDING, PROCESSING, DONE, FAILED = "pending", "processing", "done", "failed"
+
+_wakeup: Optional[asyncio.Event] = None
+_workers: List[asyncio.Task] = []
+_worker_prefix = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _event() -> asyncio.Event:
+    global _wakeup
+    if _wakeup is None:
+        _wakeup = asyncio.Event()
+    return _wakeup
+
+
+def backoff(attempts: int) -> timedelta:
+    return timedelta(seconds=min(BACKOFF_BASE_SECONDS * 2 ** max(attempts - 1, 0), BACKOFF_MAX_SECONDS))
+
+
+async def enqueue(db, email_address: str, history_id: Any):
+    """
+    Record a Gmail notification by raising the target history_id of the
+    account's pending item, creating it if there is none. Redeliveries are no-ops.
+    """
+    now = datetime.utcnow()
+    for attempt in range(2):
+        try:
+            await db[QUEUE_COLLECTION].update_one(
+                {"email": email_address, "status": PENDING},
+                {
+                    "$max": {"history_id": int(history_id)},
+                    "$inc": {"notifications": 1},
+                    "$setOnInsert": {"attempts": 0, "available_at": now, "created_at": now},
+                },
+                upsert=True,
+            )
+            break
+        except DuplicateKeyError:
+            # Lost an insert race on email_pending; the retry updates the winner
+            if attempt:
+                raise
+    _event().set()
+
+
+async def _claim(db, worker: str) -> Optional[dict]:
+    now = datetime.utcnow()
+    return await db[QUEUE_COLLECTION].find_one_and_update(
+        {"$or": [
+            {"status": PENDING, "available_at": {"$lte": now}},
+            # Lease expired: the worker holding it died mid-item
+            {"status": PROCESSING, "lease_until": {"$lt": now}},
+        ]},
+        {"$set": {"status": PROCESSING, "lease_until": now + GMAIL_QUEUE_LEASE, "worker": worker, "started_at": now}},
+        sort=[("available_at", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+async def _lock_account(db, email_address: str, worker: str) -> Optional[dict]:
+    """Lease the account for `worker`; None if missing or leased elsewhere."""
+    now = datetime.utcnow()
+    return await db["gmail_accounts"].find_one_and_update(
+        {
+            "email": email_address,
+            "$or": [{"sync_lease_until": {"$exists": False}}, {"sync_lease_until": {"$lt": now}}, {"sync_owner": worker}],
+        },
+        {"$set": {"sync_lease_until": now + GMAIL_QUEUE_LEASE, "sync_owner": worker}},
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+async def _unlock_account(db, account_id, worker: str):
+    await db["gmail_accounts"].update_one(
+        {"_id": account_id, "sync_owner": worker},
+        {"$unset": {"sync_lease_until": "", "sync_owner": ""}},
+    )
+
+
+async def _finish(db, item: dict, **fields):
+    await db[QUEUE_COLLECTION].update_one(
+        {"_id": item["_id"], "worker": item["worker"]},
+        {"$set": fields, "$unset": {"lease_until": ""}},
+    )
+
+
+async def _requeue(db, item: dict, **fields):
+    """
+    Put a claimed item back to pending. If a newer pending item for the account
+    arrived meanwhile, fold this one into it instead.
+    """
+    try:
+        await _finish(db, item, status=PENDING, **fields)
+    except DuplicateKeyError:
+        await db[QUEUE_COLLECTION].update_one(
+            {"email": item["email"], "status": PENDING},
+            {
+                "$max": {
+                    "history_id": item["history_id"],
+                    "attempts": fields.get("attempts", 0),
+                    "available_at": fields["available_at"],
+                },
+                "$inc": {"notifications": item.get("notifications", 1)},
+            },
+        )
+        await _finish(db, item, status=DONE, done_at=datetime.utcnow(), coalesced=True)
+
+
+async def _heartbeat(db, item: dict, account_id, worker: str):
+    """Extend the item and account leases while a pass runs, so neither is reclaimed mid-pass."""
+    while True:
+        await asyncio.sleep(GMAIL_QUEUE_LEASE.total_seconds() / 3)
+        lease_until = datetime.utcnow() + GMAIL_QUEUE_LEASE
+        try:
+            await db[QUEUE_COLLECTION].update_one(
+                {"_id": item["_id"], "worker": worker}, {"$set": {"lease_until": lease_until}}
+            )
+            await db["gmail_accounts"].update_one(
+                {"_id": account_id, "sync_owner": worker}, {"$set": {"sync_lease_until": lease_until}}
+            )
+        except Exception:
+            # Try again next beat; the leases still have two beats left
+            logger.warning("Gmail queue heartbeat failed for %s", item["email"], exc_info=True)
+
+
+async def _sync(db, item: dict, account: dict, worker: str):
+    heartbeat = asyncio.create_task(_heartbeat(db, item, account["_id"], worker))
+    try:
+        await sync_mailbox(db, account, item["history_id"])
+    finally:
+        heartbeat.cancel()
+
+
+async def process_item(db, item: dict, worker: str):
+    email_address = item["email"]
+    account = await _lock_account(db, email_address, worker)
+    if account is None:
+        if not await db["gmail_accounts"].find_one({"email": email_address}, {"_id": 1}):
+            logger.info("No account found for %s; dropping notification", email_address)
+            await _finish(db, item, status=DONE, done_at=datetime.utcnow(), error="unknown account")
+        else:
+            # Another worker is syncing this mailbox; this is its follow-up pass
+            await _requeue(db, item, available_at=datetime.utcnow() + ACCOUNT_BUSY_DELAY)
+        return
+
+    try:
+        await _sync(db, item, account, worker)
+    except Exception as e:
+        attempts = item.get("attempts", 0) + 1
+        if attempts >= GMAIL_QUEUE_MAX_ATTEMPTS:
+            logger.error("Gmail notification for %s failed %d times; giving up", email_address, attempts, exc_info=True)
+            await _finish(db, item, status=FAILED, attempts=attempts, error=str(e))
+        else:
+            logger.warning("Gmail notification for %s failed (attempt %d): %s", email_address, attempts, e)
+            await _requeue(
+                db, item, attempts=attempts, error=str(e),
+                available_at=datetime.utcnow() + backoff(attempts),
+            )
+    else:
+        await _finish(db, item, status=DONE, done_at=datetime.utcnow())
+    finally:
+        await _unlock_account(db, account["_id"], worker)
+
+
+async def worker_loop(db, worker: str):
+    wakeup = _event()
+    while True:
+        try:
+            item = await _claim(db, worker)
+        except Exception:
+            logger.error("Gmail queue claim failed", exc_info=True)
+            item = None
+        if item is None:
+            wakeup.clear()
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=GMAIL_QUEUE_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        try:
+            await process_item(db, item, worker)
+        except Exception:
+            # Bookkeeping failed; the lease expiry hands the item to another worker
+            logger.error("Gmail queue worker %s crashed on %s", worker, item["_id"], exc_info=True)
+
+
+def start_workers(db, count: int = GMAIL_QUEUE_WORKERS):
+    for i in range(count):
+        worker = f"{_worker_prefix}:{i}:{uuid.uuid4().hex[:6]}"
+        _workers.append(asyncio.create_task(worker_loop(db, worker)))
+    logger.info("Started %d Gmail queue workers", count)
+
+
+async def stop_workers():
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+
+
+async def queue_stats(db) -> Dict[str, Any]:
+    """Depth per status and the age of the oldest item still waiting."""
+    counts = {PENDING: 0, PROCESSING: 0, FAILED: 0}
+    async for row in db[QUEUE_COLLECTION].aggregate([
+        {"$match": {"status": {"$in": list(counts)}}},
+        {"$group": {"_id": "$status", "n": {"$sum": 1}}},
+    ]):
+        counts[row["_id"]] = row["n"]
+    oldest = await db[QUEUE_COLLECTION].find_one(
+        {"status": {"$in": [PENDING, PROCESSING]}}, {"created_at": 1}, sort=[("created_at", 1)]
+    )
+    lag = (datetime.utcnow() - oldest["created_at"]).total_seconds() if oldest else 0.0
+    return {"depth": counts[PENDING] + counts[PROCESSING], **counts, "lag_seconds": round(lag, 3), "workers": len(_workers)}
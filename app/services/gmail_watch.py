@@ -0,0 +1,169 @@
+# app/services/gmail_watch.py
+"""
+Gmail watch renewal.
+
+A Gmail watch lapses after about seven days. Each account stores the
+`watch_expiration` from its last watch response and is renewed once that is
+less than GMAIL_WATCH_RENEW_BEFORE away, up to GMAIL_WATCH_CONCURRENCY
+accounts at a time. The scheduler loop runs in every API worker, but a lease
+document in `scheduler_leases` lets only one of them renew per round.
+
+Failures are recorded on the account (`watch_error`, `watch_failures`) and
+retried with backoff via `watch_retry_at`; a success clears them.
+"""
+import asyncio
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from pymongo.errors import DuplicateKeyError
+
+from app.core.config import settings
+from app.services.gmail_client import GmailAPIError
+from app.services.gmail_credentials import gmail_client_for
+from app.utils.logger import logger
+
+LEASES_COLLECTION = "scheduler_leases"
+WATCH_LEASE_ID = "gmail_watch"
+
+GMAIL_WATCH_RENEW_BEFORE = timedelta(hours=float(os.getenv("GMAIL_WATCH_RENEW_BEFORE_HOURS", "24")))
+GMAIL_WATCH_CONCURRENCY = int(os.getenv("GMAIL_WATCH_CONCURRENCY", "8"))
+GMAIL_WATCH_POLL_SECONDS = int(os.getenv("GMAIL_WATCH_POLL_SECONDS", "300"))
+RETRY_BASE = timedelta(minutes=5)
+RETRY_MAX = timedelta(hours=6)
+
+_owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+def topic_name() -> str:
+    return f"projects/{settings.PUBSUB_PROJECT}/topics/{settings.PUBSUB_TOPIC}"
+
+
+def watch_fields(response: Dict[str, Any]) -> Dict[str, Any]:
+    """Account fields recorded from a successful users.watch response."""
+    fields: Dict[str, Any] = {"watch_renewed_at": datetime.utcnow()}
+    if response.get("expiration"):
+        # Epoch milliseconds, as a string
+        fields["watch_expiration"] = datetime.utcfromtimestamp(int(response["expiration"]) / 1000)
+    return fields
+
+
+async def acquire_lease(db, name: str, ttl: timedelta, owner: str = _owner) -> bool:
+    """Take or extend the named lease; False while another process holds it."""
+    now = datetime.utcnow()
+    try:
+        await db[LEASES_COLLECTION].find_one_and_update(
+            {"_id": name, "$or": [{"until": {"$lt": now}}, {"owner": owner}]},
+            {"$set": {"owner": owner, "until": now + ttl}},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        # The lease exists, is unexpired and belongs to someone else
+        return False
+    return True
+
+
+async def release_lease(db, name: str, owner: str = _owner):
+    await db[LEASES_COLLECTION].delete_one({"_id": name, "owner": owner})
+
+
+async def renew_watch(db, account: dict) -> bool:
+    """Renew one account's watch and record the outcome on the account."""
+    try:
+        gmail = await gmail_client_for(db, account)
+        response = await gmail.watch(topic_name(), label_ids=["INBOX"])
+    except Exception as e:
+        failures = account.get("watch_failures", 0) + 1
+        retry_in = min(RETRY_BASE * 2 ** (failures - 1), RETRY_MAX)
+        logger.warning("Gmail watch renewal failed for %s (%d in a row): %s", account.get("email"), failures, e)
+        await db["gmail_accounts"].update_one(
+            {"_id": account["_id"]},
+            {"$set": {
+                "watch_error": {
+                    "message": str(e),
+                    "status_code": e.status_code if isinstance(e, GmailAPIError) else None,
+                    "at": datetime.utcnow(),
+                },
+                "watch_failures": failures,
+                "watch_retry_at": datetime.utcnow() + retry_in,
+            }},
+        )
+        return False
+
+    update: Dict[str, Any] = {
+        "$set": watch_fields(response),
+        "$unset": {"watch_error": "", "watch_failures": "", "watch_retry_at": ""},
+    }
+    await db["gmail_accounts"].update_one({"_id": account["_id"]}, update)
+    if not account.get("history_id") and response.get("historyId"):
+        # Nothing synced yet: start from here. Never moves an existing id,
+        # which would skip unprocessed history.
+        await db["gmail_accounts"].update_one(
+            {"_id": account["_id"], "history_id": {"$in": [None, ""]}},
+            {"$set": {"history_id": int(response["historyId"])}},
+        )
+    return True
+
+
+def due_query(now: Optional[datetime] = None) -> Dict[str, Any]:
+    now = now or datetime.utcnow()
+    return {
+        "$and": [
+            {"$or": [
+                {"watch_expiration": {"$exists": False}},
+                {"watch_expiration": {"$lt": now + GMAIL_WATCH_RENEW_BEFORE}},
+            ]},
+            {"$or": [{"watch_retry_at": {"$exists": False}}, {"watch_retry_at": {"$lte": now}}]},
+        ]
+    }
+
+
+async def renew_due_watches(db) -> Dict[str, int]:
+    """Renew every due account, GMAIL_WATCH_CONCURRENCY at a time."""
+    slots = asyncio.Semaphore(GMAIL_WATCH_CONCURRENCY)
+    results = {"renewed": 0, "failed": 0}
+
+    async def renew(account):
+        async with slots:
+            ok = await renew_watch(db, account)
+        results["renewed" if ok else "failed"] += 1
+
+    tasks = []
+    async for account in db["gmail_accounts"].find(due_query()):
+        tasks.append(asyncio.create_task(renew(account)))
+    if tasks:
+        await asyncio.gather(*tasks)
+        logger.info("Gmail watches: %(renewed)d renewed, %(failed)d failed", results)
+    return results
+
+
+async def _hold_lease(db, name: str, ttl: timedelta):
+    """Keep extending a lease this process holds until cancelled."""
+    while True:
+        await asyncio.sleep(ttl.total_seconds() / 3)
+        try:
+            if not await acquire_lease(db, name, ttl):
+                logger.warning("Lost the %s lease mid-round", name)
+        except Exception:
+            logger.warning("Failed extending the %s lease", name, exc_info=True)
+
+
+async def watch_scheduler(db):
+    """Renew due watches every GMAIL_WATCH_POLL_SECONDS, in one process of the cluster."""
+    # Extended throughout a round; expires on its own if this process dies
+    lease_ttl = timedelta(seconds=GMAIL_WATCH_POLL_SECONDS * 2)
+    while True:
+        try:
+            if await acquire_lease(db, WATCH_LEASE_ID, lease_ttl):
+                holder = asyncio.create_task(_hold_lease(db, WATCH_LEASE_ID, lease_ttl))
+                try:
+                    await renew_due_watches(db)
+                finally:
+                    holder.cancel()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.error("Gmail watch round failed", exc_info=True)
+        await asyncio.sleep(GMAIL_WATCH_POLL_SECONDS)
@@ -0,0 +1,193 @@
+"""
+Shopify order documents.
+
+`normalize_order` is the single mapping from a Shopify order payload (REST
+order or orders/create webhook body) to the `orders` document, and
+`OrderWriter` upserts those documents in unordered bulk batches. Sync, the
+webhook and the full backfill all go through here.
+"""
+import os
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from bson import ObjectId
+from cachetools import TTLCache
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from app.services.user_lookup import to_object_id
+from app.utils.logger import logger
+
+ORDER_WRITE_BATCH_SIZE = int(os.getenv("ORDER_WRITE_BATCH_SIZE", "500"))
+
+ADDRESS_FIELDS = ("address1", "address2", "city", "province", "country", "zip")
+
+# Order matching for /message/analyze; orders written through OrderWriter are
+# evicted, so the TTL only bounds staleness from other writers.
+_order_cache: TTLCache = TTLCache(maxsize=4096, ttl=60)
+
+
+def order_name_key(name: Any) -> Optional[str]:
+    """Order reference without "#", uppercased: "#ca1001" -> "CA1001"."""
+    key = str(name or "").strip().lstrip("#").strip().upper()
+    return key or None
+
+
+def normalize_email(email: Optional[str]) -> Optional[str]:
+    email = (email or "").strip().lower()
+    return email or None
+
+
+def normalize_order(
+    order: Dict[str, Any],
+    shop: str,
+    user_id: Optional[ObjectId] = None,
+    company_id: Optional[ObjectId] = None,
+) -> Dict[str, Any]:
+    customer = order.get("customer") or {}
+    default_address = customer.get("default_address") or {}
+    shipping_money = (order.get("total_shipping_price_set") or {}).get("shop_money") or {}
+    return {
+        "order_id": order["id"],
+        "shop": shop,
+        "user_id": user_id,
+        "company_id": company_id,
+        "order_number": order.get("order_number"),
+        "name": order.get("name"),
+        "name_key": order_name_key(order.get("name")),
+        "created_at": order.get("created_at"),
+        "customer": {
+            "id": customer.get("id"),
+            "email": customer.get("email"),
+            "name": f"{customer.get('first_name') or ''} {customer.get('last_name') or ''}".strip(),
+            "phone": customer.get("phone"),
+            "default_address": {field: default_address.get(field) for field in ADDRESS_FIELDS},
+        },
+        "customer_email": normalize_email(customer.get("email")),
+        "shipping_address": order.get("shipping_address") or {},
+        "billing_address": order.get("billing_address") or {},
+        "line_items": [
+            {
+                "id": item.get("id"),
+                "product_id": item.get("product_id"),
+                "name": item.get("name"),
+                "quantity": item.get("quantity"),
+                "price": item.get("price"),
+            }
+            for item in order.get("line_items") or []
+        ],
+        "total_price": order.get("total_price"),
+        "total_shipping_price": shipping_money.get("amount", 0),
+        "payment_status": order.get("financial_status"),
+        "fulfillment_status": order.get("fulfillment_status"),
+        "updated_at": order.get("updated_at"),
+    }
+
+
+async def shop_owner(db, shop: str) -> Tuple[Optional[ObjectId], Optional[ObjectId]]:
+    """(user_id, company_id) the shop is connected to, or (None, None)."""
+    cred = await db.shopify_cred.find_one({"shop": shop}, {"user_id": 1, "company_id": 1})
+    if not cred:
+        logger.warning("Shopify credentials not found for shop: %s", shop)
+        return None, None
+    return to_object_id(cred.get("user_id")), to_object_id(cred.get("company_id"))
+
+
+class OrderWriter:
+    """
+    Buffers order upserts and flushes them as unordered bulk writes of
+    `batch_size`. Unordered batches let the server apply every valid operation
+    even if one fails; failures are logged and counted, not silently dropped.
+
+        writer = OrderWriter(db)
+        for doc in docs:
+            await writer.add(doc)
+        counts = await writer.close()
+    """
+
+    def __init__(self, db, batch_size: int = ORDER_WRITE_BATCH_SIZE):
+        self.db = db
+        self.batch_size = max(1, batch_size)
+        self._ops = []
+        self.inserted = 0
+        self.modified = 0
+        self.matched = 0
+        self.failed = 0
+
+    async def add(self, doc: Dict[str, Any]):
+        _order_cache.pop((doc.get("company_id"), doc.get("name_key")), None)
+        self._ops.append(UpdateOne(
+            {"order_id": doc["order_id"], "shop": doc["shop"]},
+            {"$set": doc},
+            upsert=True,
+        ))
+        if len(self._ops) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        if not self._ops:
+            return
+        ops, self._ops = self._ops, []
+        try:
+            result = await self.db.orders.bulk_write(ops, ordered=False)
+            details = result.bulk_api_result
+        except BulkWriteError as e:
+            details = e.details
+            self.failed += len(details.get("writeErrors", []))
+            logger.error("Order bulk write: %d of %d operations failed", len(details.get("writeErrors", [])), len(ops))
+        self.inserted += details.get("nUpserted", 0)
+        self.modified += details.get("nModified", 0)
+        self.matched += details.get("nMatched", 0)
+
+    async def close(self) -> Dict[str, int]:
+        await self.flush()
+        return self.counts()
+
+    def counts(self) -> Dict[str, int]:
+        return {
+            "inserted": self.inserted,
+            "modified": self.modified,
+            "matched": self.matched,
+            "failed": self.failed,
+        }
+
+
+async def write_orders(db, shop: str, orders: Iterable[Dict[str, Any]], batch_size: int = ORDER_WRITE_BATCH_SIZE) -> Dict[str, int]:
+    """Normalize and upsert Shopify orders for `shop`; returns the write counts."""
+    user_id, company_id = await shop_owner(db, shop)
+    writer = OrderWriter(db, batch_size)
+    for order in orders:
+        await writer.add(normalize_order(order, shop, user_id, company_id))
+    return await writer.close()
+
+
+async def find_company_order(db, company_id: Optional[ObjectId], order_name: Any) -> Optional[Dict[str, Any]]:
+    """
+    The company's order with this name (with or without "#"), via the
+    (company_id, name_key) index. Never matches another tenant's orders.
+    """
+    key = order_name_key(order_name)
+    if company_id is None or key is None:
+        return None
+    cache_key = (company_id, key)
+    if cache_key in _order_cache:
+        order = _order_cache[cache_key]
+    else:
+        order = await db.orders.find_one({"company_id": company_id, "name_key": key})
+        _order_cache[cache_key] = order
+    # Callers serialise the result in place; keep the cached copy intact.
+    return dict(order) if order else None
+
+
+async def backfill_order_keys(db) -> dict:
+    """Migration: derive name_key / customer_email on orders written before they existed."""
+    result = await db.orders.update_many(
+        {"name_key": {"$exists": False}},
+        [{"$set": {
+            "name_key": {"$toUpper": {"$trim": {"input": {"$ifNull": ["$name", ""]}, "chars": "# "}}},
+            "customer_email": {"$toLower": {"$trim": {"input": {"$ifNull": ["$customer.email", ""]}}}},
+        }}],
+    )
+    # Keep "no value" as null rather than "" so it never matches a lookup.
+    await db.orders.update_many({"name_key": ""}, {"$set": {"name_key": None}})
+    await db.orders.update_many({"customer_email": ""}, {"$set": {"customer_email": None}})
+    return {"updated": result.modified_count}
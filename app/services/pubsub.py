@@ -0,0 +1,102 @@
+# app/services/pubsub.py
+"""
+Gmail Pub/Sub plumbing shared by the push endpoint and the streaming-pull
+worker (app.workers.gmail_pull).
+
+PUBSUB_MODE picks how notifications reach us:
+
+  push - Pub/Sub POSTs to /api/v1/gmail/pubsub/push on the API tier (default)
+  pull - the subscription has no push endpoint; `python -m app.workers.gmail_pull`
+         consumes it with streaming pull
+
+Either way a notification ends up in the same durable queue
+(app.services.gmail_queue). With PUBSUB_EMULATOR_HOST set, the client library
+talks to the local emulator and no service-account credentials are needed.
+"""
+import json
+import os
+from typing import Optional, Tuple
+
+from google.cloud import pubsub_v1
+from google.oauth2 import service_account
+
+from app.core.config import settings
+from app.utils.logger import logger
+
+PUBSUB_MODE = os.getenv("PUBSUB_MODE", "push").lower()
+PUSH_PATH = "/api/v1/gmail/pubsub/push"
+
+
+def is_emulator() -> bool:
+    return bool(os.getenv("PUBSUB_EMULATOR_HOST"))
+
+
+def _credentials():
+    if is_emulator():
+        return None
+    return service_account.Credentials.from_service_account_info(
+        json.loads(settings.SERVICE_ACCOUNT_JSON),
+        scopes=["https://www.googleapis.com/auth/pubsub"],
+    )
+
+
+def subscriber_client() -> pubsub_v1.SubscriberClient:
+    return pubsub_v1.SubscriberClient(credentials=_credentials())
+
+
+def publisher_client() -> pubsub_v1.PublisherClient:
+    return pubsub_v1.PublisherClient(credentials=_credentials())
+
+
+def subscription_path() -> str:
+    return pubsub_v1.SubscriberClient.subscription_path(settings.PUBSUB_PROJECT, settings.PUBSUB_SUBSCRIPTION)
+
+
+def _push_config() -> dict:
+    if PUBSUB_MODE == "pull":
+        return {}
+    return {"push_endpoint": f"{settings.BACKEND_URL}{PUSH_PATH}"}
+
+
+def ensure_subscription() -> str:
+    """
+    Blocking: create the subscription for PUBSUB_MODE if missing, or switch an
+    existing one between push and pull. Returns its path.
+    """
+    subscriber = subscriber_client()
+    topic_path = subscriber.topic_path(settings.PUBSUB_PROJECT, settings.PUBSUB_TOPIC)
+    path = subscription_path()
+    push_config = _push_config()
+
+    if is_emulator():
+        # The emulator starts empty; Gmail's topic exists in real projects
+        publisher = publisher_client()
+        try:
+            publisher.get_topic(request={"topic": topic_path})
+        except Exception:
+            publisher.create_topic(request={"name": topic_path})
+
+    try:
+        existing = subscriber.get_subscription(request={"subscription": path})
+    except Exception:
+        subscriber.create_subscription(request={"name": path, "topic": topic_path, "push_config": push_config})
+        return path
+
+    if existing.push_config.push_endpoint != push_config.get("push_endpoint", ""):
+        logger.info("Switching %s to %s delivery", path, PUBSUB_MODE)
+        subscriber.modify_push_config(request={"subscription": path, "push_config": push_config})
+    return path
+
+
+def gmail_notification(data: dict) -> Optional[Tuple[str, int]]:
+    """(emailAddress, historyId) from a decoded Gmail notification, or None if unusable."""
+    email_address = data.get("emailAddress")
+    history_id = data.get("historyId")
+    if not email_address or not history_id:
+        logger.warning("Pub/Sub payload missing emailAddress or historyId: %s", data)
+        return None
+    try:
+        return email_address, int(history_id)
+    except (TypeError, ValueError):
+        logger.warning("Pub/Sub payload has a non-numeric historyId: %s", data)
+        return None
@@ -0,0 +1,97 @@
+"""
+Inbox search.
+
+Thread headers carry two search fields maintained at ingestion time:
+
+  search_tokens - distinct normalised words from the title, the client
+                  (name and address) and the opening entry. Fixed when the
+                  thread is created (plus the opening entry's body once it is
+                  hydrated), so the set stays bounded however long the thread
+                  grows. Indexed together with company_id, so a lookup is an
+                  index scan inside one tenant. The last word of a query is
+                  matched as a prefix, which keeps "type-ahead" searches for
+                  names working.
+  search_text   - plain text of the opening entry, covered (with title and
+                  client) by the `thread_text` text index for relevance-ranked
+                  search.
+"""
+import re
+import unicodedata
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+SEARCH_TEXT_LIMIT = 2000
+MAX_TOKENS_PER_ENTRY = 300
+MIN_TOKEN_LENGTH = 2
+MAX_TOKEN_LENGTH = 40
+
+_TAG_RE = re.compile(r"<(script|style)[^>]*>.*?</\1>|<[^>]+>", re.IGNORECASE | re.DOTALL)
+_ENTITY_RE = re.compile(r"&[a-z]+;|&#\d+;", re.IGNORECASE)
+_SPACE_RE = re.compile(r"\s+")
+_WORD_RE = re.compile(r"[a-z0-9]+")
+_EMAIL_RE = re.compile(r"[a-z0-9._%+-]+@[a-z0-9.-]+\.[a-z]{2,}")
+
+
+def html_to_text(html: str) -> str:
+    text = _TAG_RE.sub(" ", html or "")
+    text = _ENTITY_RE.sub(" ", text)
+    return _SPACE_RE.sub(" ", text).strip()
+
+
+def normalize(text: str) -> str:
+    """Lowercase and strip accents so "José" matches "jose"."""
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).lower()
+
+
+def tokenize(text: str) -> List[str]:
+    """Distinct words (in first-seen order) plus any full email addresses."""
+    normalized = normalize(text)
+    seen = {}
+    for email in _EMAIL_RE.findall(normalized):
+        seen.setdefault(email, None)
+    for word in _WORD_RE.findall(normalized):
+        if MIN_TOKEN_LENGTH <= len(word) <= MAX_TOKEN_LENGTH:
+            seen.setdefault(word, None)
+    return list(seen)
+
+
+def entry_text(entry: Dict[str, Any]) -> str:
+    content = entry.get("content") or ""
+    if entry.get("message_type") == "html":
+        return html_to_text(content)
+    return content
+
+
+def thread_search_fields(header: Dict[str, Any], first_entry: Dict[str, Any]) -> Dict[str, Any]:
+    """search_text / search_tokens for a new thread header."""
+    body = entry_text(first_entry)
+    tokens = tokenize(" ".join(filter(None, [header.get("title"), header.get("client"), body])))
+    return {
+        "search_text": body[:SEARCH_TEXT_LIMIT],
+        "search_tokens": tokens[:MAX_TOKENS_PER_ENTRY],
+    }
+
+
+def entry_search_tokens(entry: Dict[str, Any], extra: Iterable[Optional[str]] = ()) -> List[str]:
+    """Tokens of one entry's text (plus `extra` strings), capped at MAX_TOKENS_PER_ENTRY."""
+    return tokenize(" ".join(filter(None, [*extra, entry_text(entry)])))[:MAX_TOKENS_PER_ENTRY]
+
+
+def build_token_query(search: str) -> Optional[Dict[str, Any]]:
+    """
+    Match every word of `search`; the last one as a prefix. Anchored regexes on
+    normalised tokens are index range scans, and user input is escaped.
+    """
+    tokens = tokenize(search)
+    if not tokens:
+        return None
+    *words, last = tokens
+    clauses = [{"search_tokens": word} for word in words]
+    clauses.append({"search_tokens": {"$regex": f"^{re.escape(last)}"}})
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+def build_text_query(search: str) -> Tuple[Dict[str, Any], Dict[str, Any], List[Tuple[str, Any]]]:
+    """Filter, projection and sort for relevance-ranked `$text` search."""
+    score = {"$meta": "textScore"}
+    return {"$text": {"$search": normalize(search)}}, {"score": score}, [("score", score)]
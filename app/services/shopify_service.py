@@ -1,7 +1,9 @@
+import asyncio
 import requests
 from datetime import datetime
-from pymongo import UpdateOne
-from bson import ObjectId
+
+from app.services.order_service import OrderWriter, normalize_order, shop_owner, write_orders
+from app.utils.logger import logger
 
 async def get_all_shopify_creds(db):
     """Fetch all Shopify store credentials from the database."""
@@ -11,7 +13,10 @@ async def get_all_shopify_creds(db):
 # Fetch full orders from a shopify store
 def fetch_orders_from_shop1(shop, access_token):
     """Fetch all orders from a Shopify store using the access token."""
-    orders = []
+    return [order for page in fetch_order_pages(shop, access_token) for order in page]
+
+def fetch_order_pages(shop, access_token):
+    """Yield a store's orders one page (up to 250) at a time; blocking."""
     url = f"https://{shop}/admin/api/2025-10/orders.json?status=any&limit=250"
     headers = {
         "X-Shopify-Access-Token": access_token,
@@ -28,7 +33,7 @@ def fetch_orders_from_shop1(shop, access_token):
         data = resp.json()
         if "orders" not in data:
             break
-        orders.extend(data["orders"])
+        yield data["orders"]
         # Pagination (Shopify uses 'link' header for next page)
         link = resp.headers.get("link")
         if link and 'rel="next"' in link:
@@ -44,7 +49,6 @@ def fetch_orders_from_shop1(shop, access_token):
                 break
         else:
             break
-    return orders
 
 async def fetch_orders_from_shop(shop, access_token):
     """Fetch the 30 most recent orders from a Shopify store using the access token."""
@@ -61,64 +65,30 @@ async def fetch_orders_from_shop(shop, access_token):
 
 async def upsert_orders(db, shop, orders):
     """Insert or update orders in the database for a specific shop."""
+    counts = await write_orders(db, shop, orders)
+    logger.info("Upserted orders for %s: %s", shop, counts)
+    return counts
 
-    user_id, company_id = None, None
-
-    cred = await db.shopify_cred.find_one({"shop": shop})
-    if not cred:
-        print(f"[!] Shopify credentials not found for shop: {shop}")
-        user_id = None
-        company_id = None
-    else:
-        user_id = cred.get("user_id")
-        company_id = cred.get("company_id")
-
-    bulk_ops = []
-    for order in orders:
-        doc = {
-            "order_id": order["id"],
-            "user_id": ObjectId(user_id),
-            "company_id": ObjectId(company_id),
-            "order_number": order.get("order_number"),
-            "name": order.get("name"),
-            "shop": shop,
-            "created_at": order.get("created_at"),
-            "customer": {
-                "id": order.get("customer", {}).get("id"),
-                "email": order.get("customer", {}).get("email"),
-                "name": f"{order.get('customer', {}).get('first_name', '')} {order.get('customer', {}).get('last_name', '')}".strip(),
-                "phone": order.get("customer", {}).get("phone"),
-                "default_address": {
-                    "address1": order.get("customer", {}).get("default_address", {}).get("address1"),
-                    "address2": order.get("customer", {}).get("default_address", {}).get("address2"),
-                    "city": order.get("customer", {}).get("default_address", {}).get("city"),
-                    "province": order.get("customer", {}).get("default_address", {}).get("province"),
-                    "country": order.get("customer", {}).get("default_address", {}).get("country"),
-                    "zip": order.get("customer", {}).get("default_address", {}).get("zip"),
-                }
-            },
-            "shipping_address": order.get("shipping_address", {}),
-            "billing_address": order.get("billing_address", {}),
-            "total_price": order.get("total_price"),
-            "payment_status": order.get("financial_status"),
-            "fulfillment_status": order.get("fulfillment_status"),
-            "line_items": [
-                {
-                    "product_id": item.get("product_id"),
-                    "name": item.get("name"),
-                    "quantity": item.get("quantity"),
-                    "price": item.get("price"),
-                }
-                for item in order.get("line_items", [])
-            ],
-            "updated_at": order.get("updated_at")
-        }
-        bulk_ops.append(
-            UpdateOne(
-                {"order_id": doc["order_id"], "shop": shop},
-                {"$set": doc},
-                upsert=True
-            )
-        )
-    if bulk_ops:
-        db.orders.bulk_write(bulk_ops)
\ No newline at end of file
+async def backfill_shop_orders(db, shop, access_token):
+    """
+    Full order history of a shop. Each page is written (unordered bulk batches)
+    before the next is fetched, so memory stays at one page however large the
+    history is.
+    """
+    loop = asyncio.get_running_loop()
+    pages = fetch_order_pages(shop, access_token)
+    user_id, company_id = await shop_owner(db, shop)
+    writer = OrderWriter(db)
+    total = 0
+    while True:
+        # fetch_order_pages uses blocking requests; keep it off the event loop.
+        page = await loop.run_in_executor(None, next, pages, None)
+        if page is None:
+            break
+        for order in page:
+            await writer.add(normalize_order(order, shop, user_id, company_id))
+        await writer.flush()
+        total += len(page)
+    counts = await writer.close()
+    logger.info("Backfilled %d orders for %s: %s", total, shop, counts)
+    return counts
@@ -0,0 +1,63 @@
+from typing import Any, Dict, Iterable, List, Optional
+from bson import ObjectId
+
+# Only what list views need; never ship password hashes around.
+USER_SUMMARY_PROJECTION = {"first_name": 1, "last_name": 1, "email": 1}
+
+
+def to_object_id(value: Any) -> Optional[ObjectId]:
+    if isinstance(value, ObjectId):
+        return value
+    if value and ObjectId.is_valid(str(value)):
+        return ObjectId(str(value))
+    return None
+
+
+def full_name(user: dict) -> str:
+    return f"{user.get('first_name', '')} {user.get('last_name', '')}".strip()
+
+
+def user_summary(user: Optional[dict]) -> Optional[dict]:
+    """The {id, name, email} shape used for assignees, comment authors and owners."""
+    if not user:
+        return None
+    return {
+        "id": str(user["_id"]),
+        "name": full_name(user),
+        "email": user.get("email", ""),
+    }
+
+
+async def fetch_by_ids(db, collection: str, ids: Iterable[Any], projection: Optional[dict] = None) -> Dict[ObjectId, dict]:
+    """
+    Resolve many ids with a single `$in` query.
+    Invalid and empty ids are ignored; returns {ObjectId: document}.
+    """
+    object_ids = {oid for oid in (to_object_id(i) for i in ids) if oid}
+    if not object_ids:
+        return {}
+    cursor = db[collection].find({"_id": {"$in": list(object_ids)}}, projection)
+    return {doc["_id"]: doc async for doc in cursor}
+
+
+async def fetch_users(db, ids: Iterable[Any], projection: Optional[dict] = USER_SUMMARY_PROJECTION) -> Dict[ObjectId, dict]:
+    return await fetch_by_ids(db, "users", ids, projection)
+
+
+def lookup_one(collection: str, local_field: str, as_field: str, projection: Optional[dict] = None, required: bool = True) -> List[dict]:
+    """
+    Aggregation stages joining one `collection` document by `_id` into `as_field`.
+    The join is an `_id` point lookup per input document, all inside the same
+    server-side aggregate. Required joins drop documents without a match.
+    """
+    lookup: Dict[str, Any] = {"from": collection, "localField": local_field, "foreignField": "_id", "as": as_field}
+    if projection:
+        lookup["pipeline"] = [{"$project": projection}]
+    return [
+        {"$lookup": lookup},
+        {"$unwind": {"path": f"${as_field}", "preserveNullAndEmptyArrays": not required}},
+    ]
+
+
+def lookup_user(local_field: str, as_field: str = "user", required: bool = True) -> List[dict]:
+    return lookup_one("users", local_field, as_field, USER_SUMMARY_PROJECTION, required)
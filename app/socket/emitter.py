@@ -0,0 +1,45 @@
+# app/socket/emitter.py
+"""
+Socket.IO emits from code that may run outside the API process.
+
+In the API process `app.main` attaches its AsyncServer and emits go through
+it. A standalone worker (e.g. app.workers.gmail_pull) has no server; with
+SOCKETIO_MESSAGE_QUEUE (a redis:// URL, needs the `redis` package) it
+publishes to the queue the API servers listen on, otherwise its emits are
+dropped and clients see the change on their next fetch.
+"""
+import os
+from typing import Any, Optional
+
+import socketio
+
+from app.utils.logger import logger
+
+SOCKETIO_MESSAGE_QUEUE = os.getenv("SOCKETIO_MESSAGE_QUEUE", "")
+
+_server: Optional[socketio.AsyncServer] = None
+_publisher: Optional[socketio.AsyncRedisManager] = None
+_warned = False
+
+
+def client_manager() -> Optional[socketio.AsyncRedisManager]:
+    """Manager for the API's AsyncServer, so it also relays workers' emits."""
+    return socketio.AsyncRedisManager(SOCKETIO_MESSAGE_QUEUE) if SOCKETIO_MESSAGE_QUEUE else None
+
+
+def attach(server: socketio.AsyncServer):
+    global _server
+    _server = server
+
+
+async def emit(event: str, data: Any, **kwargs):
+    global _publisher, _warned
+    if _server is not None:
+        await _server.emit(event, data, **kwargs)
+    elif SOCKETIO_MESSAGE_QUEUE:
+        if _publisher is None:
+            _publisher = socketio.AsyncRedisManager(SOCKETIO_MESSAGE_QUEUE, write_only=True)
+        await _publisher.emit(event, data, **kwargs)
+    elif not _warned:
+        _warned = True
+        logger.warning("No Socket.IO server or SOCKETIO_MESSAGE_QUEUE; dropping %s emits", event)
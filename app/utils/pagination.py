@@ -0,0 +1,72 @@
+# pagination.py
+import base64
+import json
+from datetime import datetime
+from math import ceil
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from fastapi import HTTPException
+
+# Counting stops here; totals past this point are reported as approximate.
+COUNT_LIMIT = 10000
+
+
+def _encode_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, datetime):
+        return {"d": value.isoformat()}
+    return {"v": value}
+
+
+def _decode_value(raw: Dict[str, Any]) -> Any:
+    if "d" in raw:
+        return datetime.fromisoformat(raw["d"])
+    return raw.get("v")
+
+
+def encode_cursor(doc: Dict[str, Any], sort_field: str) -> str:
+    """Opaque cursor pointing just after `doc` in a (sort_field desc, _id desc) ordering."""
+    payload = {"k": _encode_value(doc.get(sort_field)), "id": str(doc["_id"])}
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[Any, ObjectId]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded))
+        return _decode_value(payload["k"]), ObjectId(payload["id"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def keyset_filter(sort_field: str, cursor: str) -> Dict[str, Any]:
+    """Filter selecting the documents after `cursor` for a descending keyset sort."""
+    value, oid = decode_cursor(cursor)
+    return {"$or": [
+        {sort_field: {"$lt": value}},
+        {sort_field: value, "_id": {"$lt": oid}},
+    ]}
+
+
+def keyset_sort(sort_field: str) -> List[Tuple[str, int]]:
+    return [(sort_field, -1), ("_id", -1)]
+
+
+def next_cursor(docs: List[Dict[str, Any]], size: int, sort_field: str) -> Optional[str]:
+    """Cursor for the following page, or None when this page was the last one."""
+    if len(docs) < size:
+        return None
+    return encode_cursor(docs[-1], sort_field)
+
+
+async def approximate_count(collection, query: Dict[str, Any], size: int) -> Dict[str, Any]:
+    """
+    Count matching documents up to COUNT_LIMIT. Returns the count, the total
+    number of pages and whether the figure was capped.
+    """
+    count = await collection.count_documents(query, limit=COUNT_LIMIT)
+    return {
+        "total": count,
+        "totalPages": ceil(count / size),
+        "approximate": count >= COUNT_LIMIT,
+    }
@@ -0,0 +1,147 @@
+# app/workers/gmail_pull.py
+"""
+Streaming-pull consumer for Gmail Pub/Sub notifications.
+
+With PUBSUB_MODE=pull the subscription has no push endpoint; this process
+consumes it instead of the API tier. Each message is validated and written
+to the durable notification queue (app.services.gmail_queue) and acked only
+once it is stored, so a crash before that redelivers it. The process also
+runs queue workers (--workers, default GMAIL_QUEUE_WORKERS), so ingestion
+scales with the number of pull workers; set GMAIL_QUEUE_WORKERS=0 on the API
+tier to leave ingestion to them entirely.
+
+Flow control bounds what is in flight: at most PUBSUB_MAX_MESSAGES messages
+and PUBSUB_MAX_BYTES bytes are leased before earlier ones are acked.
+
+    PUBSUB_MODE=pull python -m app.workers.gmail_pull [--workers N]
+
+Against the local emulator (no service-account credentials needed):
+
+    gcloud beta emulators pubsub start --project=local-project
+    export PUBSUB_EMULATOR_HOST=localhost:8085 PUBSUB_PROJECT=local-project PUBSUB_MODE=pull
+    python -m app.workers.gmail_pull                                 # creates topic + subscription
+    python -m app.workers.gmail_pull publish someone@example.com 123456
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+from typing import List, Optional
+
+from google.cloud import pubsub_v1
+
+from app.core.config import settings
+from app.db.mongodb import close_database, connect_database
+from app.services.gmail_client import close_http_client
+from app.services.gmail_queue import GMAIL_QUEUE_WORKERS, enqueue, start_workers, stop_workers
+from app.services.pubsub import (
+    PUBSUB_MODE,
+    ensure_subscription,
+    gmail_notification,
+    is_emulator,
+    publisher_client,
+    subscriber_client,
+)
+from app.utils.logger import logger
+
+PUBSUB_MAX_MESSAGES = int(os.getenv("PUBSUB_MAX_MESSAGES", "100"))
+PUBSUB_MAX_BYTES = int(os.getenv("PUBSUB_MAX_BYTES", str(10 * 1024 * 1024)))
+# How long a callback thread waits for the queue insert before nacking
+PUBSUB_ENQUEUE_TIMEOUT = float(os.getenv("PUBSUB_ENQUEUE_TIMEOUT", "30"))
+
+
+def make_callback(loop: asyncio.AbstractEventLoop, db):
+    """Pub/Sub callback (runs on the client's thread pool) feeding the async queue."""
+
+    def callback(message):
+        try:
+            data = json.loads(message.data.decode("utf-8"))
+        except Exception:
+            # Redelivery would not fix it
+            logger.error("Undecodable Pub/Sub message %s", message.message_id, exc_info=True)
+            message.ack()
+            return
+
+        notification = gmail_notification(data)
+        if notification is None:
+            message.ack()
+            return
+
+        future = asyncio.run_coroutine_threadsafe(enqueue(db, *notification), loop)
+        try:
+            future.result(timeout=PUBSUB_ENQUEUE_TIMEOUT)
+        except Exception:
+            future.cancel()
+            logger.error("Failed to enqueue Gmail notification for %s", notification[0], exc_info=True)
+            message.nack()
+            return
+        message.ack()
+
+    return callback
+
+
+async def run(workers: int):
+    if PUBSUB_MODE != "pull":
+        # ensure_subscription would otherwise switch the subscription back to push
+        raise SystemExit("Set PUBSUB_MODE=pull to run the streaming-pull worker")
+
+    db = await connect_database()
+    loop = asyncio.get_running_loop()
+    path = await loop.run_in_executor(None, ensure_subscription)
+
+    subscriber = subscriber_client()
+    streaming_pull = subscriber.subscribe(
+        path,
+        callback=make_callback(loop, db),
+        flow_control=pubsub_v1.types.FlowControl(max_messages=PUBSUB_MAX_MESSAGES, max_bytes=PUBSUB_MAX_BYTES),
+    )
+    start_workers(db, workers)
+    logger.info("Pulling %s%s with %d queue workers", path, " (emulator)" if is_emulator() else "", workers)
+
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    # result() returns once cancelled and raises on a fatal stream error
+    pulling = loop.run_in_executor(None, streaming_pull.result)
+    stopping = asyncio.ensure_future(stop.wait())
+    try:
+        await asyncio.wait([pulling, stopping], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        streaming_pull.cancel()
+        stopping.cancel()
+        try:
+            await pulling
+        except Exception:
+            logger.error("Streaming pull stopped with an error", exc_info=True)
+        subscriber.close()
+        await stop_workers()
+        await close_http_client()
+        close_database()
+
+
+def publish(email_address: str, history_id: int):
+    """Publish a Gmail-shaped notification, e.g. to exercise the worker on the emulator."""
+    publisher = publisher_client()
+    topic_path = publisher.topic_path(settings.PUBSUB_PROJECT, settings.PUBSUB_TOPIC)
+    data = json.dumps({"emailAddress": email_address, "historyId": history_id}).encode("utf-8")
+    print(publisher.publish(topic_path, data).result())
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog="python -m app.workers.gmail_pull")
+    parser.add_argument("--workers", type=int, default=GMAIL_QUEUE_WORKERS, help="queue workers in this process")
+    sub = parser.add_subparsers(dest="command")
+    publish_cmd = sub.add_parser("publish", help="publish a test notification")
+    publish_cmd.add_argument("email")
+    publish_cmd.add_argument("history_id", type=int)
+    args = parser.parse_args(argv)
+
+    if args.command == "publish":
+        publish(args.email, args.history_id)
+    else:
+        asyncio.run(run(args.workers))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Member listing benchmark: per-member find_one (N+1) vs batched $in vs $lookup.
+
+Seeds a throwaway database with one company of --members active members (and
+one Gmail account each), applies the index registry, then times each way of
+building the /company/{id}/members and /gmail/company/{id} listings. A command
+listener counts the database round trips each variant makes.
+
+    MONGO_URL=mongodb://localhost:27017 python -m benchmarks.members_bench --members 500
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+from datetime import datetime
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
+
+from app.db.indexes import apply_indexes
+from app.services.user_lookup import fetch_by_ids, fetch_users, lookup_one, lookup_user
+
+ROLES = ["company_owner", "store_owner", "agent", "agent", "agent"]
+
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        if event.command_name in ("find", "aggregate", "getMore"):
+            self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+async def _seed(db, members):
+    company_id = ObjectId()
+    users, memberships, accounts, stores = [], [], [], []
+    now = datetime.utcnow()
+    for i in range(members):
+        user_id = ObjectId()
+        users.append({"_id": user_id, "email": f"member{i}@example.com", "first_name": f"First{i}",
+                      "last_name": f"Last{i}", "hashed_password": "x" * 60, "created_at": now})
+        memberships.append({"user_id": user_id, "company_id": company_id, "role": random.choice(ROLES),
+                            "status": "active", "joined_at": now, "last_used_at": now})
+        store_id = ObjectId()
+        stores.append({"_id": store_id, "shop": f"shop{i}.myshopify.com", "user_id": user_id, "company_id": company_id})
+        accounts.append({"user_id": user_id, "company_id": company_id, "email": f"inbox{i}@example.com",
+                         "store_id": store_id if i % 2 else None})
+    await db["users"].insert_many(users)
+    await db["memberships"].insert_many(memberships)
+    await db["shopify_cred"].insert_many(stores)
+    await db["gmail_accounts"].insert_many(accounts)
+    await apply_indexes(db, force=True)
+    return company_id
+
+
+async def members_n_plus_one(db, company_id):
+    rows = []
+    async for membership in db["memberships"].find({"company_id": company_id, "status": "active"}):
+        user = await db["users"].find_one({"_id": membership["user_id"]})
+        if user:
+            rows.append((membership["_id"], user["email"]))
+    return rows
+
+
+async def members_batched(db, company_id):
+    active = await db["memberships"].find({"company_id": company_id, "status": "active"}).to_list(None)
+    users = await fetch_users(db, (m["user_id"] for m in active))
+    return [(m["_id"], users[m["user_id"]]["email"]) for m in active if m["user_id"] in users]
+
+
+async def members_lookup(db, company_id):
+    cursor = db["memberships"].aggregate([
+        {"$match": {"company_id": company_id, "status": "active"}},
+        *lookup_user("user_id"),
+    ])
+    return [(m["_id"], m["user"]["email"]) async for m in cursor]
+
+
+async def accounts_n_plus_one(db, company_id):
+    rows = []
+    async for account in db["gmail_accounts"].find({"company_id": company_id}):
+        owner = await db["users"].find_one({"_id": account["user_id"]})
+        store = await db["shopify_cred"].find_one({"_id": account["store_id"]}) if account.get("store_id") else None
+        if owner:
+            rows.append((account["_id"], owner["email"], (store or {}).get("shop")))
+    return rows
+
+
+async def accounts_batched(db, company_id):
+    docs = await db["gmail_accounts"].find({"company_id": company_id}).to_list(None)
+    owners = await fetch_users(db, (a["user_id"] for a in docs))
+    stores = await fetch_by_ids(db, "shopify_cred", (a.get("store_id") for a in docs), {"shop": 1})
+    return [(a["_id"], owners[a["user_id"]]["email"], (stores.get(a.get("store_id")) or {}).get("shop"))
+            for a in docs if a["user_id"] in owners]
+
+
+async def accounts_lookup(db, company_id):
+    cursor = db["gmail_accounts"].aggregate([
+        {"$match": {"company_id": company_id}},
+        *lookup_user("user_id", "owner"),
+        *lookup_one("shopify_cred", "store_id", "linked_store", {"shop": 1}, required=False),
+    ])
+    return [(a["_id"], a["owner"]["email"], (a.get("linked_store") or {}).get("shop")) async for a in cursor]
+
+
+async def _time(label, fn, db, company_id, counter, repeat):
+    timings = []
+    rows = 0
+    counter.count = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = len(await fn(db, company_id))
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    queries = counter.count // repeat
+    print(f"  {label:<10} median {timings[len(timings) // 2]:8.2f} ms   p95 {timings[int(len(timings) * 0.95) - 1]:8.2f} ms"
+          f"   queries {queries:5d}   rows {rows}")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--members", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    counter = CommandCounter()
+    client = AsyncIOMotorClient(os.getenv("MONGO_URL", "mongodb://localhost:27017"), event_listeners=[counter])
+    db_name = f"attentify_members_bench_{int(time.time())}"
+    db = client[db_name]
+    try:
+        print(f"Seeding a company with {args.members} members into {db_name} ...")
+        company_id = await _seed(db, args.members)
+
+        print("company members")
+        await _time("n+1", members_n_plus_one, db, company_id, counter, args.repeat)
+        await _time("$in", members_batched, db, company_id, counter, args.repeat)
+        await _time("$lookup", members_lookup, db, company_id, counter, args.repeat)
+
+        print("gmail accounts")
+        await _time("n+1", accounts_n_plus_one, db, company_id, counter, args.repeat)
+        await _time("$in", accounts_batched, db, company_id, counter, args.repeat)
+        await _time("$lookup", accounts_lookup, db, company_id, counter, args.repeat)
+    finally:
+        await client.drop_database(db_name)
+        client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
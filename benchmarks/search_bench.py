@@ -0,0 +1,113 @@
+"""
+Inbox search benchmark: legacy unanchored $regex vs search_tokens vs $text.
+
+Seeds a throwaway database with synthetic threads for several tenants, applies
+the index registry, then times each query path for the same search terms.
+
+    MONGO_URL=mongodb://localhost:27017 python -m benchmarks.search_bench --threads 50000
+"""
+import argparse
+import asyncio
+import os
+import random
+import re
+import string
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from app.db.indexes import apply_indexes
+from app.services.search_service import build_text_query, build_token_query, thread_search_fields
+
+FIRST_NAMES = ["james", "maria", "chen", "fatima", "olivia", "liam", "sofia", "noah", "amelia", "lucas"]
+LAST_NAMES = ["smith", "garcia", "wang", "khan", "brown", "muller", "rossi", "kim", "silva", "novak"]
+WORDS = ["order", "refund", "cancel", "shipping", "delayed", "package", "invoice", "size", "exchange",
+         "damaged", "tracking", "address", "payment", "discount", "return", "warranty"]
+
+
+def _legacy_regex_query(company_id, search):
+    search_regex = {"$regex": search, "$options": "i"}
+    return {"company_id": company_id, "$or": [{"title": search_regex}, {"client": search_regex}]}
+
+
+def _thread(company_id, now):
+    first, last = random.choice(FIRST_NAMES), random.choice(LAST_NAMES)
+    client = f"{first.title()} {last.title()} <{first}.{last}{random.randint(1, 999)}@example.com>"
+    title = f"{random.choice(WORDS).title()} for order #CA{random.randint(1000, 9999)}"
+    body = " ".join(random.choice(WORDS + list(string.ascii_lowercase)) for _ in range(200))
+    header = {
+        "_id": ObjectId(),
+        "company_id": company_id,
+        "title": title,
+        "client": client,
+        "channel": "email",
+        "last_updated": now - timedelta(minutes=random.randint(0, 500000)),
+    }
+    header.update(thread_search_fields(header, {"content": body, "message_type": "text"}))
+    return header
+
+
+async def _seed(db, threads, tenants):
+    companies = [ObjectId() for _ in range(tenants)]
+    now = datetime.utcnow()
+    batch = []
+    for i in range(threads):
+        batch.append(_thread(companies[i % tenants], now))
+        if len(batch) == 1000:
+            await db["messages"].insert_many(batch)
+            batch = []
+    if batch:
+        await db["messages"].insert_many(batch)
+    await apply_indexes(db, force=True)
+    return companies[0]
+
+
+async def _time(label, coro_factory, repeat):
+    timings = []
+    found = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        found = len(await coro_factory())
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    print(f"  {label:<10} median {timings[len(timings) // 2]:8.2f} ms   p95 {timings[int(len(timings) * 0.95) - 1]:8.2f} ms   rows {found}")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=20000)
+    parser.add_argument("--tenants", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--size", type=int, default=20)
+    args = parser.parse_args()
+
+    client = AsyncIOMotorClient(os.getenv("MONGO_URL", "mongodb://localhost:27017"))
+    db_name = f"attentify_search_bench_{int(time.time())}"
+    db = client[db_name]
+    try:
+        print(f"Seeding {args.threads} threads across {args.tenants} tenants into {db_name} ...")
+        company_id = await _seed(db, args.threads, args.tenants)
+        messages = db["messages"]
+
+        for term in ["maria", "gar", "refund", "maria garcia", "james.smith"]:
+            print(f"search={term!r}")
+
+            await _time("regex", lambda: messages.find(_legacy_regex_query(company_id, re.escape(term)))
+                        .sort("last_updated", -1).limit(args.size).to_list(args.size), args.repeat)
+
+            token_query = {"$and": [{"company_id": company_id}, build_token_query(term)]}
+            await _time("tokens", lambda: messages.find(token_query)
+                        .sort("last_updated", -1).limit(args.size).to_list(args.size), args.repeat)
+
+            text_filter, projection, sort = build_text_query(term)
+            await _time("text", lambda: messages.find({"company_id": company_id, **text_filter}, projection)
+                        .sort(sort).limit(args.size).to_list(args.size), args.repeat)
+    finally:
+        await client.drop_database(db_name)
+        client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())